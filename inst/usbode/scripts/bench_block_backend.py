@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Compare sequential and random read throughput of a plain ISO against the
+# NBD device serving a compressed copy of it. Mount the compressed image from
+# the web UI first so /dev/nbd0 is live, then run as root:
+#   python3 bench_block_backend.py /mnt/imgstore/game.iso /dev/nbd0
+import os
+import random
+import sys
+import time
+
+# f_mass_storage reads the backing file in 16 KiB buffers
+read_size = 16 * 1024
+random_reads = 2000
+
+def drop_caches():
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+def size_of(fd):
+    return os.lseek(fd, 0, os.SEEK_END)
+
+def sequential(path):
+    drop_caches()
+    fd = os.open(path, os.O_RDONLY)
+    total = 0
+    start = time.monotonic()
+    while True:
+        data = os.pread(fd, read_size, total)
+        if not data:
+            break
+        total += len(data)
+    elapsed = time.monotonic() - start
+    os.close(fd)
+    return total, elapsed
+
+def scattered(path):
+    drop_caches()
+    fd = os.open(path, os.O_RDONLY)
+    blocks = size_of(fd) // read_size
+    rng = random.Random(0)
+    total = 0
+    start = time.monotonic()
+    for i in range(random_reads):
+        total += len(os.pread(fd, read_size, rng.randrange(blocks) * read_size))
+    elapsed = time.monotonic() - start
+    os.close(fd)
+    return total, elapsed
+
+def main():
+    if len(sys.argv) < 3:
+        print(f"usage: {sys.argv[0]} <plain image> <nbd device or compressed export> ...")
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        for name, test in (('sequential', sequential), ('random', scattered)):
+            total, elapsed = test(path)
+            print(f"{path:40} {name:10} {total / 1048576:9.1f} MB {total / 1048576 / elapsed:8.2f} MB/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Compare how long a display button takes to hand a mount to the gadget job
+# queue over the old HTTP loopback path and through the in-process command bus.
+# The job worker is not started, so nothing is actually mounted:
+#   python3 bench_command_bus.py -n 500
+import argparse
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import usbode
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def report(name, latencies):
+    latencies.sort()
+    print(f"{name:10} p50 {statistics.median(latencies) * 1e6:8.0f} us  p95 {percentile(latencies, 0.95) * 1e6:8.0f} us  "
+          f"max {latencies[-1] * 1e6:8.0f} us")
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback HTTP versus command bus dispatch latency")
+    parser.add_argument('-n', '--count', type=int, default=500)
+    parser.add_argument('--image', default='bench.iso', help="store-relative image name to queue")
+    args = parser.parse_args()
+    usbode.logger.setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    server = usbode.PooledWSGIServer('127.0.0.1', 0, usbode.app)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/mount/{urllib.parse.quote_plus(args.image)}"
+
+    loopback = []
+    for i in range(args.count):
+        start = time.perf_counter()
+        with urllib.request.urlopen(url, timeout=30) as response:
+            response.read()
+        loopback.append(time.perf_counter() - start)
+
+    bus = []
+    for i in range(args.count):
+        start = time.perf_counter()
+        usbode.dispatch(usbode.MountImage(args.image))
+        bus.append(time.perf_counter() - start)
+
+    report('loopback', loopback)
+    report('bus', bus)
+    print(f"{statistics.median(loopback) / statistics.median(bus):.0f}x faster at the median")
+    server.stop(0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# End-to-end mode switch latency now that both gadgets are pre-staged and a
+# switch only moves the UDC, against the shell helper scripts that rebuilt the
+# gadget every time (reproduced below). Stop the service first and run as root
+# with the image store mounted and an image remembered in usbode-iso.txt:
+#   systemctl stop usbode && python3 bench_switch.py -n 10
+import argparse
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import usbode
+
+# The removed cleanup_mode.sh, *_gadget_setup.sh, enablegadget.sh and disablegadget.sh
+legacy_cleanup = """cd $1
+rm configs/c.1/mass_storage.usb0
+rmdir configs/c.1/strings/0x409
+rmdir configs/c.1
+rmdir functions/mass_storage.usb0
+rmdir strings/0x409
+cd ..
+rmdir $1"""
+legacy_setup = """cd $1
+echo "$2" > idVendor
+echo "$3" > idProduct
+echo 0x0100 > bcdDevice
+echo 0x0200 > bcdUSB
+echo "1111111111" > strings/0x409/serialnumber
+echo "Linux" > strings/0x409/manufacturer
+echo "$4" > strings/0x409/product
+echo "$5" > configs/c.1/strings/0x409/configuration
+echo 0 > configs/c.1/MaxPower
+echo $6 > functions/mass_storage.usb0/lun.0/cdrom
+echo $6 > functions/mass_storage.usb0/lun.0/ro
+echo 1 > functions/mass_storage.usb0/lun.0/removable
+ln -s functions/mass_storage.usb0 configs/c.1"""
+legacy_enable = 'cd "$1"\nls "/sys/class/udc" > UDC'
+legacy_disable = 'cd $1\necho "" > UDC'
+
+def sh(script, *args):
+    subprocess.run(['sh', '-c', script, 'sh'] + list(args), capture_output=True)
+
+def legacy_switch(profile, backing):
+    path = usbode.gadgetCDFolder
+    settings = usbode.gadget_profiles[profile]
+    sh(legacy_disable, path)
+    sh(legacy_cleanup, path)
+    time.sleep(.25)
+    for folder in ("strings/0x409", "configs/c.1/strings/0x409", "functions/mass_storage.usb0"):
+        os.makedirs(f"{path}/{folder}", exist_ok=True)
+    sh(legacy_setup, path, settings['idVendor'], settings['idProduct'], settings['product'],
+       settings['configuration'], settings['cdrom'])
+    with open(f"{path}/functions/mass_storage.usb0/lun.0/file", "w") as f:
+        f.write(backing)
+    sh(legacy_enable, path)
+
+def report(name, latencies):
+    latencies.sort()
+    print(f"{name:8} median {statistics.median(latencies) * 1000:7.0f} ms  min {latencies[0] * 1000:7.0f} ms  "
+          f"max {latencies[-1] * 1000:7.0f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Mode switch latency, shell scripts versus native configfs")
+    parser.add_argument('-n', '--count', type=int, default=10, help="switches per method, alternating modes")
+    args = parser.parse_args()
+    usbode.logger.setLevel(logging.WARNING)
+    with open(usbode.iso_mount_file) as f:
+        image = f.readline().strip()
+    usbode.image_catalog.refresh()
+
+    # Start from no gadgets, as the stopped service leaves configfs
+    usbode.disable_gadget()
+    for staged in usbode.gadgets.values():
+        usbode.cleanupMode(staged.path)
+
+    before = []
+    for i in range(args.count):
+        profile, backing = ('exfat', usbode.store_dev) if i % 2 == 0 else ('cdrom', image)
+        start = time.perf_counter()
+        legacy_switch(profile, backing)
+        before.append(time.perf_counter() - start)
+
+    # Stage both gadgets as the service does at boot before timing switch() itself
+    sh(legacy_disable, usbode.gadgetCDFolder)
+    sh(legacy_cleanup, usbode.gadgetCDFolder)
+    usbode.init_gadget('cdrom')
+    after = []
+    for i in range(args.count):
+        start = time.perf_counter()
+        usbode.switch()
+        after.append(time.perf_counter() - start)
+
+    report('scripts', before)
+    report('native', after)
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +0,0 @@
-cd $1
-echo "" > UDC
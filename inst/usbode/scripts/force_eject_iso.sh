@@ -1,3 +0,0 @@
-cd $1
-
-echo 1 > functions/mass_storage.usb0/lun.0/forced_eject
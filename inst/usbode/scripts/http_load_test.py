@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Measure web UI latency under concurrent clients, optionally with slow
+# clients holding connections open the way old browsers on retro machines do,
+# and with open /events streams like browser tabs left on the status page.
+#   python3 http_load_test.py http://usbode.local -c 8 -n 400 --slow 4 --streams 4
+import argparse
+import socket
+import statistics
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+def slow_client(host, port, stop):
+    # Send a request line and then dribble headers so the connection stays open
+    try:
+        sock = socket.create_connection((host, port), timeout=60)
+        sock.sendall(b"GET / HTTP/1.1\r\nHost: usbode\r\n")
+        while not stop.is_set():
+            sock.sendall(b"X-Slow: 1\r\n")
+            stop.wait(2)
+        sock.close()
+    except OSError:
+        pass
+
+def event_stream(host, port, stop, refused):
+    # Subscribe to /events and hold the stream open without reading it
+    try:
+        sock = socket.create_connection((host, port), timeout=60)
+        sock.sendall(b"GET /events HTTP/1.1\r\nHost: usbode\r\n\r\n")
+        if b" 503 " in sock.recv(64):
+            refused.append(1)
+        stop.wait()
+        sock.close()
+    except OSError:
+        refused.append(1)
+
+def worker(base, paths, count, latencies, errors, lock):
+    for i in range(count):
+        url = base + paths[i % len(paths)]
+        start = time.monotonic()
+        try:
+            with urllib.request.urlopen(url, timeout=30) as response:
+                response.read()
+            elapsed = time.monotonic() - start
+            with lock:
+                latencies.append(elapsed)
+        except Exception:
+            with lock:
+                errors.append(url)
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent latency test for the USBODE web server")
+    parser.add_argument('base', help="base URL, e.g. http://usbode.local")
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('-n', '--requests', type=int, default=400, help="total requests across all clients")
+    parser.add_argument('--slow', type=int, default=0, help="slow clients to keep connected during the test")
+    parser.add_argument('--streams', type=int, default=0, help="/events streams to keep open during the test")
+    parser.add_argument('--paths', default='/,/list,/search.json?q=a')
+    args = parser.parse_args()
+
+    base = args.base.rstrip('/')
+    target = urllib.parse.urlsplit(base)
+    paths = args.paths.split(',')
+    stop = threading.Event()
+    slow = [threading.Thread(target=slow_client, args=(target.hostname, target.port or 80, stop), daemon=True) for i in range(args.slow)]
+    refused = []
+    slow += [threading.Thread(target=event_stream, args=(target.hostname, target.port or 80, stop, refused), daemon=True) for i in range(args.streams)]
+    for thread in slow:
+        thread.start()
+    time.sleep(0.5)
+
+    latencies, errors, lock = [], [], threading.Lock()
+    per_client = max(1, args.requests // args.concurrency)
+    clients = [threading.Thread(target=worker, args=(base, paths, per_client, latencies, errors, lock)) for i in range(args.concurrency)]
+    start = time.monotonic()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.monotonic() - start
+    stop.set()
+
+    latencies.sort()
+    if args.streams:
+        print(f"{args.streams - len(refused)} of {args.streams} event streams accepted")
+    print(f"{args.concurrency} clients, {args.slow} slow clients, {len(latencies)} ok, {len(errors)} failed in {elapsed:.1f} s ({len(latencies) / elapsed:.1f} req/s)")
+    if latencies:
+        print(f"latency ms: min {latencies[0] * 1000:.0f}  p50 {statistics.median(latencies) * 1000:.0f}  "
+              f"p95 {percentile(latencies, 0.95) * 1000:.0f}  p99 {percentile(latencies, 0.99) * 1000:.0f}  max {latencies[-1] * 1000:.0f}")
+
+if __name__ == "__main__":
+    main()
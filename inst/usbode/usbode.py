@@ -6,13 +6,36 @@ import datetime
 from logging.handlers import RotatingFileHandler
 import time
 import subprocess
-import requests
+import re
+import sqlite3
+import ctypes
+import ctypes.util
+import struct
+import bisect
+import hashlib
+import zlib
+import gzip
+import bz2
+import mmap
+import json
+import io
+import socket
+import fcntl
+import errno
+from xml.etree import ElementTree
+from collections import namedtuple, OrderedDict, deque
 from gpiozero import *
 from pathlib import Path
-from threading import Thread, Lock
+import threading
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import functools
 import time
 import urllib.parse
-from flask import Flask
+import html
+from flask import Flask, request, jsonify, send_file
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 
 def setup_logging():
     """Configure logging to both console and file"""
@@ -102,6 +125,34 @@ def read_display_config():
     return default_display
 display_type = read_display_config()
 
+# f_mass_storage accepts at most this many LUNs per function
+changer_max_luns = 16
+
+def read_changer_config():
+    """
+    Read the number of CD-ROM LUNs from a changer=N line in /boot/firmware/usbode.conf
+    Each LUN is a drive with its own image; defaults to 1, a plain single drive
+    """
+    config_file = '/boot/firmware/usbode.conf'
+    try:
+        if os.path.exists(config_file):
+            with open(config_file, 'r') as f:
+                for line in f:
+                    line = line.split('#', 1)[0].strip()
+                    if line.startswith('changer='):
+                        luns = int(line.split('=', 1)[1].strip())
+                        if 1 <= luns <= changer_max_luns:
+                            if luns > 1:
+                                logger.info(f"Disc changer enabled with {luns} LUNs")
+                            return luns
+                        logger.warning(f"changer in {config_file} must be between 1 and {changer_max_luns}, not {luns}")
+    except Exception as e:
+        logger.error(f"Error reading changer configuration: {e}")
+    return 1
+changer_luns = read_changer_config()
+# LUN the display pickers load into, chosen in the advanced menu
+display_disc = 0
+
 try:
     if display_type == 'pirateaudio':
         import st7789
@@ -133,7 +184,9 @@ store_dev = '/dev/mmcblk0p3'
 store_mnt = '/mnt/imgstore'
 allow_update_from_store = True
 gadgetCDFolder = '/sys/kernel/config/usb_gadget/usbode'
+gadgetExfatFolder = '/sys/kernel/config/usb_gadget/usbode_exfat'
 iso_mount_file = '/opt/usbode/usbode-iso.txt'
+catalog_db_file = '/opt/usbode/usbode-catalog.db'
 cdemu_cdrom = '/dev/cdrom'
 versionNum = "1.99a"
 global updateEvent
@@ -151,384 +204,4652 @@ def version():
     logger.info("Web Functionality and massive rewrite Danifunker: https://github.com/danifunker/usbode")
     logger.info(f"USBODE version {versionNum}")
 
-global myIPAddress
-myIPAddress = "Unable to determine IP address"
+global myIPAddress
+myIPAddress = "Unable to determine IP address"
+
+def getMyIPAddress():
+    while True:
+        global myIPAddress
+        time.sleep(1)
+        try:
+            ipAddressAttempt = subprocess.check_output(['hostname', '-I']).decode('utf-8').strip().split(' ')[0]
+        except Exception as e:
+            ipAddressAttempt = "Unable to determine IP address"
+            logger.error(f"Failed to get IP address: {e}")
+        
+        if ipAddressAttempt != myIPAddress:
+            logger.info(f"IP address changed from {myIPAddress} to {ipAddressAttempt}")
+            myIPAddress = ipAddressAttempt
+            signal_update()
+
+### Beginning of Metrics ###
+
+# Kept in memory and rendered in the Prometheus text format by /metrics; recording
+# a sample is a bisect and two additions under an uncontended lock
+metric_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def metric_labels(label, value):
+    if value is None:
+        return ""
+    escaped = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'{label}="{escaped}"'
+
+class Histogram:
+    """Latency distribution in seconds, optionally split by one label"""
+
+    def __init__(self, name, help, label=None, buckets=metric_buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        self.lock = Lock()
+        metrics.append(self)
+
+    def observe(self, seconds, value=None):
+        with self.lock:
+            series = self.series.get(value)
+            if series is None:
+                series = self.series[value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            series[1] += seconds
+
+    def time(self, value=None):
+        return timed_block(self, value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(value, list(counts), total) for value, (counts, total) in self.series.items()]
+        for value, counts, total in sorted(series, key=lambda s: str(s[0])):
+            label = metric_labels(self.label, value)
+            prefix = label + "," if label else ""
+            running = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                running += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {running}')
+            suffix = f"{{{label}}}" if label else ""
+            lines.append(f"{self.name}_sum{suffix} {total:.6f}")
+            lines.append(f"{self.name}_count{suffix} {running}")
+        return lines
+
+class Counter:
+    """Monotonic count, optionally split by one label"""
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+        self.lock = Lock()
+        metrics.append(self)
+
+    def inc(self, value=None, amount=1):
+        with self.lock:
+            self.values[value] = self.values.get(value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        for value, count in sorted(values, key=lambda v: str(v[0])):
+            label = metric_labels(self.label, value)
+            lines.append(f"{self.name}{{{label}}} {count}" if label else f"{self.name} {count}")
+        return lines
+
+class Gauge:
+    """Value read when /metrics is scraped; read returns a number or a dict of label value to number"""
+
+    def __init__(self, name, help, read, label=None, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+        self.kind = kind
+        metrics.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.read()
+        except Exception as e:
+            logger.error(f"Cannot read {self.name}: {e}")
+            return lines
+        if isinstance(values, dict):
+            for value, number in sorted(values.items(), key=lambda v: str(v[0])):
+                lines.append(f"{self.name}{{{metric_labels(self.label, value)}}} {number}")
+        elif values is not None:
+            lines.append(f"{self.name} {values}")
+        return lines
+
+metrics = []
+
+@contextmanager
+def timed_block(histogram, value=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - start, value)
+
+# Per thread: how deep we are in timed calls of each group
+timed_depth = threading.local()
+
+def timed(histogram, value=None, group=None):
+    """
+    Decorator recording how long each call takes into histogram. Calls of a
+    group made from inside another call of the same group on this thread are
+    part of that operation and are not recorded again.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            depth = getattr(timed_depth, group, 0) if group else 0
+            if group:
+                setattr(timed_depth, group, depth + 1)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if group:
+                    setattr(timed_depth, group, depth)
+                if not depth:
+                    histogram.observe(time.perf_counter() - start, value)
+        return wrapper
+    return decorate
+
+def outermost_call(group):
+    """True inside a timed call of group that no other call of group encloses"""
+    return getattr(timed_depth, group, 0) <= 1
+
+clock_ticks = os.sysconf('SC_CLK_TCK')
+page_size = os.sysconf('SC_PAGE_SIZE')
+
+def resident_memory():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * page_size
+
+def thread_cpu_seconds():
+    """CPU time (user + system) of every live thread, keyed by its Python name"""
+    names = {thread.native_id: thread.name for thread in threading.enumerate()}
+    seconds = {}
+    for task in os.listdir('/proc/self/task'):
+        try:
+            with open(f'/proc/self/task/{task}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces, the fields after it never do
+        fields = stat[stat.rindex(')') + 2:].split()
+        name = names.get(int(task), stat[stat.index('(') + 1:stat.rindex(')')])
+        seconds[name] = seconds.get(name, 0) + (int(fields[11]) + int(fields[12])) / clock_ticks
+    return seconds
+
+mount_seconds = Histogram('usbode_mount_seconds', "Time to change the loaded image (change_Loaded_Mount)")
+switch_seconds = Histogram('usbode_switch_seconds', "Time to switch between CD-ROM and exFAT mode")
+rollback_seconds = Histogram('usbode_rollback_seconds', "Time to restore the gadget after a failed job")
+init_gadget_seconds = Histogram('usbode_init_gadget_seconds', "Time to set up the gadget in a mode", 'mode')
+display_render_seconds = Histogram('usbode_display_render_seconds', "Time to draw a screen, including the flush", 'screen')
+display_flush_seconds = Histogram('usbode_display_flush_seconds', "Time to send a frame to the display over SPI", 'display')
+http_request_seconds = Histogram('usbode_http_request_seconds', "Time to handle a web request, up to the first byte of streamed pages", 'route')
+mounts_total = Counter('usbode_mounts_total', "Image changes by outcome", 'result')
+mode_switches_total = Counter('usbode_mode_switches_total', "Switches between CD-ROM and exFAT mode")
+button_presses_total = Counter('usbode_button_presses_total', "Display button presses by GPIO pin", 'pin')
+Gauge('usbode_catalog_images', "Images in the catalog", lambda: len(image_catalog.entries))
+Gauge('usbode_resident_memory_bytes', "Resident set size of the USBODE process", resident_memory)
+Gauge('usbode_thread_cpu_seconds_total', "CPU time used by each thread", thread_cpu_seconds, 'thread', 'counter')
+
+def count_button_press(pin):
+    button_presses_total.inc(pin)
+
+def render_metrics():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+### END OF METRICS ###
+
+### Begining of Web Interface ###
+
+app = Flask(__name__)
+
+# Stylesheet for every page, served as its own long-lived, pre-compressed asset instead of inline
+SITE_CSS = """/* Basic styling compatible with CSS 1.0 */
+body {background-color: #EAEAEA; color: #333333; font-family: serif; margin: 0; padding: 0;}
+h1, h2, h3 {color: #1E4D8C;}
+a {color: #0066CC;}
+a:visited {color: #0066CC;}
+
+/* Container with percentage-based width for better scaling */
+.container {width: 100%; max-width: 800px; margin: 0 auto; padding: 0;}
+
+/* Header and footer styling */
+.header {background-color: #3A7CA5; padding: 10px; text-align: center; color: #FFFFFF;}
+.header h1, .header h2 {color: #FFFFFF; margin: 5px 0;}
+.content {padding: 10px; background-color: #FFFFFF; min-height: 300px;}
+.footer {background-color: #3A7CA5; padding: 10px; text-align: center; color: #FFFFFF;}
+
+/* Button styling that works on small screens */
+.button {
+    background-color: #4CAF50; 
+    padding: 7px 15px; 
+    text-decoration: none; 
+    color: #FFFFFF; 
+    margin: 5px; 
+    display: inline-block;
+    border: 1px solid #2E8B57;
+}
+
+/* Info boxes with better padding on small screens */
+.info-box {background-color: #F5F5F5; padding: 10px; margin: 10px 0;}
+.warning {background-color: #FFDDDD; padding: 10px; margin: 10px 0; color: #990000;}
+
+/* File list items with better scaling */
+.file-link {
+    padding: 8px; 
+    margin: 5px 0; 
+    display: block; 
+    font-size: 16px;
+    word-wrap: break-word;
+    overflow-wrap: break-word;
+}
+.file-info {font-size: 12px; color: #555555;}
+.thumb {float: right; max-height: 48px; margin-left: 6px;}
+.file-link-even {background-color: #E3F2FD;}
+.file-link-odd {background-color: #BBDEFB;}
+
+/* Simple media queries for basic responsive layout - ignored by old browsers */
+@media screen and (max-width: 480px) {
+    .button {
+        display: block;
+        margin: 10px 0;
+        text-align: center;
+    }
+}
+"""
+site_css_bytes = SITE_CSS.encode()
+site_css_gzip = gzip.compress(site_css_bytes, 9, mtime=0)
+site_css_digest = hashlib.sha1(site_css_bytes).hexdigest()[:12]
+# The file name changes with the content, so the asset can be cached for a year
+site_css_url = f"/static/usbode-{site_css_digest}.css"
+
+# HTML shell shared by every page; the stylesheet is served separately so browsers cache it
+HTML_LAYOUT = """<!DOCTYPE html>
+<html>
+<head>
+    <title>USBODE - USB Optical Drive Emulator</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <link rel="stylesheet" type="text/css" href="{css}">
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>USBODE</h1>
+            <h2>USB Optical Drive Emulator</h2>
+        </div>
+        <div class="content">
+            {content}
+        </div>
+        <div class="footer">
+            <p>Version {version}</p>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+# The shell never changes at runtime, so it is split around the content slot once
+page_head, page_tail = HTML_LAYOUT.format(content='\0', version=versionNum, css=site_css_url).split('\0')
+
+def render_page(content):
+    return page_head + content + page_tail
+
+class FragmentCache:
+    """
+    Rendered HTML fragments by name. Each is kept together with the state
+    stamp it was built from and rebuilt only when the stamp changes.
+    """
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.fragments = OrderedDict()
+        self.lock = Lock()
+
+    def lookup(self, name, stamp):
+        with self.lock:
+            cached = self.fragments.get(name)
+            if cached is not None and cached[0] == stamp:
+                self.fragments.move_to_end(name)
+                return cached[1]
+        return None
+
+    def store(self, name, stamp, fragment):
+        with self.lock:
+            self.fragments[name] = (stamp, fragment)
+            self.fragments.move_to_end(name)
+            while len(self.fragments) > self.max_entries:
+                self.fragments.popitem(last=False)
+
+fragment_cache = FragmentCache()
+
+@app.before_request
+def start_request_timer():
+    request.environ['usbode.started'] = time.perf_counter()
+
+@app.teardown_request
+def record_request_time(error=None):
+    started = request.environ.get('usbode.started')
+    if started is not None:
+        http_request_seconds.observe(time.perf_counter() - started, request.url_rule.rule if request.url_rule else 'unmatched')
+
+@app.route('/metrics')
+def metricsText():
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/static/usbode-<digest>.css')
+def siteCSS(digest):
+    gzipped = 'gzip' in request.headers.get('Accept-Encoding', '')
+    response = app.response_class(site_css_gzip if gzipped else site_css_bytes, mimetype='text/css')
+    if gzipped:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if digest == site_css_digest:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        # An old page asking for an old stylesheet gets the current one, but only briefly
+        response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(site_css_digest + ('-gz' if gzipped else ''))
+    return response.make_conditional(request)
+
+def changer_html():
+    """Image in each disc of the changer with an eject link, or nothing for a single drive"""
+    if changer_luns == 1:
+        return ""
+    rows = []
+    for lun, disc in enumerate(gadget_state.discs):
+        eject = f' <a href="/eject/{lun}">Eject</a>' if disc else ''
+        rows.append(f"<li>Disc {lun}: <strong>{html.escape(disc) if disc else 'empty'}</strong>{eject}</li>")
+    return f"<p>Disc changer:</p><ul>{''.join(rows)}</ul>"
+
+@app.route('/')
+def index():
+    mode = checkState()
+    mode_text = "(CD-Emulator)" if mode == 1 else "(ExFAT mode)" if mode == 2 else ""
+    
+    content = f"""
+    <h3>Welcome to USBODE</h3>
+    <div class="info-box">
+        <p>My IP address is: {myIPAddress}</p>
+        <p>Currently Serving: <strong>{getMountedCDName()}</strong></p>
+        <p>Current Mode is: <strong>{mode} {mode_text}</strong></p>
+        {changer_html()}
+    </div>
+    
+    <div>
+        <a class="button" href="/switch">Switch Modes</a>
+        <a class="button" href="/list">Load Another Image</a>
+        <a class="button" href="/search">Search Images</a>
+        <a class="button" href="/shutdown">Shutdown the Pi</a>
+    </div>
+    """
+    
+    return render_page(content)
+
+@app.route('/switch')  
+def switch_mode():
+    mode = checkState()
+    mode_text = "(CD-Emulator)" if mode == 1 else "(ExFAT mode)" if mode == 2 else ""
+    job = dispatch(SwitchMode(None))
+    
+    content = f"""
+    <h3>Switching Mode</h3>
+    <div class="info-box">
+        <p>Switching mode has been queued, the drive reconnects in a few seconds.</p>
+        <p>Mode was <strong>{mode} {mode_text}</strong></p>
+        <p>Progress: <a href="{job.url()}">{job.url()}</a></p>
+    </div>
+    
+    <div>
+        <a class="button" href="/switch">Switch Modes Again</a>
+        <a class="button" href="/">Return to Homepage</a>
+    </div>
+    """
+    
+    return render_page(content)
+
+def list_stamp():
+    """Everything the rendered file list depends on; the cached rows are reused while it stays the same"""
+    return (titles_etag(), metadata_store.version, thumbnail_store.version)
+
+list_page_size = 100
+list_page_size_max = 500
+# Rows are sent to the browser in batches of this many while the page is still being produced
+list_stream_batch = 20
+
+def letter_bucket(name):
+    first = name[:1].upper()
+    return first if 'A' <= first <= 'Z' else '#'
+
+def list_entries(folder, letter=None):
+    """('folder' or 'image', name) pairs of a folder, optionally only those under one letter"""
+    subfolders, files = list_folder(folder)
+    entries = [('folder', name) for name in subfolders] + [('image', name) for name in files]
+    if letter:
+        entries = [entry for entry in entries if letter_bucket(entry[1]) == letter]
+    return entries
+
+def list_row_html(folder, kind, name):
+    path = f"{folder}/{name}" if folder else name
+    if kind == 'folder':
+        return f'<a href="/list?dir={urllib.parse.quote_plus(path)}">[{html.escape(name)}/]</a>'
+    entry = image_catalog.get(path)
+    info = metadata_summary(metadata_store.peek(path), entry.size if entry else None)
+    title = image_title(path)
+    if title != name:
+        # Verified DAT title as the link, with the file name underneath
+        info = f"{name} - {info}" if info else name
+    info_html = f'<br><span class="file-info">{html.escape(info)}</span>' if info else ''
+    thumb_html = f'<img class="thumb" src="/thumb/{urllib.parse.quote(path)}" alt="">' if thumbnail_store.state(path) == 'ready' else ''
+    if changer_luns > 1:
+        # The title loads disc 0, these load the other discs of the changer
+        links = " ".join(f'<a href="/mount/{urllib.parse.quote_plus(path)}?lun={lun}">{lun}</a>' for lun in range(changer_luns))
+        info_html += f'<br><span class="file-info">Load into disc: {links}</span>'
+    return f'{thumb_html}<a href="/mount/{urllib.parse.quote_plus(path)}">{html.escape(title)}</a>{info_html}'
+
+def list_rows(folder, entries, first_row=0):
+    """Rendered rows for one page of entries, in alternating colours, yielded in small batches"""
+    paths = [f"{folder}/{name}" if folder else name for kind, name in entries if kind == 'image']
+    # Only show metadata and thumbnails that are already cached; the rest is read in the background for next time
+    metadata_store.prefetch(paths)
+    thumbnail_store.prefetch(paths)
+    batch = []
+    for i, (kind, name) in enumerate(entries, first_row):
+        row_class = "file-link-even" if i % 2 == 0 else "file-link-odd"
+        batch.append(f'<div class="file-link {row_class}">{list_row_html(folder, kind, name)}</div>')
+        if len(batch) == list_stream_batch:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+def list_url(folder, letter=None, offset=0, size=list_page_size):
+    args = {'dir': folder}
+    if letter:
+        args['letter'] = letter
+    if offset:
+        args['offset'] = offset
+    if size != list_page_size:
+        args['size'] = size
+    return '/list?' + urllib.parse.urlencode(args)
+
+@app.route('/list')
+def listFiles():
+    folder = request.args.get('dir', '').strip('/')
+    if not image_catalog.has_folder(folder):
+        folder = ''
+    letter = request.args.get('letter', '').upper()[:1]
+    if letter and not ('A' <= letter <= 'Z' or letter == '#'):
+        letter = ''
+    try:
+        size = max(1, min(int(request.args.get('size', list_page_size)), list_page_size_max))
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        size, offset = list_page_size, 0
+    all_entries = list_entries(folder)
+    entries = [entry for entry in all_entries if letter_bucket(entry[1]) == letter] if letter else all_entries
+    total = len(entries)
+    if offset >= total:
+        offset = max(0, (total - 1) // size * size)
+    page = entries[offset:offset + size]
+    is_exfat = (checkState() == 2)
+    
+    content = f"""
+    <h3>File Selection</h3>
+    <div class="info-box">
+        <p>Current File Loaded: <strong>{getMountedCDName()}</strong></p>
+        {changer_html()}
+        <p>To load a different ISO, select it. No disconnection between the OS and the USBODE will occur.</p>
+    </div>
+    """
+    
+    content += """
+    <form action="/search" method="get">
+        <input type="text" name="q">
+        <input type="submit" value="Search">
+    </form>
+    """
+    content += f"<h4>Available Files in /{html.escape(folder)}:</h4>"
+    if len(all_entries) > size:
+        # Letter buckets, only for letters that have entries
+        letters = sorted(set(letter_bucket(name) for kind, name in all_entries))
+        links = [f'<a href="{html.escape(list_url(folder, size=size))}">All</a>' if letter else '<strong>All</strong>']
+        for bucket in letters:
+            links.append(f'<strong>{bucket}</strong>' if bucket == letter else f'<a href="{html.escape(list_url(folder, bucket, size=size))}">{bucket}</a>')
+        content += f'<p>{" ".join(links)}</p>'
+    if folder:
+        content += f'<div class="file-link file-link-odd"><a href="/list?dir={urllib.parse.quote_plus(parent_folder(folder))}">[Up one folder]</a></div>'
+    
+    navigation = ""
+    if total > size:
+        pages = (total + size - 1) // size
+        navigation = f"<p>Page {offset // size + 1} of {pages} ({total} entries) "
+        if offset > 0:
+            navigation += f'<a class="button" href="{html.escape(list_url(folder, letter, max(0, offset - size), size))}">Previous</a>'
+        if offset + size < total:
+            navigation += f'<a class="button" href="{html.escape(list_url(folder, letter, offset + size, size))}">Next</a>'
+        navigation += "</p>"
+    footer = navigation + """
+    <div>
+        <a class="button" href="/">Return to Homepage</a>
+    </div>
+    """
+    
+    cache_name = f"list:{folder}:{letter}:{offset}:{size}"
+    stamp = list_stamp()
+    
+    def generate():
+        # Stream the page so the first rows arrive while the rest are still being rendered
+        yield page_head + content
+        cached = fragment_cache.lookup(cache_name, stamp)
+        if cached is not None:
+            yield cached
+        else:
+            parts = []
+            for rows in list_rows(folder, page, offset):
+                parts.append(rows)
+                yield rows
+            fragment_cache.store(cache_name, stamp, ''.join(parts))
+        yield footer + page_tail
+    
+    return app.response_class(generate(), mimetype='text/html')
+
+@app.route('/search')
+def searchFiles():
+    query = request.args.get('q', '')
+    results, total = search_index.search(query)
+    
+    content = f"""
+    <h3>Search</h3>
+    <form action="/search" method="get">
+        <input type="text" name="q" value="{html.escape(query, quote=True)}">
+        <input type="submit" value="Search">
+    </form>
+    """
+    
+    if query:
+        shown = f", showing the first {len(results)}" if total > len(results) else ""
+        content += f"<h4>{total} matches for &quot;{html.escape(query)}&quot;{shown}:</h4>"
+        # The same escaped rows as /list, with DAT titles and the path of each match underneath
+        content += ''.join(list_rows('', [('image', file) for file in results]))
+    
+    content += """
+    <div>
+        <a class="button" href="/list">Browse All Files</a>
+        <a class="button" href="/">Return to Homepage</a>
+    </div>
+    """
+    
+    return render_page(content)
+
+@app.route('/search.json')
+def searchFilesJSON():
+    query = request.args.get('q', '')
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), 1000))
+    except ValueError:
+        limit = 50
+    start = time.perf_counter()
+    results, total = search_index.search(query, limit)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    images = []
+    for name in results:
+        entry = image_catalog.get(name)
+        images.append({'name': name, 'size': entry.size if entry else None, 'type': entry.type if entry else None})
+    return jsonify(query=query, count=len(images), total=total, elapsed_ms=round(elapsed_ms, 3), results=images)
+
+@app.route('/cdemu')
+def mountCDEMU():
+    job = dispatch(MountDevice(cdemu_cdrom))
+    
+    content = f"""
+    <h3>Mounting File</h3>
+    <div class="info-box">
+        <p>Attempting to mount: <strong>CDEMU CDROM</strong></p>
+        <p>Progress: <a href="{job.url()}">{job.url()}</a></p>
+    </div>
+    
+    <div>
+        <a class="button" href="/">Return to Homepage</a>
+        <a class="button" href="/list">Select Another File</a>
+    </div>
+    """
+    
+    return render_page(content)
+
+@app.route('/mount/<path:file>')
+def mountFile(file):
+    decoded_file = urllib.parse.unquote_plus(file)
+    try:
+        job = dispatch(MountImage(decoded_file, request.args.get('lun', 0)))
+    except ValueError as e:
+        logger.error(f"Refusing to mount {decoded_file}: {e}")
+        return render_page(f'<div class="warning"><p>Invalid file: {html.escape(decoded_file)}</p></div>'), 400
+    disc = f" into disc {job.lun}" if changer_luns > 1 else ""
+    
+    content = f"""
+    <h3>Mounting File</h3>
+    <div class="info-box">
+        <p>Attempting to mount: <strong>{html.escape(decoded_file)}</strong>{disc}</p>
+        <p>Progress: <a href="{job.url()}">{job.url()}</a></p>
+    </div>
+    
+    <div>
+        <a class="button" href="/">Return to Homepage</a>
+        <a class="button" href="/list">Select Another File</a>
+    </div>
+    """
+    
+    return render_page(content)
+
+@app.route('/eject/<int:lun>')
+def ejectDisc(lun):
+    try:
+        job = dispatch(EjectDisc(lun))
+    except ValueError as e:
+        logger.error(f"Refusing to eject disc {lun}: {e}")
+        return render_page(f'<div class="warning"><p>{html.escape(str(e))}</p></div>'), 400
+    
+    content = f"""
+    <h3>Ejecting Disc</h3>
+    <div class="info-box">
+        <p>Ejecting disc <strong>{lun}</strong>, the other discs stay loaded.</p>
+        <p>Progress: <a href="{job.url()}">{job.url()}</a></p>
+    </div>
+    
+    <div>
+        <a class="button" href="/">Return to Homepage</a>
+        <a class="button" href="/list">Select Another File</a>
+    </div>
+    """
+    
+    return render_page(content)
+
+@app.route('/upload/<path:file>', methods=['GET', 'PUT', 'POST', 'DELETE'])
+def uploadFile(file):
+    """
+    Resumable upload: GET returns the offset to resume from, PUT ?offset=N
+    appends the request body, POST with size and sha1/md5/crc32 verifies and
+    publishes the file, DELETE abandons the upload.
+    """
+    try:
+        name = upload_name(file)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if request.method == 'GET':
+        return jsonify(name=name, offset=upload_offset(name))
+    lock = upload_lock(name)
+    if not lock.acquire(blocking=False):
+        return jsonify(error=f"{name} is already being written"), 409
+    try:
+        with store_writer():
+            if request.method == 'DELETE':
+                if os.path.exists(upload_part_file(name)):
+                    os.remove(upload_part_file(name))
+                return jsonify(name=name, offset=0)
+            if os.path.exists(store_path(name)):
+                return jsonify(error=f"{name} already exists"), 409
+            current = upload_offset(name)
+            if request.method == 'PUT':
+                try:
+                    offset = int(request.args.get('offset', current))
+                except ValueError:
+                    return jsonify(error="offset must be an integer"), 400
+                if offset < 0 or offset > current:
+                    return jsonify(error=f"offset {offset} is past the received data", offset=current), 409
+                return jsonify(name=name, offset=write_upload_chunk(name, offset, request.stream))
+            checksums = {key: request.values.get(key) for key in ('sha1', 'md5', 'crc32')}
+            if not any(checksums.values()):
+                return jsonify(error="a sha1, md5 or crc32 checksum is required"), 400
+            if not os.path.exists(upload_part_file(name)):
+                return jsonify(error=f"nothing has been uploaded to {name}"), 404
+            size = request.values.get('size')
+            errors = finish_upload(name, int(size) if size and size.isdigit() else None, **checksums)
+            if errors:
+                return jsonify(error="; ".join(errors), offset=current), 422
+            return jsonify(name=name, size=current)
+    except StoreExported as e:
+        return jsonify(error=str(e)), 409
+    except OSError as e:
+        logger.error(f"Upload of {name} failed: {e}")
+        return jsonify(error=str(e), offset=upload_offset(name)), 500
+    finally:
+        lock.release()
+
+@app.route('/extract', methods=['GET', 'POST'])
+def extractArchive():
+    """POST a ZIP or 7z archive as the request body to unpack it into ?dir=; GET lists recent extractions"""
+    if request.method == 'GET':
+        return jsonify(jobs=[job.as_dict() for job in list(extract_jobs.values())])
+    folder = request.args.get('dir', '').strip('/')
+    try:
+        if folder:
+            store_path(folder)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    try:
+        with store_writer():
+            job = extract_archive(request.stream, folder)
+    except StoreExported as e:
+        return jsonify(error=str(e)), 409
+    return jsonify(job.as_dict()), 200 if job.state == 'done' else 422
+
+@app.route('/thumb/<path:file>')
+def thumbnail(file):
+    try:
+        store_path(file)
+    except ValueError:
+        return "Invalid file", 400
+    path = thumbnail_store.web_jpeg(file)
+    if path is None:
+        return "No cover art", 404
+    return send_file(path, mimetype='image/jpeg', max_age=86400)
+
+@app.route('/jobs')
+def listJobs():
+    return jsonify(jobs=[job.as_dict() for job in gadget_jobs.recent()])
+
+@app.route('/jobs/<id>')
+def jobStatus(id):
+    job = gadget_jobs.get(id)
+    if job is None:
+        return jsonify(error=f"No job {id}"), 404
+    return jsonify(job.as_dict())
+
+@app.route('/shutdown')
+def shutdown():
+    dispatch(Shutdown())
+    
+    content = """
+    <h3>System Shutdown</h3>
+    <div class="warning">
+        <p>Shutting down the Pi now...</p>
+    </div>
+    """
+    
+    return render_page(content)
+
+@app.route('/exit')
+def exit():
+    start_exit()
+    Thread.is_alive == 0
+    
+    content = """
+    <h3>Application Exit</h3>
+    <div class="warning">
+        <p>Exiting the application now...</p>
+    </div>
+    """
+    
+    return render_page(content)
+### END OF WEB INTERFACE ###
+
+### Beginning of JSON API ###
+
+gadget_modes = {0: 'disabled', 1: 'cdrom', 2: 'exfat'}
+# Version counters restart with the process, so tags also carry the start time
+api_epoch = f"{int(time.time()):x}"
+
+def api_etag(*parts):
+    return "-".join(str(part) for part in (api_epoch,) + parts)
+
+def conditional_json(etag, build):
+    """304 when the client already has this version, otherwise the JSON from build() tagged with a strong ETag"""
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def titles_etag():
+    # Titles change when the catalog, the hashes or the DAT set change
+    return f"{image_catalog.version}-{hash_engine.version}-{zlib.crc32((dat_index.stamp or '').encode()):x}"
+
+def store_name(path):
+    """Catalog name of an image path, or the path itself for devices and files outside the store"""
+    return os.path.relpath(path, store_mnt) if path and path.startswith(store_mnt + '/') else path
+
+def api_status():
+    mode = checkState()
+    discs = [(store_name(disc) or None) if mode == 1 else None for disc in gadget_state.discs]
+    name = discs[0]
+    return {'mode': gadget_modes.get(mode, 'disabled'), 'mounted': name,
+            'title': image_title(name) if name and image_catalog.get(name) else None,
+            'discs': [{'lun': lun, 'mounted': disc, 'title': image_title(disc) if disc and image_catalog.get(disc) else None}
+                      for lun, disc in enumerate(discs)],
+            'images': len(image_catalog.names()), 'version': versionNum}
+
+def api_image(name, detailed=False):
+    entry = image_catalog.get(name)
+    image = {'name': name, 'size': entry.size, 'mtime': entry.mtime, 'type': entry.type, 'title': image_title(name)}
+    if detailed:
+        meta = metadata_store.peek(name)
+        hashes = hash_engine.get(name)
+        match = dat_match(name)
+        image['metadata'] = meta._asdict() if meta else None
+        image['hashes'] = hashes._asdict() if hashes else None
+        image['dat'] = match._asdict() if match else None
+    return image
+
+@app.route('/api/v1/status')
+def apiStatus():
+    return conditional_json(api_etag('s', gadget_state_version, titles_etag()), api_status)
+
+@app.route('/api/v1/images')
+def apiImages():
+    folder = request.args.get('dir')
+    def build():
+        if folder is None:
+            names = image_catalog.names()
+            return {'images': [api_image(name) for name in names]}
+        subfolders, files = list_folder(folder.strip('/'))
+        prefix = folder.strip('/') + '/' if folder.strip('/') else ''
+        return {'folder': folder.strip('/'), 'folders': subfolders, 'images': [api_image(prefix + file) for file in files]}
+    return conditional_json(api_etag('i', titles_etag(), f"{zlib.crc32((folder or '').encode()):x}" if folder is not None else 'all'), build)
+
+@app.route('/api/v1/images/<path:name>')
+def apiImage(name):
+    if image_catalog.get(name) is None:
+        return jsonify(error=f"{name} is not in the image store"), 404
+    # Metadata is read lazily, so a detail response is only cacheable once it is in
+    metadata_state = 'm' if metadata_store.is_cached(name) else 'p'
+    if metadata_state == 'p':
+        metadata_store.prefetch([name])
+    return conditional_json(api_etag('d', titles_etag(), metadata_state), lambda: api_image(name, detailed=True))
+
+def job_accepted(job):
+    """202 pointing at the job's status URL, which the client polls until it is done or failed"""
+    response = jsonify(job.as_dict())
+    response.status_code = 202
+    response.headers['Location'] = job.url()
+    return response
+
+@app.route('/api/v1/mount', methods=['POST'])
+def apiMount():
+    body = request.get_json(silent=True) or request.values
+    name = body.get('name', '')
+    if image_catalog.get(name) is None:
+        return jsonify(error=f"{name} is not in the image store"), 404
+    if checkState() == 2:
+        return jsonify(error="Switch to CD-ROM mode before mounting an image"), 409
+    try:
+        job = dispatch(MountImage(name, body.get('lun', 0)))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return job_accepted(job)
+
+@app.route('/api/v1/eject', methods=['POST'])
+def apiEject():
+    body = request.get_json(silent=True) or request.values
+    try:
+        job = dispatch(EjectDisc(body.get('lun', 0)))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return job_accepted(job)
+
+@app.route('/api/v1/mode', methods=['POST'])
+def apiMode():
+    body = request.get_json(silent=True) or request.values
+    mode = body.get('mode', '')
+    if mode not in ('cdrom', 'exfat'):
+        return jsonify(error="mode must be cdrom or exfat"), 400
+    if gadget_modes.get(checkState()) != mode:
+        if mode == 'cdrom' and not list_images():
+            return jsonify(error="There are no images to serve in CD-ROM mode"), 409
+    job = dispatch(SwitchMode(mode))
+    return job_accepted(job)
+
+### END OF JSON API ###
+
+### Beginning of Live Events ###
+
+# Streams and long-polls each hold an HTTP worker, so only some of the pool may be used for them
+event_subscriber_limit = 4
+event_keepalive_seconds = 15
+event_poll_seconds = 25
+
+def read_sysfs(path, default=''):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+def device_status():
+    """Mode, loaded image, IP address and USB host state, read without logging errors mid-switch"""
+    state = gadget_state
+    mode, udc = gadget_modes[state.mode], state.udc
+    discs = [(store_name(disc) or None) if mode == 'cdrom' else None for disc in state.discs]
+    # 'configured' once the host has enumerated the drive, 'not attached' when unplugged
+    host = read_sysfs(f"/sys/class/udc/{udc}/state", 'unknown') if udc else 'not attached'
+    return {'mode': mode, 'mounted': discs[0], 'discs': discs, 'ip': myIPAddress, 'host': host}
+
+class EventHub:
+    """
+    Numbered log of device status changes. Whenever something signals an
+    update the status is re-read and one event is published per field that
+    changed; SSE streams and long-polls wait on the log.
+    """
+    event_fields = (('mounted', 'mount'), ('mode', 'mode'), ('ip', 'ip'), ('host', 'host')) + \
+        ((('discs', 'discs'),) if changer_luns > 1 else ())
+
+    def __init__(self, size=64):
+        self.events = deque(maxlen=size)
+        self.seq = 0
+        self.status = {}
+        self.condition = threading.Condition()
+        self.wake = Event()
+        self.subscribers = 0
+
+    def publish(self, kind, status):
+        with self.condition:
+            self.seq += 1
+            self.events.append((self.seq, kind, status))
+            self.condition.notify_all()
+
+    def since(self, seq):
+        """Events after seq, or None if some were already dropped from the log or seq is from before a restart"""
+        with self.condition:
+            if (self.events and seq < self.events[0][0] - 1) or seq > self.seq:
+                return None
+            return [event for event in self.events if event[0] > seq]
+
+    def wait(self, seq, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            # Only wait while nothing is new; a seq ahead of ours is from before a restart and resets the client
+            while self.seq == seq and not exitRequested:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(min(remaining, 1))
+        return self.since(seq)
+
+    def subscribe(self):
+        with self.condition:
+            if self.subscribers >= event_subscriber_limit:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def watch(self):
+        global updateEvent
+        self.status = device_status()
+        while not exitRequested:
+            # The host connection has no internal notification, so it is also polled every couple of seconds
+            self.wake.wait(2)
+            self.wake.clear()
+            status = device_status()
+            changed = [kind for field, kind in self.event_fields if status[field] != self.status.get(field)]
+            self.status = status
+            for kind in changed:
+                self.publish(kind, status)
+            if 'host' in changed:
+                with update_lock:
+                    updateEvent = 1
+
+event_hub = EventHub()
+
+def signal_update():
+    """Something visible changed: redraw the display and publish the new status to event subscribers"""
+    global updateEvent
+    with update_lock:
+        updateEvent = 1
+    event_hub.wake.set()
+
+def start_events():
+    daemonEvents = Thread(target=event_hub.watch, daemon=True, name='Events')
+    daemonEvents.start()
+    logger.info("Event thread started")
+
+def format_sse(seq, kind, data):
+    return f"id: {seq}\nevent: {kind}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/events')
+def eventStream():
+    """Server-Sent Events: the current status first, then one event per change"""
+    if not event_hub.subscribe():
+        return jsonify(error="Too many event subscribers, use /events/poll"), 503, {'Retry-After': '30'}
+    try:
+        last_seq = int(request.headers.get('Last-Event-ID', request.args.get('since', -1)))
+    except ValueError:
+        last_seq = -1
+    def stream():
+        seq = last_seq
+        missed = event_hub.since(seq) if seq >= 0 else None
+        if missed is None:
+            # New subscriber, or one that fell too far behind: start from a full status
+            seq = event_hub.seq
+            yield format_sse(seq, 'status', event_hub.status)
+            missed = []
+        while not exitRequested:
+            for event_seq, kind, status in missed:
+                seq = event_seq
+                yield format_sse(event_seq, kind, status)
+            missed = event_hub.wait(seq, event_keepalive_seconds)
+            if missed is None:
+                seq = event_hub.seq
+                yield format_sse(seq, 'status', event_hub.status)
+                missed = []
+            elif not missed:
+                # Comment line so proxies keep the connection and dead clients are noticed
+                yield ": keepalive\n\n"
+    response = app.response_class(stream(), mimetype='text/event-stream',
+                                  headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Runs when the server closes the response, even if the stream was never started
+    response.call_on_close(event_hub.unsubscribe)
+    return response
+
+@app.route('/events/poll')
+def eventPoll():
+    """Long-poll fallback for browsers without EventSource: waits until there are events after ?since="""
+    try:
+        since = int(request.args.get('since', -1))
+        timeout = max(0, min(float(request.args.get('timeout', event_poll_seconds)), event_poll_seconds))
+    except ValueError:
+        return jsonify(error="since and timeout must be numbers"), 400
+    if since < 0:
+        return jsonify(seq=event_hub.seq, events=[], status=event_hub.status)
+    if event_hub.subscribe():
+        try:
+            events = event_hub.wait(since, timeout)
+        finally:
+            event_hub.unsubscribe()
+    else:
+        # Out of subscriber slots: answer straight away rather than holding a worker
+        events = event_hub.since(since)
+    if events is None:
+        return jsonify(seq=event_hub.seq, events=[], status=event_hub.status, reset=True)
+    return jsonify(seq=events[-1][0] if events else max(since, 0), status=event_hub.status,
+                   events=[{'seq': seq, 'event': kind, 'status': status} for seq, kind, status in events])
+
+### END OF LIVE EVENTS ###
+
+def getMountedCDName():
+    return gadget_state.image
+
+# Print without endline
+def prints(string):
+    print(string, end=' ')
+
+### Beginning of Image Catalog ###
+
+image_extensions = ('.iso', '.cue', '.cso', '.zso', '.chd', '.iso.gz')
+
+CatalogEntry = namedtuple('CatalogEntry', ['name', 'size', 'mtime', 'type', 'sort_key'])
+
+# inotify event flags from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+inotify_event_header = struct.Struct('iIII')
+
+def natural_sort_key(name):
+    """Case-insensitive sort key that orders 'Disc 2' before 'Disc 10'"""
+    return re.sub(r'\d+', lambda m: m.group(0).rjust(12, '0'), name.lower())
+
+def is_image_file(name):
+    return name.lower().endswith(image_extensions) and not name.startswith("._")
+
+def is_hidden_folder(name):
+    # Skip dot folders and the housekeeping folders Windows/macOS drop on the exFAT store
+    return name.startswith(('.', '$')) or name == "System Volume Information"
+
+def parent_folder(path):
+    return path.rpartition('/')[0]
+
+class ImageCatalog:
+    """
+    In-memory index of the images in the store, snapshotted to SQLite so the
+    list survives reboots without rescanning the SD card. Image names are paths
+    relative to the store root, and a folder tree is precomputed so browsing a
+    folder only costs the entries in that folder. The index is kept current by
+    inotify events (or a cheap folder mtime poll when inotify is unavailable)
+    and by explicit update calls from code that writes files.
+    """
+
+    def __init__(self, root, db_file):
+        self.root = root
+        self.db_file = db_file
+        self.entries = {}
+        self.version = 0
+        self.lock = Lock()
+        self._sorted = []
+        self._folders = {'': ([], [])}
+        self._dir_mtimes = {}
+        self._db = None
+        self.listeners = []
+
+    def _open_db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_file, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS images (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, type TEXT, sort_key TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, mtime REAL)")
+            self._db.commit()
+        return self._db
+
+    def load(self):
+        """Load the last snapshot so list consumers are served before the first scan finishes"""
+        try:
+            with self.lock:
+                db = self._open_db()
+                rows = db.execute("SELECT name, size, mtime, type, sort_key FROM images").fetchall()
+                self.entries = {row[0]: CatalogEntry(*row) for row in rows}
+                self._dir_mtimes = dict(db.execute("SELECT path, mtime FROM folders").fetchall())
+                self._changed(list(self.entries), [])
+            logger.info(f"Loaded image catalog snapshot with {len(self.entries)} entries from {self.db_file}")
+        except Exception as e:
+            logger.error(f"Failed to load image catalog from {self.db_file}: {e}")
+
+    def add_listener(self, listener):
+        """Register listener(changed, removed), called with the lock held after every update"""
+        self.listeners.append(listener)
+
+    def _changed(self, changed, removed):
+        # Caller holds self.lock. Rebuild the sorted list and the folder tree in one pass.
+        ordered = sorted(self.entries.values(), key=lambda entry: entry.sort_key)
+        folders = {'': ([], [])}
+        links = []
+        for entry in ordered:
+            folder, _, base = entry.name.rpartition('/')
+            child = folder
+            while child not in folders:
+                # Register every missing ancestor with its parent; the root always exists
+                folders[child] = ([], [])
+                parent, _, child_base = child.rpartition('/')
+                links.append((parent, child_base))
+                child = parent
+            folders[folder][1].append(base)
+        for parent, child_base in links:
+            folders[parent][0].append(child_base)
+        for subfolders, files in folders.values():
+            subfolders.sort(key=natural_sort_key)
+        self._folders = folders
+        self._sorted = [entry.name for entry in ordered]
+        self.version += 1
+        for listener in self.listeners:
+            try:
+                listener(changed, removed)
+            except Exception as e:
+                logger.error(f"Image catalog listener {listener} failed: {e}")
+
+    def _make_entry(self, name, size, mtime):
+        return CatalogEntry(name, size, mtime, os.path.splitext(name)[1][1:].lower(), natural_sort_key(name))
+
+    def _stat_entry(self, name):
+        try:
+            st = os.stat(os.path.join(self.root, name))
+        except OSError:
+            return None
+        return self._make_entry(name, st.st_size, st.st_mtime)
+
+    def _persist(self, upserts, removals, folder_upserts=(), folder_removals=()):
+        # Caller holds self.lock
+        try:
+            db = self._open_db()
+            with db:
+                db.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)", upserts)
+                db.executemany("DELETE FROM images WHERE name = ?", [(name,) for name in removals])
+                db.executemany("INSERT OR REPLACE INTO folders VALUES (?, ?)", folder_upserts)
+                db.executemany("DELETE FROM folders WHERE path = ?", [(path,) for path in folder_removals])
+        except Exception as e:
+            logger.error(f"Failed to persist image catalog: {e}")
+
+    def refresh(self, force=False, folder=''):
+        """
+        Diff a folder subtree against the index. Folders whose mtime has not
+        changed reuse their known contents, so only changed folders are listed.
+        """
+        with self.lock:
+            known_children = {}
+            for path in self._dir_mtimes:
+                if path:
+                    known_children.setdefault(parent_folder(path), []).append(path)
+            known_files = {}
+            for name, entry in self.entries.items():
+                known_files.setdefault(parent_folder(name), []).append(entry)
+            known_mtimes = dict(self._dir_mtimes)
+
+        found = {}
+        dir_mtimes = {}
+        pending = [folder]
+        while pending:
+            rel = pending.pop()
+            try:
+                mtime = os.stat(os.path.join(self.root, rel)).st_mtime
+            except OSError as e:
+                if rel == folder:
+                    logger.error(f"Cannot stat image store folder {self.root}/{rel}: {e}")
+                    return False
+                continue
+            dir_mtimes[rel] = mtime
+            if not force and known_mtimes.get(rel) == mtime:
+                for entry in known_files.get(rel, []):
+                    found[entry.name] = (entry.size, entry.mtime)
+                pending.extend(known_children.get(rel, []))
+                continue
+            try:
+                with os.scandir(os.path.join(self.root, rel)) as it:
+                    for dirent in it:
+                        name = f"{rel}/{dirent.name}" if rel else dirent.name
+                        if dirent.is_dir(follow_symlinks=False):
+                            if not is_hidden_folder(dirent.name):
+                                pending.append(name)
+                        elif is_image_file(dirent.name) and dirent.is_file():
+                            st = dirent.stat()
+                            found[name] = (st.st_size, st.st_mtime)
+            except OSError as e:
+                logger.error(f"Failed to scan {self.root}/{rel}: {e}")
+
+        def in_subtree(path):
+            return not folder or path == folder or path.startswith(folder + '/')
+
+        with self.lock:
+            upserts = []
+            for name, (size, mtime) in found.items():
+                entry = self.entries.get(name)
+                if entry is None or entry.size != size or entry.mtime != mtime:
+                    entry = self._make_entry(name, size, mtime)
+                    self.entries[name] = entry
+                    upserts.append(entry)
+            removals = [name for name in self.entries if in_subtree(name) and name not in found]
+            for name in removals:
+                del self.entries[name]
+            folder_removals = [path for path in self._dir_mtimes if in_subtree(path) and path not in dir_mtimes]
+            for path in folder_removals:
+                del self._dir_mtimes[path]
+            folder_upserts = [(path, mtime) for path, mtime in dir_mtimes.items() if self._dir_mtimes.get(path) != mtime]
+            self._dir_mtimes.update(folder_upserts)
+            self._persist(upserts, removals, folder_upserts, folder_removals)
+            if upserts or removals:
+                self._changed([entry.name for entry in upserts], removals)
+                logger.info(f"Image catalog updated: {len(upserts)} added/changed, {len(removals)} removed, {len(self.entries)} total")
+        return bool(upserts or removals)
+
+    def update_file(self, name):
+        """Re-stat a single file, adding, updating or dropping its entry"""
+        entry = self._stat_entry(name) if is_image_file(os.path.basename(name)) else None
+        with self.lock:
+            if entry is not None:
+                if self.entries.get(name) == entry:
+                    return
+                self.entries[name] = entry
+                self._persist([entry], [])
+                self._changed([name], [])
+            elif name in self.entries:
+                del self.entries[name]
+                self._persist([], [name])
+                self._changed([], [name])
+
+    def remove_file(self, name):
+        with self.lock:
+            if name in self.entries:
+                del self.entries[name]
+                self._persist([], [name])
+                self._changed([], [name])
+
+    def remove_folder(self, folder):
+        """Drop a folder that was deleted or moved out, with everything indexed under it"""
+        def in_subtree(path):
+            return path == folder or path.startswith(folder + '/')
+        with self.lock:
+            removals = [name for name in self.entries if in_subtree(name)]
+            for name in removals:
+                del self.entries[name]
+            folder_removals = [path for path in self._dir_mtimes if in_subtree(path)]
+            for path in folder_removals:
+                del self._dir_mtimes[path]
+            self._persist([], removals, [], folder_removals)
+            if removals or folder_removals:
+                self._changed([], removals)
+                logger.info(f"Image catalog updated: {folder} removed with {len(removals)} images, {len(self.entries)} total")
+
+    def names(self):
+        return list(self._sorted)
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def list_folder(self, folder=''):
+        """Return (subfolders, images) directly inside folder, as names relative to it"""
+        subfolders, files = self._folders.get(folder.strip('/'), ([], []))
+        return list(subfolders), list(files)
+
+    def has_folder(self, folder):
+        return folder.strip('/') in self._folders
+
+    def watch(self):
+        """Keep the catalog current; runs forever in its own thread"""
+        self.refresh(force=True)
+        try:
+            self._watch_inotify()
+        except Exception as e:
+            logger.warning(f"inotify unavailable for {self.root} ({e}), polling folder mtimes instead")
+        while not exitRequested:
+            time.sleep(10)
+            self.refresh()
+
+    def _watch_inotify(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+        watches = {}
+
+        def add_watch(rel):
+            wd = libc.inotify_add_watch(fd, os.path.join(self.root, rel).encode(), mask)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed on {self.root}/{rel}")
+            watches[wd] = rel
+
+        try:
+            add_watch('')
+            for rel in list(self._dir_mtimes):
+                if rel:
+                    add_watch(rel)
+            logger.info(f"Watching {len(watches)} folders under {self.root} for changes with inotify")
+            while not exitRequested:
+                buffer = os.read(fd, 64 * 1024)
+                offset = 0
+                while offset < len(buffer):
+                    wd, event_mask, cookie, name_len = inotify_event_header.unpack_from(buffer, offset)
+                    offset += inotify_event_header.size
+                    base = buffer[offset:offset + name_len].rstrip(b'\0').decode('utf-8', 'surrogateescape')
+                    offset += name_len
+                    if event_mask & IN_Q_OVERFLOW:
+                        # Lost events, fall back to a full diff
+                        self.refresh(force=True)
+                        continue
+                    folder = watches.get(wd)
+                    if folder is None:
+                        continue
+                    if event_mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                        del watches[wd]
+                        if folder == '':
+                            # The store itself was unmounted or moved
+                            self.refresh(force=True)
+                            return
+                        continue
+                    name = f"{folder}/{base}" if folder else base
+                    if event_mask & IN_ISDIR:
+                        if is_hidden_folder(base):
+                            continue
+                        if event_mask & (IN_DELETE | IN_MOVED_FROM):
+                            # The folder is gone from here, so there is nothing left to diff against
+                            self.remove_folder(name)
+                            for watch, rel in list(watches.items()):
+                                if rel == name or rel.startswith(name + '/'):
+                                    libc.inotify_rm_watch(fd, watch)
+                                    del watches[watch]
+                            continue
+                        self.refresh(force=True, folder=name)
+                        if event_mask & (IN_CREATE | IN_MOVED_TO):
+                            # Watch the new folder and anything that was created inside it before we looked
+                            watched = set(watches.values())
+                            for rel in list(self._dir_mtimes):
+                                if (rel == name or rel.startswith(name + '/')) and rel not in watched:
+                                    add_watch(rel)
+                    elif base:
+                        self.update_file(name)
+        finally:
+            os.close(fd)
+
+image_catalog = ImageCatalog(store_mnt, catalog_db_file)
+
+def start_catalog():
+    image_catalog.load()
+    daemonCatalog = Thread(target=image_catalog.watch, daemon=True, name='Catalog')
+    daemonCatalog.start()
+    logger.info("Image catalog thread started")
+
+def list_images():
+    return image_catalog.names()
+
+def list_folder(folder=''):
+    return image_catalog.list_folder(folder)
+
+def store_path(name):
+    """Absolute path in the store for a catalog name, refusing names that escape the store"""
+    path = os.path.normpath(os.path.join(store_mnt, name))
+    if not path.startswith(store_mnt + '/'):
+        raise ValueError(f"{name} is outside of {store_mnt}")
+    return path
+
+def current_image_folder():
+    """Folder of the loaded image, so the pickers open where the user left off"""
+    mounted = getMountedCDName()
+    if mounted.startswith(store_mnt + '/'):
+        folder = parent_folder(mounted[len(store_mnt) + 1:])
+        if image_catalog.has_folder(folder):
+            return folder
+    return ''
+
+def folder_menu_items(folder):
+    """Entries shown by the display pickers for one folder: parent link, subfolders, then images"""
+    subfolders, files = list_folder(folder)
+    items = [".."] if folder else []
+    items += [subfolder + "/" for subfolder in subfolders]
+    items += files
+    return items
+
+def folder_menu_select(folder, item):
+    """Resolve a picker entry to ('folder', path) for navigation or ('image', name) to load"""
+    if item == "..":
+        return 'folder', parent_folder(folder)
+    name = f"{folder}/{item}" if folder else item
+    if item.endswith("/"):
+        return 'folder', name[:-1]
+    return 'image', name
+
+### END OF IMAGE CATALOG ###
+
+### Beginning of Image Search ###
+
+class SearchIndex:
+    """
+    Trigram index over image paths for substring search, plus a sorted word
+    list for queries shorter than a trigram. Both are updated incrementally
+    from catalog change notifications.
+    """
+
+    def __init__(self):
+        self.trigrams = {}
+        self.words = []
+        self.indexed = {}
+        self.lock = Lock()
+
+    @staticmethod
+    def _trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @staticmethod
+    def _words(text):
+        return set(re.findall(r'[a-z0-9]+', text))
+
+    def _remove(self, name):
+        text = self.indexed.pop(name, None)
+        if text is None:
+            return
+        for trigram in self._trigrams(text):
+            names = self.trigrams.get(trigram)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self.trigrams[trigram]
+
+    def _add(self, name):
+        """Index name's trigrams and return its word postings for the caller to merge"""
+        text = name.lower()
+        self.indexed[name] = text
+        for trigram in self._trigrams(text):
+            self.trigrams.setdefault(trigram, set()).add(name)
+        return [(word, name) for word in self._words(text)]
+
+    def update(self, changed, removed):
+        with self.lock:
+            dropped = set(removed) | set(changed)
+            for name in dropped:
+                self._remove(name)
+            # One filter and one sort per batch; inserting postings one by one is quadratic on the first scan
+            words = [posting for posting in self.words if posting[1] not in dropped] if dropped else self.words
+            for name in changed:
+                words.extend(self._add(name))
+            words.sort()
+            self.words = words
+
+    def search(self, query, limit=50):
+        """Return up to limit image names containing query, in catalog order, and how many matched in all"""
+        query = query.strip().lower()
+        if not query:
+            return [], 0
+        with self.lock:
+            if len(query) >= 3:
+                candidate_sets = []
+                for trigram in self._trigrams(query):
+                    names = self.trigrams.get(trigram)
+                    if not names:
+                        return [], 0
+                    candidate_sets.append(names)
+                candidate_sets.sort(key=len)
+                candidates = set(candidate_sets[0]).intersection(*candidate_sets[1:])
+                matches = [name for name in candidates if query in self.indexed[name]]
+            else:
+                # Too short for trigrams: match the start of any word in the path
+                matches = set()
+                i = bisect.bisect_left(self.words, (query, ''))
+                while i < len(self.words) and self.words[i][0].startswith(query):
+                    matches.add(self.words[i][1])
+                    i += 1
+        return sorted(matches, key=natural_sort_key)[:limit], len(matches)
+
+search_index = SearchIndex()
+image_catalog.add_listener(search_index.update)
+
+### END OF IMAGE SEARCH ###
+
+### Beginning of Image Metadata ###
+
+IsoMetadata = namedtuple('IsoMetadata', ['label', 'created', 'bootable', 'blocks', 'filesystem'])
+
+iso_sector_size = 2048
+
+class IsoSectorReader:
+    """Reads cooked 2048-byte sectors from a plain ISO image with pread"""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.blocks = os.fstat(self.fd).st_size // iso_sector_size
+
+    def read(self, lba, count=1):
+        return os.pread(self.fd, count * iso_sector_size, lba * iso_sector_size)
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_sector_reader(path):
+    """Return a sector reader for an image, or None if its format can't be read directly"""
+    if path.lower().endswith('.iso'):
+        return IsoSectorReader(path)
+    if path.lower().endswith('.cue'):
+        return CueSectorReader(path)
+    return open_compressed_reader(path)
+
+def iso_datetime(raw):
+    # ISO9660 dec-datetime: 'YYYYMMDDHHMMSScc' plus a timezone byte, all zeros when unset
+    text = raw[:12].decode('ascii', 'replace')
+    if not text.isdigit() or text.startswith('0000'):
+        return ''
+    return f"{text[0:4]}-{text[4:6]}-{text[6:8]} {text[8:10]}:{text[10:12]}"
+
+def udf_dstring(raw):
+    # OSTA compressed unicode: first byte is the compression id, last byte the used length
+    length = raw[-1]
+    if length == 0:
+        return ''
+    data = raw[1:length]
+    if raw[0] == 16:
+        return data.decode('utf-16-be', 'replace').strip()
+    return data.decode('latin-1').strip()
+
+def read_udf_volume(reader):
+    """Return (label, created) from the UDF Primary Volume Descriptor, found via the anchor at sector 256"""
+    anchor = reader.read(256)
+    if len(anchor) < 24 or struct.unpack_from('<H', anchor, 0)[0] != 2:
+        return '', ''
+    length, location = struct.unpack_from('<II', anchor, 16)
+    for i in range(min(length // iso_sector_size, 16)):
+        descriptor = reader.read(location + i)
+        if len(descriptor) < 388:
+            break
+        tag = struct.unpack_from('<H', descriptor, 0)[0]
+        if tag == 1:
+            year, month, day, hour, minute = struct.unpack_from('<HBBBB', descriptor, 378)
+            created = f"{year:04d}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}" if year else ''
+            return udf_dstring(descriptor[24:56]), created
+        if tag == 8:  # Terminating descriptor
+            break
+    return '', ''
+
+def read_iso_metadata(path):
+    """
+    Read the volume label, creation date, El Torito flag, block count and
+    filesystem type from the volume descriptors at sector 16 onwards. Only a
+    handful of sectors are read and the image is never mounted.
+    """
+    reader = open_sector_reader(path)
+    if reader is None:
+        return None
+    with reader:
+        label, created, bootable, blocks = '', '', False, reader.blocks
+        filesystems = []
+        joliet_label = ''
+        for lba in range(16, 16 + 64):
+            descriptor = reader.read(lba)
+            if len(descriptor) < iso_sector_size:
+                break
+            identifier = descriptor[1:6]
+            if identifier == b'CD001':
+                descriptor_type = descriptor[0]
+                if descriptor_type == 0 and descriptor[7:30] == b'EL TORITO SPECIFICATION':
+                    bootable = True
+                elif descriptor_type == 1:
+                    filesystems.append('ISO9660')
+                    label = descriptor[40:72].decode('ascii', 'replace').strip()
+                    blocks = struct.unpack_from('<I', descriptor, 80)[0]
+                    created = iso_datetime(descriptor[813:830])
+                elif descriptor_type == 2 and descriptor[88:90] == b'%/' and descriptor[90:91] in (b'@', b'C', b'E'):
+                    filesystems.append('Joliet')
+                    joliet_label = descriptor[40:72].decode('utf-16-be', 'replace').strip()
+            elif identifier in (b'NSR02', b'NSR03'):
+                filesystems.append('UDF')
+            elif identifier not in (b'BEA01', b'TEA01', b'BOOT2', b'CDW02'):
+                break
+        if 'UDF' in filesystems and 'ISO9660' not in filesystems:
+            label, created = read_udf_volume(reader)
+        if not filesystems:
+            return None
+        return IsoMetadata(joliet_label or label, created, bootable, blocks, '/'.join(filesystems))
+
+def metadata_summary(meta, size=None):
+    """One-line description of an image for the web and display lists"""
+    if meta is None:
+        return ''
+    parts = [meta.label or "(no label)", meta.filesystem]
+    if size is not None:
+        parts.append(f"{size / (1024 * 1024):.0f} MB")
+    if meta.created:
+        parts.append(meta.created[:10])
+    if meta.bootable:
+        parts.append("bootable")
+    return " - ".join(parts)
+
+class MetadataStore:
+    """
+    Cache of IsoMetadata keyed by (name, size, mtime), kept in memory and in
+    the catalog database, so each image is only read once per version of the
+    file. Missing entries can be filled lazily or by a background prefetch.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.cache = {}
+        self.version = 0
+        self.lock = Lock()
+        self.pending = []
+        self.pending_event = Event()
+        self._db = None
+
+    def _open_db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.catalog.db_file, timeout=10, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, label TEXT, created TEXT, bootable INTEGER, blocks INTEGER, filesystem TEXT)")
+            self._db.commit()
+        return self._db
+
+    def load(self):
+        try:
+            with self.lock:
+                rows = self._open_db().execute("SELECT * FROM metadata").fetchall()
+                for name, size, mtime, label, created, bootable, blocks, filesystem in rows:
+                    meta = IsoMetadata(label, created, bool(bootable), blocks, filesystem) if filesystem else None
+                    self.cache[name] = (size, mtime, meta)
+        except Exception as e:
+            logger.error(f"Failed to load image metadata cache: {e}")
+
+    def peek(self, name):
+        """Cached metadata for a catalog entry, or None without touching the image"""
+        entry = self.catalog.get(name)
+        cached = self.cache.get(name)
+        if entry is None or cached is None or cached[:2] != (entry.size, entry.mtime):
+            return None
+        return cached[2]
+
+    def is_cached(self, name):
+        entry = self.catalog.get(name)
+        cached = self.cache.get(name)
+        return entry is not None and cached is not None and cached[:2] == (entry.size, entry.mtime)
+
+    def get(self, name):
+        """Metadata for a catalog entry, reading the image only on a cache miss"""
+        if self.is_cached(name):
+            return self.cache[name][2]
+        entry = self.catalog.get(name)
+        if entry is None:
+            return None
+        try:
+            meta = read_iso_metadata(os.path.join(self.catalog.root, name))
+        except Exception as e:
+            logger.warning(f"Could not read volume descriptors from {name}: {e}")
+            meta = None
+        with self.lock:
+            self.cache[name] = (entry.size, entry.mtime, meta)
+            self.version += 1
+            try:
+                db = self._open_db()
+                with db:
+                    db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (name, entry.size, entry.mtime,
+                                meta.label if meta else None, meta.created if meta else None,
+                                int(meta.bootable) if meta else 0, meta.blocks if meta else None,
+                                meta.filesystem if meta else None))
+            except Exception as e:
+                logger.error(f"Failed to store metadata for {name}: {e}")
+        return meta
+
+    def forget(self, changed, removed):
+        # Catalog listener: drop rows for deleted images, changed ones are caught by the key check
+        if not removed:
+            return
+        with self.lock:
+            for name in removed:
+                self.cache.pop(name, None)
+            try:
+                db = self._open_db()
+                with db:
+                    db.executemany("DELETE FROM metadata WHERE name = ?", [(name,) for name in removed])
+            except Exception as e:
+                logger.error(f"Failed to drop metadata rows: {e}")
+
+    def prefetch(self, names):
+        """Queue uncached images for the background reader"""
+        missing = [name for name in names if not self.is_cached(name)]
+        if missing:
+            with self.lock:
+                self.pending.extend(missing)
+            self.pending_event.set()
+
+    def worker(self):
+        while not exitRequested:
+            self.pending_event.wait()
+            with self.lock:
+                names, self.pending = self.pending, []
+                self.pending_event.clear()
+            for name in names:
+                if not self.is_cached(name):
+                    self.get(name)
+
+metadata_store = MetadataStore(image_catalog)
+image_catalog.add_listener(metadata_store.forget)
+
+def start_metadata():
+    metadata_store.load()
+    daemonMetadata = Thread(target=metadata_store.worker, daemon=True, name='Metadata')
+    daemonMetadata.start()
+    logger.info("Image metadata thread started")
+
+### END OF IMAGE METADATA ###
+
+### Beginning of Image Hashing ###
+
+hash_chunk_size = 4 * 1024 * 1024
+hash_checkpoint_interval = 64 * 1024 * 1024
+hash_idle_seconds = 5
+
+ImageHashes = namedtuple('ImageHashes', ['sha1', 'md5', 'crc32'])
+
+def load_libcrypto():
+    """
+    OpenSSL's SHA1/MD5 contexts are plain structs, so unlike hashlib objects
+    they can be saved to disk and restored to resume hashing mid-file.
+    """
+    try:
+        lib = ctypes.CDLL(ctypes.util.find_library('crypto'))
+        for prefix in ('SHA1', 'MD5'):
+            getattr(lib, f"{prefix}_Init").argtypes = [ctypes.c_void_p]
+            getattr(lib, f"{prefix}_Update").argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+            getattr(lib, f"{prefix}_Final").argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        lib.version = 0
+        for name in ('OpenSSL_version_num', 'SSLeay'):
+            if hasattr(lib, name):
+                getattr(lib, name).restype = ctypes.c_ulong
+                lib.version = getattr(lib, name)()
+                break
+        return lib
+    except Exception as e:
+        logger.warning(f"libcrypto not available ({e}), image hashing will restart interrupted files from the beginning")
+        return None
+
+libcrypto = None
+
+class HashState:
+    """
+    SHA-1, MD5 and CRC32 of a stream, updated in parallel and optionally
+    restorable from a checkpoint. The context structs are only meaningful to
+    the libcrypto build that wrote them, so checkpoints start with a tag of
+    its version and the struct sizes and are ignored after an upgrade.
+    """
+    ctx_size = 128
+
+    @classmethod
+    def tag(cls):
+        return f"openssl {libcrypto.version:x} ctx {cls.ctx_size} ptr {ctypes.sizeof(ctypes.c_void_p)}\n".encode()
+
+    @classmethod
+    def restorable(cls, state):
+        return libcrypto is not None and state is not None and state.startswith(cls.tag()) and \
+            len(state) == len(cls.tag()) + cls.ctx_size * 2 + 4
+
+    def __init__(self, state=None):
+        self.crc = 0
+        if libcrypto is not None:
+            self.sha1 = ctypes.create_string_buffer(self.ctx_size)
+            self.md5 = ctypes.create_string_buffer(self.ctx_size)
+            if state is None:
+                libcrypto.SHA1_Init(self.sha1)
+                libcrypto.MD5_Init(self.md5)
+            else:
+                state = state[len(self.tag()):]
+                self.sha1.raw = state[:self.ctx_size]
+                self.md5.raw = state[self.ctx_size:self.ctx_size * 2]
+                self.crc = struct.unpack_from('<I', state, self.ctx_size * 2)[0]
+        else:
+            self.sha1 = hashlib.sha1()
+            self.md5 = hashlib.md5()
+
+    def resumable(self):
+        return libcrypto is not None
+
+    def state(self):
+        return self.tag() + self.sha1.raw + self.md5.raw + struct.pack('<I', self.crc) if self.resumable() else None
+
+    def update_tasks(self, view, address):
+        """Return the three digest updates for a chunk so they can run on separate cores"""
+        length = len(view)
+
+        def update_crc():
+            self.crc = zlib.crc32(view, self.crc)
+
+        if self.resumable():
+            return [lambda: libcrypto.SHA1_Update(self.sha1, address, length),
+                    lambda: libcrypto.MD5_Update(self.md5, address, length),
+                    update_crc]
+        return [lambda: self.sha1.update(view), lambda: self.md5.update(view), update_crc]
+
+    def digest(self):
+        if self.resumable():
+            sha1 = ctypes.create_string_buffer(20)
+            md5 = ctypes.create_string_buffer(16)
+            libcrypto.SHA1_Final(sha1, self.sha1)
+            libcrypto.MD5_Final(md5, self.md5)
+            return ImageHashes(sha1.raw.hex(), md5.raw.hex(), f"{self.crc:08x}")
+        return ImageHashes(self.sha1.hexdigest(), self.md5.hexdigest(), f"{self.crc:08x}")
+
+class HostActivityMonitor:
+    """
+    Detects the USB host reading from the store partition by comparing the
+    partition's read counters with the bytes this process read itself.
+    """
+
+    def __init__(self, device, threshold=256 * 1024):
+        self.stat_file = f"/sys/class/block/{os.path.basename(device)}/stat"
+        self.threshold = threshold
+        self.last = self._sample()
+
+    def _sample(self):
+        try:
+            with open(self.stat_file) as f:
+                device_bytes = int(f.read().split()[2]) * 512
+            with open('/proc/self/io') as f:
+                own_bytes = next(int(line.split()[1]) for line in f if line.startswith('read_bytes'))
+            return device_bytes, own_bytes
+        except Exception:
+            return None
+
+    def host_active(self):
+        current = self._sample()
+        previous, self.last = self.last, current
+        if current is None or previous is None:
+            return False
+        return (current[0] - previous[0]) - (current[1] - previous[1]) > self.threshold
+
+class HashEngine:
+    """
+    Background hashing of every image in the catalog. Files are streamed in
+    large aligned chunks with O_DIRECT where supported, the three digests are
+    computed on separate cores while the next chunk is read, progress is
+    checkpointed so a reboot resumes mid-file, and work pauses whenever the
+    host is reading from the card or the store is exported in exFAT mode.
+    Files are hashed one at a time since parallel reads would only make a
+    single SD card seek.
+    """
+
+    def __init__(self, catalog, device):
+        self.catalog = catalog
+        self.monitor = HostActivityMonitor(device)
+        self.hashes = {}
+        self.version = 0
+        self.lock = Lock()
+        self.wake = Event()
+        self._db = None
+
+    def _open_db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.catalog.db_file, timeout=10, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS hashes (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT, md5 TEXT, crc32 TEXT)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS hash_progress (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, offset INTEGER, state BLOB)")
+            self._db.commit()
+        return self._db
+
+    def load(self):
+        try:
+            with self.lock:
+                for name, size, mtime, sha1, md5, crc32 in self._open_db().execute("SELECT * FROM hashes"):
+                    self.hashes[name] = (size, mtime, ImageHashes(sha1, md5, crc32))
+        except Exception as e:
+            logger.error(f"Failed to load image hashes: {e}")
+
+    def get(self, name):
+        """Hashes of a catalog entry, or None if it hasn't been hashed in its current version"""
+        entry = self.catalog.get(name)
+        cached = self.hashes.get(name)
+        if entry is None or cached is None or cached[:2] != (entry.size, entry.mtime):
+            return None
+        return cached[2]
+
+    def catalog_changed(self, changed, removed):
+        # Catalog listener: new or modified images need hashing
+        if removed:
+            with self.lock:
+                for name in removed:
+                    self.hashes.pop(name, None)
+                try:
+                    db = self._open_db()
+                    with db:
+                        db.executemany("DELETE FROM hashes WHERE name = ?", [(name,) for name in removed])
+                        db.executemany("DELETE FROM hash_progress WHERE name = ?", [(name,) for name in removed])
+                except Exception as e:
+                    logger.error(f"Failed to drop hash rows: {e}")
+        if changed:
+            self.wake.set()
+
+    def _checkpoint(self, entry, offset, state):
+        if state is None:
+            return
+        try:
+            db = self._open_db()
+            with db:
+                db.execute("INSERT OR REPLACE INTO hash_progress VALUES (?, ?, ?, ?, ?)",
+                           (entry.name, entry.size, entry.mtime, offset, state))
+        except Exception as e:
+            logger.error(f"Failed to checkpoint hashing of {entry.name}: {e}")
+
+    def _resume_point(self, entry):
+        try:
+            row = self._open_db().execute("SELECT size, mtime, offset, state FROM hash_progress WHERE name = ?", (entry.name,)).fetchone()
+        except Exception:
+            row = None
+        if row and row[:2] == (entry.size, entry.mtime) and libcrypto is not None:
+            if HashState.restorable(row[3]):
+                return row[2], HashState(row[3])
+            logger.info(f"Hash checkpoint of {entry.name} was written by another libcrypto, starting over")
+        return 0, HashState()
+
+    def _wait_until_idle(self):
+        """Block while the host is reading the card or owns the store; returns False on exit"""
+        quiet_since = None
+        while not exitRequested:
+            if store_exported() or self.monitor.host_active():
+                quiet_since = None
+            elif quiet_since is None:
+                quiet_since = time.time()
+            elif time.time() - quiet_since >= hash_idle_seconds:
+                return True
+            time.sleep(1)
+        return False
+
+    def hash_file(self, entry, pool, buffers):
+        path = os.path.join(self.catalog.root, entry.name)
+        offset, state = self._resume_point(entry)
+        if offset:
+            logger.info(f"Resuming hash of {entry.name} at {offset // (1024 * 1024)} MB")
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_DIRECT', 0))
+            direct = True
+        except OSError:
+            fd = os.open(path, os.O_RDONLY)
+            direct = False
+        start = time.time()
+        started_at = offset
+        last_checkpoint = offset
+        pending = []
+        try:
+            index = 0
+            while offset < entry.size:
+                if self.monitor.host_active() or store_exported():
+                    for future in pending:
+                        future.result()
+                    pending = []
+                    self._checkpoint(entry, offset, state.state())
+                    logger.info(f"Host is using the card, pausing hash of {entry.name}")
+                    if not self._wait_until_idle():
+                        return None
+                    self.monitor.host_active()
+                buffer, address = buffers[index % 2]
+                try:
+                    count = os.preadv(fd, [buffer], offset)
+                except OSError:
+                    if not direct:
+                        raise
+                    # The filesystem refused direct IO, fall back to buffered reads
+                    os.close(fd)
+                    fd = os.open(path, os.O_RDONLY)
+                    direct = False
+                    count = os.preadv(fd, [buffer], offset)
+                if count <= 0:
+                    break
+                if not direct:
+                    # Don't let a full pass over the store evict the host's hot pages
+                    os.posix_fadvise(fd, offset, count, os.POSIX_FADV_DONTNEED)
+                for future in pending:
+                    future.result()
+                offset += count
+                pending = [pool.submit(task) for task in state.update_tasks(memoryview(buffer)[:count], address)]
+                index += 1
+                if offset - last_checkpoint >= hash_checkpoint_interval:
+                    for future in pending:
+                        future.result()
+                    pending = []
+                    self._checkpoint(entry, offset, state.state())
+                    last_checkpoint = offset
+            for future in pending:
+                future.result()
+        finally:
+            os.close(fd)
+        current = self.catalog.get(entry.name)
+        if current is None or (current.size, current.mtime) != (entry.size, entry.mtime) or offset != entry.size:
+            logger.info(f"{entry.name} changed while hashing, will retry")
+            return None
+        hashes = state.digest()
+        elapsed = time.time() - start
+        logger.info(f"Hashed {entry.name}: sha1 {hashes.sha1} ({(offset - started_at) / (1024 * 1024) / max(elapsed, 0.001):.1f} MB/s)")
+        with self.lock:
+            self.hashes[entry.name] = (entry.size, entry.mtime, hashes)
+            self.version += 1
+            try:
+                db = self._open_db()
+                with db:
+                    db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", (entry.name, entry.size, entry.mtime) + tuple(hashes))
+                    db.execute("DELETE FROM hash_progress WHERE name = ?", (entry.name,))
+            except Exception as e:
+                logger.error(f"Failed to store hashes for {entry.name}: {e}")
+        return hashes
+
+    def run(self):
+        # Idle IO priority so the gadget's reads always win at the block layer
+        subprocess.run(['ionice', '-c', '3', '-p', str(threading.get_native_id())], capture_output=True)
+        # Page-aligned buffers as O_DIRECT requires; two so one is read while the other is hashed
+        buffers = []
+        for i in range(2):
+            buffer = mmap.mmap(-1, hash_chunk_size)
+            buffers.append((buffer, ctypes.addressof(ctypes.c_char.from_buffer(buffer))))
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix='Hasher') as pool:
+            while not exitRequested:
+                self.wake.clear()
+                # DATs are copied in alongside images, so look for new ones whenever we look for work
+                dat_index.refresh()
+                todo = [self.catalog.get(name) for name in self.catalog.names() if self.get(name) is None]
+                todo = [entry for entry in todo if entry is not None]
+                if not todo:
+                    self.wake.wait(60)
+                    continue
+                for entry in todo:
+                    if exitRequested:
+                        break
+                    if not self._wait_until_idle():
+                        break
+                    try:
+                        self.hash_file(entry, pool, buffers)
+                    except Exception as e:
+                        logger.error(f"Failed to hash {entry.name}: {e}")
+                        time.sleep(hash_idle_seconds)
+                # Only images that failed or changed are left; don't spin on them
+                self.wake.wait(60)
+
+hash_engine = HashEngine(image_catalog, store_dev)
+image_catalog.add_listener(hash_engine.catalog_changed)
+
+def start_hashing():
+    global libcrypto
+    libcrypto = load_libcrypto()
+    hash_engine.load()
+    daemonHasher = Thread(target=hash_engine.run, daemon=True, name='Hash Engine')
+    daemonHasher.start()
+    logger.info("Image hashing thread started")
+
+### END OF IMAGE HASHING ###
+
+### Beginning of DAT Matching ###
+
+dat_index_file = '/opt/usbode/usbode-dat.idx'
+
+DatMatch = namedtuple('DatMatch', ['title', 'bad_dump'])
+
+def parse_logiqx_dat(path):
+    """Yield (title, size, crc32, sha1, bad_dump) for every rom in a Logiqx XML DAT"""
+    for event, elem in ElementTree.iterparse(path, events=('end',)):
+        if elem.tag not in ('game', 'machine'):
+            continue
+        title = elem.get('name', '')
+        for rom in elem.iter('rom'):
+            yield (title, int(rom.get('size') or 0), rom.get('crc'), rom.get('sha1'),
+                   rom.get('status') in ('baddump', 'nodump'))
+        elem.clear()
+
+clrmamepro_token = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+
+def parse_clrmamepro_dat(path):
+    """Yield (title, size, crc32, sha1, bad_dump) for every rom in a clrmamepro text DAT"""
+    title = ''
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('name ') and not line.startswith('name ('):
+                match = clrmamepro_token.match(line, 5)
+                if match:
+                    title = match.group(1) if match.group(1) is not None else match.group(2)
+            elif line.startswith('rom ('):
+                tokens = [m.group(1) if m.group(1) is not None else m.group(2) for m in clrmamepro_token.finditer(line[5:].rstrip(')'))]
+                fields = {}
+                flags = set()
+                i = 0
+                while i < len(tokens):
+                    if tokens[i] in ('baddump', 'nodump'):
+                        flags.add(tokens[i])
+                        i += 1
+                    else:
+                        fields[tokens[i].lower()] = tokens[i + 1] if i + 1 < len(tokens) else ''
+                        i += 2
+                size = fields.get('size', '0')
+                yield (title, int(size) if size.isdigit() else 0, fields.get('crc'), fields.get('sha1'),
+                       bool(flags) or fields.get('flags') in ('baddump', 'nodump'))
+
+class DatIndex:
+    """
+    Hash -> title lookup compiled from the Redump/No-Intro DATs in the store.
+    The DATs are parsed once into an open-addressed hash table on disk (keyed
+    by SHA-1, with a CRC32+size table for DATs without SHA-1) which is mmap'd,
+    so a lookup is a couple of probes no matter how many entries the DATs have.
+    """
+    magic = b'USBODAT1'
+    header = struct.Struct('<8sIIIQ')
+    sha1_slot = struct.Struct('<20sI')
+    crc_slot = struct.Struct('<IQI')
+    empty = 0xFFFFFFFF
+
+    def __init__(self, root, index_file):
+        self.root = root
+        self.index_file = index_file
+        self.stamp = None
+        self.map = None
+        self.lock = Lock()
+
+    def dat_files(self):
+        found = []
+        try:
+            with os.scandir(self.root) as it:
+                for dirent in it:
+                    if dirent.name.lower().endswith(('.dat', '.xml')) and not dirent.name.startswith('._') and dirent.is_file():
+                        st = dirent.stat()
+                        found.append([dirent.name, st.st_size, st.st_mtime])
+        except OSError as e:
+            logger.error(f"Failed to look for DAT files in {self.root}: {e}")
+        return sorted(found)
+
+    def refresh(self):
+        """Open the compiled index, recompiling it first if the DAT files changed"""
+        stamp = json.dumps(self.dat_files())
+        if stamp == self.stamp:
+            return
+        if self.map is None and self._open(stamp):
+            return
+        if stamp == '[]':
+            with self.lock:
+                self.map = None
+                self.stamp = stamp
+            return
+        try:
+            self.compile(stamp)
+        except Exception as e:
+            logger.error(f"Failed to compile DAT index: {e}")
+            self.stamp = stamp
+            return
+        self._open(stamp)
+
+    def _open(self, stamp):
+        try:
+            with open(self.index_file, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        magic, stamp_len, sha1_buckets, crc_buckets, titles_offset = self.header.unpack_from(mapped, 0)
+        if magic != self.magic or mapped[self.header.size:self.header.size + stamp_len].decode('utf-8', 'replace') != stamp:
+            mapped.close()
+            return False
+        with self.lock:
+            self.map = mapped
+            self.stamp = stamp
+            self.sha1_buckets = sha1_buckets
+            self.crc_buckets = crc_buckets
+            self.sha1_table = self.header.size + stamp_len
+            self.crc_table = self.sha1_table + sha1_buckets * self.sha1_slot.size
+            self.titles = titles_offset
+        logger.info(f"Opened DAT index {self.index_file}")
+        return True
+
+    def compile(self, stamp):
+        start = time.time()
+        titles = bytearray()
+        title_offsets = {}
+        roms = []
+        for name, size, mtime in json.loads(stamp):
+            path = os.path.join(self.root, name)
+            with open(path, 'rb') as f:
+                is_xml = f.read(64).lstrip().startswith(b'<')
+            parser = parse_logiqx_dat if is_xml else parse_clrmamepro_dat
+            try:
+                for title, rom_size, crc, sha1, bad_dump in parser(path):
+                    key = (title, bad_dump)
+                    if key not in title_offsets:
+                        encoded = title.encode('utf-8')[:65535]
+                        title_offsets[key] = len(titles)
+                        titles += struct.pack('<BH', int(bad_dump), len(encoded)) + encoded
+                    roms.append((bytes.fromhex(sha1) if sha1 and len(sha1) == 40 else None,
+                                 int(crc, 16) if crc else None, rom_size, title_offsets[key]))
+            except Exception as e:
+                logger.error(f"Failed to parse DAT {name}: {e}")
+
+        def table_size(count):
+            size = 16
+            while size < count * 2:
+                size *= 2
+            return size
+
+        sha1_buckets = table_size(sum(1 for rom in roms if rom[0]))
+        crc_buckets = table_size(sum(1 for rom in roms if rom[1] is not None))
+        sha1_table = bytearray(self.sha1_slot.pack(b'\0' * 20, self.empty) * sha1_buckets)
+        crc_table = bytearray(self.crc_slot.pack(0, 0, self.empty) * crc_buckets)
+        for sha1, crc, rom_size, title_offset in roms:
+            if sha1:
+                slot = struct.unpack_from('<I', sha1)[0] & (sha1_buckets - 1)
+                while self.sha1_slot.unpack_from(sha1_table, slot * self.sha1_slot.size)[1] != self.empty:
+                    slot = (slot + 1) & (sha1_buckets - 1)
+                self.sha1_slot.pack_into(sha1_table, slot * self.sha1_slot.size, sha1, title_offset)
+            if crc is not None:
+                slot = (crc ^ rom_size) & (crc_buckets - 1)
+                while self.crc_slot.unpack_from(crc_table, slot * self.crc_slot.size)[2] != self.empty:
+                    slot = (slot + 1) & (crc_buckets - 1)
+                self.crc_slot.pack_into(crc_table, slot * self.crc_slot.size, crc, rom_size, title_offset)
+
+        encoded_stamp = stamp.encode('utf-8')
+        titles_offset = self.header.size + len(encoded_stamp) + len(sha1_table) + len(crc_table)
+        temp_file = self.index_file + '.tmp'
+        with open(temp_file, 'wb') as f:
+            f.write(self.header.pack(self.magic, len(encoded_stamp), sha1_buckets, crc_buckets, titles_offset))
+            f.write(encoded_stamp)
+            f.write(sha1_table)
+            f.write(crc_table)
+            f.write(titles)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.index_file)
+        logger.info(f"Compiled {len(roms)} DAT entries ({len(title_offsets)} titles) into {self.index_file} in {time.time() - start:.1f}s")
+
+    def _title(self, offset):
+        bad_dump, length = struct.unpack_from('<BH', self.map, self.titles + offset)
+        start = self.titles + offset + 3
+        return DatMatch(self.map[start:start + length].decode('utf-8', 'replace'), bool(bad_dump))
+
+    def lookup(self, hashes, size):
+        """Return the DatMatch for an image's hashes, or None if no DAT lists it"""
+        with self.lock:
+            if self.map is None or hashes is None:
+                return None
+            sha1 = bytes.fromhex(hashes.sha1)
+            slot = struct.unpack_from('<I', sha1)[0] & (self.sha1_buckets - 1)
+            while True:
+                key, title_offset = self.sha1_slot.unpack_from(self.map, self.sha1_table + slot * self.sha1_slot.size)
+                if title_offset == self.empty:
+                    break
+                if key == sha1:
+                    return self._title(title_offset)
+                slot = (slot + 1) & (self.sha1_buckets - 1)
+            crc = int(hashes.crc32, 16)
+            slot = (crc ^ size) & (self.crc_buckets - 1)
+            while True:
+                key, key_size, title_offset = self.crc_slot.unpack_from(self.map, self.crc_table + slot * self.crc_slot.size)
+                if title_offset == self.empty:
+                    return None
+                if key == crc and key_size == size:
+                    return self._title(title_offset)
+                slot = (slot + 1) & (self.crc_buckets - 1)
+
+dat_index = DatIndex(store_mnt, dat_index_file)
+
+def dat_match(name):
+    """DAT entry matching a catalog image, once the hash engine has hashed it"""
+    entry = image_catalog.get(name)
+    if entry is None:
+        return None
+    return dat_index.lookup(hash_engine.get(name), entry.size)
+
+def image_title(name):
+    """Name to show for an image: the verified DAT title when known, flagged if it's a bad dump"""
+    match = dat_match(name)
+    if match is None:
+        return os.path.basename(name)
+    if match.bad_dump:
+        return "BAD DUMP: " + match.title
+    return match.title
+
+def menu_item_label(folder, item):
+    """Display text for a picker entry, using the DAT title for images"""
+    kind, target = folder_menu_select(folder, item)
+    return image_title(target) if kind == 'image' else item
+
+### END OF DAT MATCHING ###
+
+### Beginning of Block Backend ###
+
+CueTrack = namedtuple('CueTrack', ['file', 'number', 'mode', 'sector_size', 'data_offset', 'start_frame'])
+
+# Bytes per raw sector and where the 2048 bytes of user data start in it, per cue track mode
+cue_track_layouts = {
+    'MODE1/2048': (2048, 0),
+    'MODE1/2352': (2352, 16),
+    'MODE2/2336': (2336, 8),
+    'MODE2/2352': (2352, 24),
+    'CDI/2336': (2336, 8),
+    'CDI/2352': (2352, 24),
+    'AUDIO': (2352, 0),
+}
+
+def cue_frames(timestamp):
+    minutes, seconds, frames = (int(part) for part in timestamp.split(':'))
+    return (minutes * 60 + seconds) * 75 + frames
+
+def parse_cue_sheet(path):
+    """Return the tracks of a cue sheet with their BIN paths resolved next to the cue"""
+    folder = os.path.dirname(path)
+    tracks = []
+    current_file = None
+    number = mode = None
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            match = re.match(r'\s*FILE\s+(?:"(.*)"|(\S+))\s+\S+', line, re.IGNORECASE)
+            if match:
+                current_file = os.path.join(folder, match.group(1) or match.group(2))
+                continue
+            match = re.match(r'\s*TRACK\s+(\d+)\s+(\S+)', line, re.IGNORECASE)
+            if match:
+                number, mode = int(match.group(1)), match.group(2).upper()
+                continue
+            match = re.match(r'\s*INDEX\s+01\s+(\d+:\d+:\d+)', line, re.IGNORECASE)
+            if match and number is not None and current_file:
+                if mode not in cue_track_layouts:
+                    raise ValueError(f"Unsupported track mode {mode} in {path}")
+                sector_size, data_offset = cue_track_layouts[mode]
+                tracks.append(CueTrack(current_file, number, mode, sector_size, data_offset, cue_frames(match.group(1))))
+                number = None
+    return tracks
+
+class CueSectorReader:
+    """
+    Presents the first data track of a CUE/BIN as cooked 2048-byte sectors,
+    slicing the user data out of each raw sector of an mmap'd BIN instead of
+    writing a converted copy. The data track has to be track 1: on CD-Extra
+    discs it follows the audio in a later session, and its filesystem points
+    at absolute disc addresses that a single-track drive cannot serve.
+    """
+
+    def __init__(self, path):
+        tracks = parse_cue_sheet(path)
+        data_tracks = [track for track in tracks if track.mode != 'AUDIO']
+        if not data_tracks:
+            raise ValueError(f"{path} has no data track")
+        self.track = track = data_tracks[0]
+        if track is not tracks[0]:
+            raise ValueError(f"{path} starts with audio and has its data in track {track.number} (CD-Extra), which can't be served as a CD-ROM image")
+        if len(tracks) > 1:
+            logger.info(f"{path} has {len(tracks)} tracks, only data track {track.number} can be served")
+        self.fd = os.open(track.file, os.O_RDONLY)
+        file_size = os.fstat(self.fd).st_size
+        self.base = track.start_frame * track.sector_size
+        end = file_size
+        for other in tracks:
+            if other.file == track.file and other.start_frame > track.start_frame:
+                end = min(end, other.start_frame * other.sector_size)
+        self.blocks = max(0, (end - self.base) // track.sector_size)
+        self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ) if file_size else None
+
+    def is_cooked(self):
+        """True when the BIN already is a plain 2048-byte image the gadget can read directly"""
+        return self.track.sector_size == iso_sector_size and self.base == 0
+
+    def read(self, lba, count=1):
+        count = max(0, min(count, self.blocks - lba))
+        if count == 0:
+            return b''
+        sector_size = self.track.sector_size
+        start = self.base + lba * sector_size + self.track.data_offset
+        if sector_size == iso_sector_size:
+            return self.map[start:start + count * iso_sector_size]
+        view = memoryview(self.map)
+        try:
+            return b''.join(view[offset:offset + iso_sector_size] for offset in range(start, start + count * sector_size, sector_size))
+        finally:
+            view.release()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Linux NBD ioctls and wire protocol constants from <linux/nbd.h>
+NBD_SET_SOCK = 0xab00
+NBD_SET_BLKSIZE = 0xab01
+NBD_DO_IT = 0xab03
+NBD_CLEAR_SOCK = 0xab04
+NBD_CLEAR_QUE = 0xab05
+NBD_SET_SIZE_BLOCKS = 0xab07
+NBD_DISCONNECT = 0xab08
+NBD_SET_TIMEOUT = 0xab09
+NBD_SET_FLAGS = 0xab0a
+NBD_FLAG_HAS_FLAGS = 1 << 0
+NBD_FLAG_READ_ONLY = 1 << 1
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_REPLY_MAGIC = 0x67446698
+NBD_CMD_READ = 0
+NBD_CMD_DISC = 2
+nbd_request = struct.Struct('>IHH8sQI')
+nbd_reply = struct.Struct('>II8s')
+
+class NbdExport:
+    """
+    Serves a sector reader to the kernel as a read-only NBD block device. The
+    kernel end of a socketpair is handed over with NBD_SET_SOCK, so no NBD
+    client tools or handshake are involved, and the gadget reads the device
+    like any other block device.
+    """
+
+    def __init__(self, device, reader, source):
+        self.device = device
+        self.reader = reader
+        self.source = source
+        self.device_fd = None
+        self.threads = []
+
+    def start(self):
+        subprocess.run(['modprobe', 'nbd'], capture_output=True)
+        self.device_fd = os.open(self.device, os.O_RDWR)
+        kernel_sock, self.sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            fcntl.ioctl(self.device_fd, NBD_CLEAR_SOCK)
+            fcntl.ioctl(self.device_fd, NBD_SET_BLKSIZE, iso_sector_size)
+            fcntl.ioctl(self.device_fd, NBD_SET_SIZE_BLOCKS, self.reader.blocks)
+            fcntl.ioctl(self.device_fd, NBD_SET_FLAGS, NBD_FLAG_HAS_FLAGS | NBD_FLAG_READ_ONLY)
+            fcntl.ioctl(self.device_fd, NBD_SET_TIMEOUT, 30)
+            fcntl.ioctl(self.device_fd, NBD_SET_SOCK, kernel_sock.fileno())
+        except OSError:
+            kernel_sock.close()
+            self.sock.close()
+            os.close(self.device_fd)
+            raise
+        # NBD_DO_IT blocks for the lifetime of the device, the kernel keeps its own reference to the socket
+        self.threads = [Thread(target=self._do_it, args=(kernel_sock,), daemon=True, name=f'NBD {self.device}'),
+                        Thread(target=self._serve, daemon=True, name=f'NBD server {self.device}')]
+        for thread in self.threads:
+            thread.start()
+        logger.info(f"Serving {self.source} on {self.device} ({self.reader.blocks} sectors)")
+
+    def _do_it(self, kernel_sock):
+        try:
+            fcntl.ioctl(self.device_fd, NBD_DO_IT)
+        except OSError as e:
+            logger.info(f"NBD_DO_IT on {self.device} returned: {e}")
+        finally:
+            kernel_sock.close()
+
+    def _recv_exact(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def _serve(self):
+        try:
+            while True:
+                header = self._recv_exact(nbd_request.size)
+                if header is None:
+                    break
+                magic, flags, command, handle, offset, length = nbd_request.unpack(header)
+                if magic != NBD_REQUEST_MAGIC or command == NBD_CMD_DISC:
+                    break
+                if command != NBD_CMD_READ:
+                    # Read-only device; flushes are no-ops, everything else is refused
+                    self.sock.sendall(nbd_reply.pack(NBD_REPLY_MAGIC, 0 if command == 3 else errno.EPERM, handle))
+                    continue
+                try:
+                    first = offset // iso_sector_size
+                    last = (offset + length + iso_sector_size - 1) // iso_sector_size
+                    data = self.reader.read(first, last - first)
+                    skip = offset - first * iso_sector_size
+                    data = data[skip:skip + length]
+                    data += b'\0' * (length - len(data))
+                    self.sock.sendall(nbd_reply.pack(NBD_REPLY_MAGIC, 0, handle) + data)
+                except Exception as e:
+                    logger.error(f"NBD read of {length} bytes at {offset} from {self.source} failed: {e}")
+                    self.sock.sendall(nbd_reply.pack(NBD_REPLY_MAGIC, errno.EIO, handle))
+        except OSError as e:
+            logger.info(f"NBD server for {self.device} stopped: {e}")
+
+    def stop(self):
+        try:
+            fcntl.ioctl(self.device_fd, NBD_DISCONNECT)
+        except OSError as e:
+            logger.warning(f"NBD_DISCONNECT on {self.device} failed: {e}")
+        for thread in self.threads:
+            thread.join(5)
+        try:
+            fcntl.ioctl(self.device_fd, NBD_CLEAR_QUE)
+            fcntl.ioctl(self.device_fd, NBD_CLEAR_SOCK)
+        except OSError:
+            pass
+        self.sock.close()
+        os.close(self.device_fd)
+        self.reader.close()
+        logger.info(f"Stopped serving {self.source} on {self.device}")
+
+block_cache_bytes = 16 * 1024 * 1024
+readahead_blocks = 4
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+class BlockCache:
+    """Size-bounded LRU of decompressed blocks shared by the NBD server and its readahead thread"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()
+        self.bytes = 0
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, index):
+        with self.lock:
+            data = self.blocks.get(index)
+            if data is not None:
+                self.blocks.move_to_end(index)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return data
+
+    def __contains__(self, index):
+        return index in self.blocks
+
+    def put(self, index, data):
+        with self.lock:
+            if index in self.blocks:
+                return
+            self.blocks[index] = data
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes and len(self.blocks) > 1:
+                evicted_index, evicted = self.blocks.popitem(last=False)
+                self.bytes -= len(evicted)
+
+class CisoBlockSource:
+    """CSO (deflate) and ZISO (LZ4) images: a block index followed by individually compressed blocks"""
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        magic, header_size, self.total_size, self.block_size, version, self.align = struct.unpack('<4sIQIBB', os.pread(self.fd, 22, 0))
+        if magic not in (b'CISO', b'ZISO'):
+            os.close(self.fd)
+            raise ValueError(f"{path} is not a CSO/ZISO image")
+        self.lz4 = magic == b'ZISO'
+        self.version = version
+        self.lock = Lock()
+        count = (self.total_size + self.block_size - 1) // self.block_size + 1
+        self.index = struct.unpack(f'<{count}I', os.pread(self.fd, count * 4, 24))
+        # ZISO blocks and flagged CSOv2 blocks are LZ4; refuse now rather than fail mid-read
+        uses_lz4 = self.lz4 or (version >= 2 and any(entry & 0x80000000 for entry in self.index[:-1]))
+        if uses_lz4 and lz4 is None:
+            os.close(self.fd)
+            raise ValueError(f"{path} has LZ4 blocks, which need python3-lz4")
+
+    def read_block(self, number):
+        entry, next_entry = self.index[number], self.index[number + 1]
+        position = (entry & 0x7FFFFFFF) << self.align
+        length = ((next_entry & 0x7FFFFFFF) << self.align) - position
+        with self.lock:
+            # After close() fd is -1, so a late read fails instead of reading whatever reused the descriptor
+            data = os.pread(self.fd, length, position)
+        expected = min(self.block_size, self.total_size - number * self.block_size)
+        if self.lz4:
+            if entry & 0x80000000:
+                return data[:expected]
+            return lz4.block.decompress(data, uncompressed_size=self.block_size)[:expected]
+        if self.version >= 2 and length >= self.block_size:
+            # CSOv2 stores incompressible blocks raw without setting a flag
+            return data[:expected]
+        if entry & 0x80000000:
+            if self.version >= 2:
+                return lz4.block.decompress(data, uncompressed_size=self.block_size)[:expected]
+            return data[:expected]
+        return zlib.decompressobj(-15).decompress(data, self.block_size)[:expected]
+
+    def close(self):
+        with self.lock:
+            os.close(self.fd)
+            self.fd = -1
+
+class GzipBlockSource:
+    """
+    Random access into a gzipped image. Decompressor state is checkpointed
+    every few MB the first time a region is decompressed, so later reads only
+    inflate from the nearest checkpoint instead of the start of the file.
+    """
+    block_size = 256 * 1024
+    span = 4 * 1024 * 1024
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.compressed_size = os.fstat(self.fd).st_size
+        self.checkpoints = [(0, 0, zlib.decompressobj(31))]
+        self.lock = Lock()
+        size = struct.unpack('<I', os.pread(self.fd, 4, self.compressed_size - 4))[0]
+        # The trailer only holds the size modulo 4 GB; the PVD knows the real size of an ISO
+        self.total_size = size
+        pvd = self._inflate(16 * iso_sector_size, iso_sector_size)
+        if pvd[1:6] == b'CD001':
+            pvd_size = struct.unpack_from('<I', pvd, 80)[0] * iso_sector_size
+            if pvd_size & 0xFFFFFFFF == size:
+                self.total_size = pvd_size
+
+    def _inflate(self, position, length):
+        with self.lock:
+            i = bisect.bisect_right([checkpoint[0] for checkpoint in self.checkpoints], position) - 1
+            out_position, in_position, decompressor = self.checkpoints[i]
+            decompressor = decompressor.copy()
+            extend_index = i == len(self.checkpoints) - 1
+        output = bytearray()
+        pending = b''
+        while out_position < position + length:
+            if not pending:
+                with self.lock:
+                    pending = os.pread(self.fd, 64 * 1024, in_position)
+                if not pending:
+                    break
+            chunk_start = in_position
+            data = decompressor.decompress(pending, 256 * 1024)
+            if decompressor.eof:
+                # Concatenated gzip members: start a new decompressor after this one's trailer
+                in_position = chunk_start + len(pending) - len(decompressor.unused_data)
+                pending = b''
+                decompressor = zlib.decompressobj(31)
+            else:
+                in_position = chunk_start + len(pending) - len(decompressor.unconsumed_tail)
+                pending = decompressor.unconsumed_tail
+            if out_position + len(data) > position:
+                output += data[max(0, position - out_position):position + length - out_position]
+            out_position += len(data)
+            if extend_index and out_position - self.checkpoints[-1][0] >= self.span and not pending:
+                with self.lock:
+                    if out_position > self.checkpoints[-1][0]:
+                        self.checkpoints.append((out_position, in_position, decompressor.copy()))
+        return bytes(output)
+
+    def read_block(self, number):
+        return self._inflate(number * self.block_size, min(self.block_size, self.total_size - number * self.block_size))
+
+    def close(self):
+        with self.lock:
+            os.close(self.fd)
+            self.fd = -1
+
+class ChdBlockSource:
+    """CHD images through libchdr; one block is one CHD hunk"""
+    open_read = 1
+    track_tag = (ord('C') << 24) | (ord('H') << 16) | (ord('T') << 8) | ord('2')
+    # 2048 bytes of user data at these offsets inside each 2448-byte CHD CD frame
+    track_layouts = {'MODE1': 0, 'MODE2_FORM1': 0, 'MODE1_RAW': 16, 'MODE2_RAW': 24, 'MODE2': 8, 'MODE2_FORM_MIX': 8}
+    frame_size = 2448
+
+    class Header(ctypes.Structure):
+        _fields_ = [('length', ctypes.c_uint32), ('version', ctypes.c_uint32), ('flags', ctypes.c_uint32),
+                    ('compression', ctypes.c_uint32 * 4), ('hunkbytes', ctypes.c_uint32),
+                    ('totalhunks', ctypes.c_uint32), ('logicalbytes', ctypes.c_uint64)]
+
+    def __init__(self, path):
+        library = ctypes.util.find_library('chdr')
+        if library is None:
+            raise ValueError("CHD images need libchdr")
+        self.lib = ctypes.CDLL(library)
+        self.lib.chd_open.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(ctypes.c_void_p)]
+        self.lib.chd_get_header.argtypes = [ctypes.c_void_p]
+        self.lib.chd_get_header.restype = ctypes.POINTER(self.Header)
+        self.lib.chd_read.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_void_p]
+        self.lib.chd_get_metadata.argtypes = [ctypes.c_void_p, ctypes.c_uint32, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_uint32,
+                                              ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_uint32), ctypes.POINTER(ctypes.c_uint8)]
+        self.lib.chd_close.argtypes = [ctypes.c_void_p]
+        self.chd = ctypes.c_void_p()
+        error = self.lib.chd_open(path.encode(), self.open_read, None, ctypes.byref(self.chd))
+        if error:
+            raise ValueError(f"chd_open failed on {path} with error {error}")
+        header = self.lib.chd_get_header(self.chd).contents
+        self.block_size = header.hunkbytes
+        self.total_size = header.logicalbytes
+        self.lock = Lock()
+        self.buffer = ctypes.create_string_buffer(self.block_size)
+        # CD images carry track metadata; use the first data track's layout. Like
+        # CueSectorReader, refuse CD-Extra discs whose data track follows audio.
+        self.stride, self.data_offset, self.first_frame, self.frames = iso_sector_size, 0, 0, None
+        metadata = ctypes.create_string_buffer(256)
+        for index in range(99):
+            length = ctypes.c_uint32()
+            if self.lib.chd_get_metadata(self.chd, self.track_tag, index, metadata, 256, ctypes.byref(length), None, None):
+                break
+            fields = dict(field.split(':', 1) for field in metadata.value.decode('ascii', 'replace').split() if ':' in field)
+            if fields.get('TYPE') in self.track_layouts:
+                if index > 0:
+                    self.close()
+                    raise ValueError(f"{path} starts with audio and has its data in track {fields.get('TRACK', index + 1)} (CD-Extra), which can't be served as a CD-ROM image")
+                pregap = int(fields.get('PREGAP', 0)) if fields.get('PGTYPE', '').startswith('V') else 0
+                self.stride = self.frame_size
+                self.data_offset = self.track_layouts[fields['TYPE']]
+                self.first_frame = pregap
+                self.frames = int(fields.get('FRAMES', 0)) - pregap
+                break
+
+    def read_block(self, number):
+        with self.lock:
+            if self.chd is None:
+                raise IOError(f"chd_read of hunk {number} after close")
+            error = self.lib.chd_read(self.chd, number, self.buffer)
+            if error:
+                raise IOError(f"chd_read of hunk {number} failed with error {error}")
+            return self.buffer.raw
+
+    def close(self):
+        # Under the lock so a read in progress finishes before libchdr frees the handle
+        with self.lock:
+            if self.chd is not None:
+                self.lib.chd_close(self.chd)
+                self.chd = None
+
+class CompressedSectorReader:
+    """
+    Cooked 2048-byte sectors out of a compressed block source, through an LRU
+    block cache. When reads are sequential the next few blocks are
+    decompressed ahead of time on a background thread.
+    """
+
+    def __init__(self, source, cache_bytes=block_cache_bytes, readahead=0):
+        self.source = source
+        self.stride = getattr(source, 'stride', iso_sector_size)
+        self.data_offset = getattr(source, 'data_offset', 0)
+        self.first_frame = getattr(source, 'first_frame', 0)
+        frames = getattr(source, 'frames', None)
+        self.blocks = frames if frames is not None else source.total_size // iso_sector_size
+        self.cache = BlockCache(cache_bytes)
+        self.readahead = readahead
+        self.last_block = None
+        self.readahead_queue = []
+        self.readahead_event = Event()
+        self.closed = False
+        self.readahead_thread = None
+        if readahead:
+            self.readahead_thread = Thread(target=self._readahead_worker, daemon=True, name='Readahead')
+            self.readahead_thread.start()
+
+    def _block(self, number):
+        data = self.cache.get(number)
+        if data is None:
+            data = self.source.read_block(number)
+            self.cache.put(number, data)
+        return data
+
+    def _readahead_worker(self):
+        while not self.closed:
+            self.readahead_event.wait()
+            self.readahead_event.clear()
+            while self.readahead_queue and not self.closed:
+                number = self.readahead_queue.pop(0)
+                if number not in self.cache:
+                    try:
+                        self.cache.put(number, self.source.read_block(number))
+                    except Exception as e:
+                        logger.warning(f"Readahead of block {number} failed: {e}")
+
+    def read(self, lba, count=1):
+        count = max(0, min(count, self.blocks - lba))
+        if count == 0:
+            return b''
+        block_size = self.source.block_size
+        output = bytearray()
+        start = (self.first_frame + lba) * self.stride + self.data_offset
+        if self.stride == iso_sector_size:
+            # Contiguous sectors: copy whole runs out of each block
+            position, end = start, start + count * iso_sector_size
+            while position < end:
+                number = position // block_size
+                block = self._block(number)
+                offset = position - number * block_size
+                piece = block[offset:offset + min(end - position, block_size - offset)]
+                output += piece
+                position += len(piece)
+        else:
+            for position in range(start, start + count * self.stride, self.stride):
+                number = position // block_size
+                offset = position - number * block_size
+                piece = self._block(number)[offset:offset + iso_sector_size]
+                if len(piece) < iso_sector_size:
+                    piece += self._block(number + 1)[:iso_sector_size - len(piece)]
+                output += piece
+        last = (start + count * self.stride - 1) // block_size
+        first = start // block_size
+        if self.readahead and self.last_block is not None and first in (self.last_block, self.last_block + 1):
+            total_blocks = (self.source.total_size + block_size - 1) // block_size
+            ahead = [number for number in range(last + 1, min(last + 1 + self.readahead, total_blocks)) if number not in self.cache]
+            if ahead:
+                self.readahead_queue = ahead
+                self.readahead_event.set()
+        self.last_block = last
+        return bytes(output)
+
+    def close(self):
+        self.closed = True
+        self.readahead_event.set()
+        # The worker may be inside read_block(); let it finish before the source goes away
+        if self.readahead_thread is not None and self.readahead_thread is not threading.current_thread():
+            self.readahead_thread.join()
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+compressed_image_sources = {
+    '.cso': CisoBlockSource,
+    '.zso': CisoBlockSource,
+    '.chd': ChdBlockSource,
+    '.iso.gz': GzipBlockSource,
+}
+
+def open_compressed_reader(path, readahead=0):
+    """CompressedSectorReader for a CSO/ZISO/CHD/gzip image, or None for other files"""
+    for extension, source_class in compressed_image_sources.items():
+        if path.lower().endswith(extension):
+            return CompressedSectorReader(source_class(path), readahead=readahead)
+    return None
+
+# One NBD export per LUN that needs one, and the (backing, image) pair loaded into each LUN
+active_exports = {}
+active_backing = {}
+
+def nbd_device_for(lun):
+    return f"/dev/nbd{lun}"
+
+def release_backing_file(lun=None):
+    """Stop the user-space export backing a LUN's image, or every LUN's; call after the gadget let go of it"""
+    for slot in [lun] if lun is not None else list(set(active_exports) | set(active_backing)):
+        export = active_exports.pop(slot, None)
+        if export is not None:
+            export.stop()
+        active_backing.pop(slot, None)
+
+def backing_file_for(filename, lun=0):
+    """
+    Path to write to lun.N/file for an image. Plain ISOs and block devices are
+    used as is; cue sheets point at their BIN when it is already cooked.
+    Other cue sheets and compressed images are served through an NBD export
+    of their cooked sectors, on the NBD device numbered like the LUN.
+    """
+    release_backing_file(lun)
+    if filename.lower().endswith('.cue'):
+        reader = CueSectorReader(filename)
+    else:
+        reader = open_compressed_reader(filename, readahead=readahead_blocks)
+        if reader is None:
+            active_backing[lun] = (filename, filename)
+            return filename
+    if isinstance(reader, CueSectorReader) and reader.is_cooked():
+        backing = reader.track.file
+        reader.close()
+    else:
+        backing = nbd_device_for(lun)
+        export = NbdExport(backing, reader, filename)
+        try:
+            export.start()
+        except Exception:
+            reader.close()
+            raise
+        active_exports[lun] = export
+    active_backing[lun] = (backing, filename)
+    return backing
+
+def image_for_backing_file(backing):
+    """Inverse of backing_file_for(), so the UI shows the cue sheet instead of /dev/nbd0"""
+    for loaded, filename in active_backing.values():
+        if loaded == backing:
+            return filename
+    return backing
+
+def export_for(filename):
+    """The running NBD export serving filename on any LUN, if there is one"""
+    for export in active_exports.values():
+        if export.source == filename:
+            return export
+    return None
+
+### END OF BLOCK BACKEND ###
+
+### Beginning of Image Warm-up ###
+
+# Upper bounds so a huge directory tree or a hot cache can't turn warm-up into a full read
+warmup_max_directories = 256
+warmup_max_bytes = 8 * 1024 * 1024
+# Remember which parts of each image the host read last time and warm those too
+warmup_remember_hot_regions = True
+# Residency is checked one window at a time; mapping a whole DVD image at once fails on 32-bit userlands
+residency_window_bytes = 64 * 1024 * 1024
+
+def iso_warm_regions(reader):
+    """
+    (lba, count) runs a host reads first after insertion: the system area and
+    volume descriptors, each descriptor's path table and root directory, the
+    first sector of every directory in the path table, and the UDF anchor and
+    volume descriptor sequence.
+    """
+    regions = [(0, 16)]
+    lba = 16
+    while lba < min(reader.blocks, 16 + 32):
+        descriptor = reader.read(lba)
+        regions.append((lba, 1))
+        if len(descriptor) < iso_sector_size or descriptor[1:6] != b'CD001' or descriptor[0] == 255:
+            break
+        if descriptor[0] in (1, 2):
+            path_table_size = struct.unpack_from('<I', descriptor, 132)[0]
+            path_table_lba = struct.unpack_from('<I', descriptor, 140)[0]
+            root_lba = struct.unpack_from('<I', descriptor, 158)[0]
+            root_size = struct.unpack_from('<I', descriptor, 166)[0]
+            path_table_sectors = (path_table_size + iso_sector_size - 1) // iso_sector_size
+            regions.append((path_table_lba, path_table_sectors))
+            regions.append((root_lba, (root_size + iso_sector_size - 1) // iso_sector_size))
+            table = reader.read(path_table_lba, path_table_sectors)[:path_table_size]
+            position = 0
+            directories = 0
+            while position + 8 <= len(table) and directories < warmup_max_directories:
+                name_length = table[position]
+                if name_length == 0:
+                    break
+                regions.append((struct.unpack_from('<I', table, position + 2)[0], 1))
+                position += 8 + name_length + (name_length & 1)
+                directories += 1
+        lba += 1
+    if reader.blocks > 256:
+        anchor = reader.read(256)
+        regions.append((256, 1))
+        if struct.unpack_from('<H', anchor, 0)[0] == 2:
+            sequence_length, sequence_lba = struct.unpack_from('<II', anchor, 16)
+            regions.append((sequence_lba, (sequence_length + iso_sector_size - 1) // iso_sector_size))
+    return regions
+
+def merge_regions(regions, blocks):
+    """Sort, clip and coalesce (lba, count) runs, dropping whatever is past the warm-up byte budget"""
+    merged = []
+    for lba, count in sorted(regions):
+        count = min(count, blocks - lba)
+        if lba < 0 or count <= 0:
+            continue
+        if merged and lba <= merged[-1][0] + merged[-1][1]:
+            last_lba, last_count = merged[-1]
+            merged[-1] = (last_lba, max(last_count, lba + count - last_lba))
+        else:
+            merged.append((lba, count))
+    budget = warmup_max_bytes // iso_sector_size
+    limited = []
+    for lba, count in merged:
+        if budget <= 0:
+            break
+        limited.append((lba, min(count, budget)))
+        budget -= count
+    return limited
+
+class HotRegionStore:
+    """Per-image sector runs that were resident when the image was last swapped out, kept in the catalog database"""
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.lock = Lock()
+        self._db = None
+
+    def _open_db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.catalog.db_file, timeout=10, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS hot_regions (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, regions TEXT)")
+            self._db.commit()
+        return self._db
+
+    def _entry(self, path):
+        try:
+            name = os.path.relpath(path, self.catalog.root)
+        except ValueError:
+            return None
+        return self.catalog.get(name)
+
+    def get(self, path):
+        entry = self._entry(path)
+        if entry is None:
+            return []
+        try:
+            with self.lock:
+                row = self._open_db().execute("SELECT size, mtime, regions FROM hot_regions WHERE name = ?", (entry.name,)).fetchone()
+        except Exception as e:
+            logger.error(f"Failed to read hot regions of {entry.name}: {e}")
+            return []
+        if row is None or tuple(row[:2]) != (entry.size, entry.mtime):
+            return []
+        return [tuple(region) for region in json.loads(row[2])]
+
+    def put(self, path, regions):
+        entry = self._entry(path)
+        if entry is None:
+            return
+        try:
+            with self.lock:
+                db = self._open_db()
+                db.execute("INSERT OR REPLACE INTO hot_regions VALUES (?, ?, ?, ?)", (entry.name, entry.size, entry.mtime, json.dumps(regions)))
+                db.commit()
+        except Exception as e:
+            logger.error(f"Failed to save hot regions of {entry.name}: {e}")
+
+hot_region_store = None
+
+def resident_regions(reader):
+    """
+    Sector runs of an image that are currently cached: pages in the page
+    cache for plain ISOs (via mincore), decompressed blocks in the block cache
+    for compressed images. None when residency can't be determined.
+    """
+    if isinstance(reader, IsoSectorReader):
+        if reader.blocks == 0:
+            return []
+        total = reader.blocks * iso_sector_size
+        page_size = mmap.PAGESIZE
+        libc = ctypes.CDLL(None, use_errno=True)
+        resident = []
+        for offset in range(0, total, residency_window_bytes):
+            length = min(residency_window_bytes, total - offset)
+            pages = (length + page_size - 1) // page_size
+            mapping = mmap.mmap(reader.fd, length, access=mmap.ACCESS_COPY, offset=offset)
+            address = ctypes.c_char.from_buffer(mapping)
+            try:
+                vector = (ctypes.c_ubyte * pages)()
+                if libc.mincore(ctypes.c_void_p(ctypes.addressof(address)), ctypes.c_size_t(length), vector) != 0:
+                    return None
+                first_page = offset // page_size
+                resident += [first_page + page for page in range(pages) if vector[page] & 1]
+            finally:
+                del address
+                mapping.close()
+        sectors_per_page = page_size // iso_sector_size
+        return merge_regions([(page * sectors_per_page, sectors_per_page) for page in resident], reader.blocks)
+    if isinstance(reader, CompressedSectorReader):
+        block_size = reader.source.block_size
+        regions = []
+        for number in list(reader.cache.blocks):
+            first = max(0, (number * block_size - reader.data_offset) // reader.stride - reader.first_frame)
+            regions.append((first, block_size // reader.stride + 1))
+        return merge_regions(regions, reader.blocks)
+    return None
+
+def remember_hot_regions(filename):
+    """Record what the host read from an image before it is swapped out"""
+    if not warmup_remember_hot_regions or hot_region_store is None or not filename or not is_image_file(filename):
+        return
+    try:
+        export = export_for(filename)
+        if export is not None:
+            regions = resident_regions(export.reader)
+        else:
+            with open_sector_reader(filename) as reader:
+                regions = resident_regions(reader)
+        if regions is not None:
+            hot_region_store.put(filename, regions)
+    except Exception as e:
+        logger.warning(f"Could not record hot regions of {filename}: {e}")
+
+def warm_image(filename):
+    """
+    Pull the regions a host reads right after insertion into the page cache
+    (or the block cache of an NBD export) so the first commands don't wait on
+    the SD card. Runs before the image is written to lun.0/file.
+    """
+    start = time.monotonic()
+    reader = None
+    owned = False
+    try:
+        export = export_for(filename)
+        if export is not None:
+            reader = export.reader
+        else:
+            reader = open_sector_reader(filename)
+            owned = True
+        if reader is None:
+            return
+        regions = iso_warm_regions(reader)
+        remembered = hot_region_store.get(filename) if warmup_remember_hot_regions and hot_region_store is not None else []
+        regions = merge_regions(regions + remembered, reader.blocks)
+        if isinstance(reader, IsoSectorReader):
+            # Queue all the IO up front so the card sees one burst instead of a chain of dependent reads
+            for lba, count in regions:
+                os.posix_fadvise(reader.fd, lba * iso_sector_size, count * iso_sector_size, os.POSIX_FADV_WILLNEED)
+        total = 0
+        for lba, count in regions:
+            for offset in range(0, count, 64):
+                total += len(reader.read(lba + offset, min(64, count - offset)))
+        logger.info(f"Warmed {total // 1024} KB of {filename} in {len(regions)} runs ({len(remembered)} remembered) in {(time.monotonic() - start) * 1000:.0f} ms")
+    except Exception as e:
+        logger.warning(f"Warm-up of {filename} failed: {e}")
+    finally:
+        if owned and reader is not None:
+            reader.close()
+
+def start_warmup():
+    global hot_region_store
+    hot_region_store = HotRegionStore(image_catalog)
+
+### END OF IMAGE WARM-UP ###
+
+### Beginning of Image Upload ###
+
+upload_chunk_size = 1024 * 1024
+# Uploads are synced to the card at least this often, so a power cut loses at most this much
+upload_sync_bytes = 4 * 1024 * 1024
+# How long a switch to exFAT waits for uploads and extractions to stop writing to the store
+store_writer_drain_seconds = 10
+# Write bandwidth for uploads while the host is idle and while it is reading from the card
+upload_rate_idle = 24 * 1024 * 1024
+upload_rate_busy = 2 * 1024 * 1024
+
+class UploadThrottle:
+    """
+    Token bucket shared by all uploads. The refill rate drops whenever the
+    USB host is reading from the card so uploads don't starve the CD drive.
+    """
+
+    def __init__(self, device):
+        self.monitor = HostActivityMonitor(device)
+        self.rate = upload_rate_idle
+        self.tokens = float(upload_chunk_size)
+        self.last = time.monotonic()
+        self.checked = 0
+        self.lock = Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.checked >= 0.5:
+                self.rate = upload_rate_busy if self.monitor.host_active() else upload_rate_idle
+                self.checked = now
+            self.tokens = min(float(upload_chunk_size), self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= count
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+upload_throttle = UploadThrottle(store_dev)
+upload_locks = {}
+upload_locks_lock = Lock()
+
+class StoreExported(Exception):
+    """The store is, or is about to be, handed to the host, so the Pi must not write to it"""
+
+# Uploads and extractions writing to the store. A switch to exFAT blocks new
+# writers, waits for the running ones to stop and only then exports the store,
+# because two writers on one exFAT filesystem corrupt it.
+store_writers = 0
+store_writes_blocked = False
+store_writers_condition = threading.Condition()
+
+@contextmanager
+def store_writer():
+    global store_writers
+    with store_writers_condition:
+        if store_writes_blocked or store_exported():
+            raise StoreExported("The image store is exported to the host in exFAT mode")
+        store_writers += 1
+    try:
+        yield
+    finally:
+        with store_writers_condition:
+            store_writers -= 1
+            store_writers_condition.notify_all()
+
+def check_store_writable():
+    """Called by writers between chunks, so they stop as soon as a switch to exFAT begins"""
+    if store_writes_blocked or store_exported():
+        raise StoreExported("Switching to exFAT mode, the write was abandoned")
+
+def block_store_writes(timeout=store_writer_drain_seconds):
+    """Refuse new writers and wait for running ones to stop; False if some are still writing after timeout"""
+    global store_writes_blocked
+    with store_writers_condition:
+        store_writes_blocked = True
+        return store_writers_condition.wait_for(lambda: store_writers == 0, timeout)
+
+def allow_store_writes():
+    global store_writes_blocked
+    with store_writers_condition:
+        store_writes_blocked = False
+
+def upload_name(name):
+    """
+    Normalized catalog name for an upload target, or ValueError if it isn't an
+    image inside the store. The BIN/IMG/SUB/WAV files a cue sheet points at
+    are accepted as well, like the companions kept from archives.
+    """
+    path = store_path(name)
+    if not (is_image_file(os.path.basename(path)) or path.lower().endswith(archive_companion_extensions)):
+        raise ValueError(f"{name} is not a supported image type")
+    return os.path.relpath(path, store_mnt)
+
+def upload_part_file(name):
+    return store_path(name) + '.part'
+
+def upload_offset(name):
+    """Bytes received so far for an upload, i.e. where the client should resume"""
+    try:
+        return os.path.getsize(upload_part_file(name))
+    except FileNotFoundError:
+        return 0
+
+def upload_lock(name):
+    with upload_locks_lock:
+        return upload_locks.setdefault(name, Lock())
+
+def write_upload_chunk(name, offset, stream):
+    """
+    Append one request body to an upload's .part file at offset. The body is
+    streamed in small pieces and synced to the card every few MB and before
+    returning, so an acknowledged offset survives a power cut and a cut in
+    the middle of a long body loses little. Returns the new offset.
+    """
+    part = upload_part_file(name)
+    os.makedirs(os.path.dirname(part), exist_ok=True)
+    fd = os.open(part, os.O_WRONLY | os.O_CREAT, 0o666)
+    try:
+        # A retried chunk may overlap data that was written but never acknowledged
+        os.ftruncate(fd, offset)
+        unsynced = 0
+        while True:
+            data = stream.read(upload_chunk_size)
+            if not data:
+                break
+            check_store_writable()
+            upload_throttle.consume(len(data))
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(fd, view, offset)
+                offset += written
+                unsynced += written
+                view = view[written:]
+            if unsynced >= upload_sync_bytes:
+                os.fsync(fd)
+                unsynced = 0
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return offset
+
+def finish_upload(name, size=None, sha1=None, md5=None, crc32=None):
+    """
+    Verify a completed .part file against the checksums the client sent, move
+    it into place and add it to the catalog. Returns a list of mismatch
+    descriptions, empty on success.
+    """
+    part = upload_part_file(name)
+    actual_size = os.path.getsize(part)
+    if size is not None and actual_size != size:
+        return [f"size is {actual_size}, expected {size}"]
+    sha1_hash, md5_hash, crc = hashlib.sha1(), hashlib.md5(), 0
+    with open(part, 'rb') as f:
+        while True:
+            data = f.read(hash_chunk_size)
+            if not data:
+                break
+            check_store_writable()
+            upload_throttle.consume(len(data))
+            sha1_hash.update(data)
+            md5_hash.update(data)
+            crc = zlib.crc32(data, crc)
+    errors = []
+    for label, expected, actual in (('sha1', sha1, sha1_hash.hexdigest()), ('md5', md5, md5_hash.hexdigest()), ('crc32', crc32, f"{crc:08x}")):
+        if expected is not None and expected.lower() != actual:
+            errors.append(f"{label} is {actual}, expected {expected.lower()}")
+    if errors:
+        return errors
+    check_store_writable()
+    os.rename(part, store_path(name))
+    directory = os.open(os.path.dirname(part), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+    image_catalog.update_file(name)
+    logger.info(f"Upload of {name} complete, {actual_size} bytes")
+    return []
+
+### END OF IMAGE UPLOAD ###
+
+### Beginning of Archive Extraction ###
+
+# Extracted alongside images so cue sheets and their tracks stay together
+archive_companion_extensions = ('.bin', '.img', '.sub', '.wav')
+zip_local_header = struct.Struct('<IHHHHHIIIHH')
+zip_local_signature = 0x04034b50
+zip_descriptor_signature = 0x08074b50
+sevenzip_signature = b'7z\xbc\xaf\x27\x1c'
+
+class StreamBuffer:
+    """Reads exact byte counts from a request stream, with push-back for data a decompressor read past its end"""
+
+    def __init__(self, stream, job):
+        self.stream = stream
+        self.job = job
+        self.pending = b''
+
+    def read(self, count):
+        if self.pending:
+            data, self.pending = self.pending[:count], self.pending[count:]
+            return data
+        data = self.stream.read(count)
+        self.job.received += len(data)
+        return data
+
+    def read_exact(self, count):
+        data = b''
+        while len(data) < count:
+            piece = self.read(count - len(data))
+            if not piece:
+                raise ValueError("archive is truncated")
+            data += piece
+        return data
+
+    def unread(self, data):
+        self.pending = data + self.pending
+
+class ExtractJob:
+    """Progress of one archive extraction, as reported by /extract"""
+
+    def __init__(self, id, folder):
+        self.id = id
+        self.folder = folder
+        self.state = 'running'
+        self.received = 0
+        self.member = None
+        self.member_bytes = 0
+        self.extracted = []
+        self.skipped = []
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+
+    def as_dict(self):
+        return {'id': self.id, 'folder': self.folder, 'state': self.state, 'received': self.received,
+                'member': self.member, 'member_bytes': self.member_bytes, 'extracted': self.extracted,
+                'skipped': self.skipped, 'error': self.error, 'started': self.started, 'finished': self.finished}
+
+extract_jobs = OrderedDict()
+extract_jobs_lock = Lock()
+extract_next_id = 1
+
+def wanted_archive_member(name):
+    return is_image_file(os.path.basename(name)) or name.lower().endswith(archive_companion_extensions)
+
+def zip_member_decompressor(method):
+    if method == 8:
+        return zlib.decompressobj(-15)
+    if method == 12:
+        return bz2.BZ2Decompressor()
+    return None
+
+def extract_zip_member(source, header, name, target, job):
+    """Copy one member's data from the stream to target (or nowhere when target is None), checking its CRC"""
+    signature, version, flags, method, mtime, mdate, crc, compressed, size, name_length, extra_length = header
+    if flags & 1:
+        raise ValueError(f"{name} is encrypted")
+    if method not in (0, 8, 12):
+        raise ValueError(f"{name} uses unsupported compression method {method}")
+    extra = source.read_exact(extra_length)
+    zip64 = False
+    position = 0
+    while position + 4 <= len(extra):
+        tag, length = struct.unpack_from('<HH', extra, position)
+        if tag == 0x0001:
+            zip64 = True
+            fields = extra[position + 4:position + 4 + length]
+            if size == 0xFFFFFFFF and len(fields) >= 8:
+                size = struct.unpack_from('<Q', fields, 0)[0]
+                fields = fields[8:]
+            if compressed == 0xFFFFFFFF and len(fields) >= 8:
+                compressed = struct.unpack_from('<Q', fields, 0)[0]
+        position += 4 + length
+    streamed = bool(flags & 8)
+    if streamed and method == 0:
+        raise ValueError(f"{name} is stored without sizes and can't be streamed")
+    decompressor = zip_member_decompressor(method)
+    fd = None
+    if target is not None:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd = os.open(target + '.part', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        actual_crc = 0
+        offset = 0
+        remaining = None if streamed else compressed
+        while remaining is None or remaining > 0:
+            data = source.read(upload_chunk_size if remaining is None else min(upload_chunk_size, remaining))
+            if not data:
+                raise ValueError(f"archive ends inside {name}")
+            if remaining is not None:
+                remaining -= len(data)
+            if decompressor is not None:
+                output = decompressor.decompress(data)
+                if decompressor.eof:
+                    source.unread(decompressor.unused_data)
+                    remaining = 0
+            else:
+                output = data
+            actual_crc = zlib.crc32(output, actual_crc)
+            if fd is not None and output:
+                check_store_writable()
+                upload_throttle.consume(len(output))
+                view = memoryview(output)
+                while view:
+                    written = os.pwrite(fd, view, offset + len(output) - len(view))
+                    view = view[written:]
+            offset += len(output)
+            job.member_bytes = offset
+        if streamed:
+            descriptor = source.read_exact(4)
+            if struct.unpack('<I', descriptor)[0] == zip_descriptor_signature:
+                descriptor = source.read_exact(4)
+            crc = struct.unpack('<I', descriptor)[0]
+            source.read_exact(16 if zip64 else 8)
+        if actual_crc != crc:
+            raise ValueError(f"CRC mismatch in {name}")
+        if fd is not None:
+            os.fsync(fd)
+    except Exception:
+        if fd is not None:
+            os.close(fd)
+            fd = None
+            os.remove(target + '.part')
+        raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+    if target is not None:
+        check_store_writable()
+        os.rename(target + '.part', target)
+
+def extract_zip_stream(source, folder, job):
+    """
+    Walk a ZIP archive front to back through its local headers, writing each
+    image (and the tracks that go with it) straight to its place in the store
+    and publishing it to the catalog as soon as it is complete.
+    """
+    while True:
+        signature = source.read(4)
+        if len(signature) < 4 or struct.unpack('<I', signature)[0] != zip_local_signature:
+            # Central directory or end of archive: every member has been seen
+            break
+        header = zip_local_header.unpack(signature + source.read_exact(zip_local_header.size - 4))
+        flags, name_length = header[2], header[9]
+        raw_name = source.read_exact(name_length)
+        member = raw_name.decode('utf-8' if flags & 0x800 else 'cp437', 'replace')
+        target = None
+        if not member.endswith('/') and wanted_archive_member(member):
+            name = os.path.relpath(store_path(os.path.join(folder, member)), store_mnt)
+            target = store_path(name)
+        job.member, job.member_bytes = member, 0
+        extract_zip_member(source, header, member, target, job)
+        if target is None:
+            if not member.endswith('/'):
+                job.skipped.append(member)
+            continue
+        job.extracted.append(name)
+        image_catalog.update_file(name)
+        logger.info(f"Extracted {name} ({job.member_bytes} bytes)")
+    # Drain the central directory so the client sees a clean response
+    while source.read(upload_chunk_size):
+        pass
+
+def extract_7z_stream(source, folder, job):
+    """
+    7z keeps its index at the end of the archive, so it can't be unpacked
+    while streaming; the archive is staged next to its destination and
+    unpacked with the 7z tool at idle IO priority, then removed.
+    """
+    directory = store_path(folder) if folder else store_mnt
+    os.makedirs(directory, exist_ok=True)
+    staged = os.path.join(directory, f".usbode-extract-{job.id}.7z")
+    try:
+        with open(staged, 'wb') as f:
+            while True:
+                data = source.read(upload_chunk_size)
+                if not data:
+                    break
+                check_store_writable()
+                upload_throttle.consume(len(data))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        listing = subprocess.run(['7z', 'l', '-slt', '-ba', staged], capture_output=True, text=True)
+        members = [line[7:] for line in listing.stdout.splitlines() if line.startswith('Path = ')]
+        wanted = {}
+        for member in members:
+            if wanted_archive_member(member):
+                # Checked before anything is unpacked, so a member can't land outside the destination folder
+                path = os.path.normpath(os.path.join(directory, member))
+                if path.startswith(directory + '/'):
+                    wanted[member] = os.path.relpath(path, store_mnt)
+                else:
+                    logger.warning(f"Skipping {member}, it is outside of {directory}")
+        job.skipped = [member for member in members if member not in wanted]
+        if not wanted:
+            return
+        job.member = ', '.join(wanted)
+        # -spd: member names are literal, so a name containing * ? or [ can't match other members
+        command = ['ionice', '-c', '3', '7z', 'x', '-y', '-spd', f'-o{directory}', staged, '--'] + list(wanted)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=0.5)
+                break
+            except subprocess.TimeoutExpired:
+                if store_writes_blocked:
+                    process.kill()
+                    process.communicate()
+                    check_store_writable()
+        if process.returncode != 0:
+            raise ValueError(f"7z failed: {stderr.strip() or stdout.strip()}")
+        for name in wanted.values():
+            job.extracted.append(name)
+            image_catalog.update_file(name)
+    finally:
+        if os.path.exists(staged):
+            os.remove(staged)
+
+def extract_archive(stream, folder):
+    """Extract a ZIP or 7z archive arriving on stream into folder of the store, returning its ExtractJob"""
+    global extract_next_id
+    with extract_jobs_lock:
+        job = ExtractJob(str(extract_next_id), folder)
+        extract_next_id += 1
+        extract_jobs[job.id] = job
+        while len(extract_jobs) > 20:
+            extract_jobs.popitem(last=False)
+    source = StreamBuffer(stream, job)
+    thread_id = str(threading.get_native_id())
+    subprocess.run(['ionice', '-c', '3', '-p', thread_id], capture_output=True)
+    try:
+        magic = source.read_exact(6)
+        source.unread(magic)
+        if magic == sevenzip_signature:
+            extract_7z_stream(source, folder, job)
+        elif struct.unpack_from('<I', magic)[0] == zip_local_signature:
+            extract_zip_stream(source, folder, job)
+        else:
+            raise ValueError("not a ZIP or 7z archive")
+        job.state = 'done'
+    except Exception as e:
+        job.state = 'failed'
+        job.error = str(e)
+        logger.error(f"Extraction into {folder or store_mnt} failed: {e}")
+    finally:
+        job.member = None
+        job.finished = time.time()
+        # Request threads may be reused, so drop back to the default IO class
+        subprocess.run(['ionice', '-c', '0', '-p', thread_id], capture_output=True)
+    return job
+
+### END OF ARCHIVE EXTRACTION ###
+
+### Beginning of Cover Art ###
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+thumbs_folder = '/opt/usbode/thumbs'
+thumb_cache_bytes = 8 * 1024 * 1024
+thumb_panel_size = 40
+thumb_web_size = 96
+# Where the tile sits on the ST7789 file picker, clear of the text and the button bar
+thumb_panel_position = (196, 148)
+st7789_rotation = 90
+sidecar_extensions = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+def find_sidecar(path):
+    """Cover image stored next to an image as game.png or game.iso.png"""
+    stems = [path, os.path.splitext(path)[0]]
+    if path.lower().endswith('.iso.gz'):
+        stems.append(path[:-7])
+    for stem in stems:
+        for extension in sidecar_extensions:
+            for candidate in (stem + extension, stem + extension.upper()):
+                if os.path.isfile(candidate):
+                    return candidate
+    return None
+
+def iso_find_file(reader, path):
+    """(lba, size) of a file in the ISO9660 tree, matching names case-insensitively and without ';1' versions"""
+    descriptor = reader.read(16)
+    if descriptor[1:6] != b'CD001' or descriptor[0] != 1:
+        return None
+    lba, size = struct.unpack_from('<I', descriptor, 158)[0], struct.unpack_from('<I', descriptor, 166)[0]
+    parts = [part for part in path.upper().replace('\\', '/').split('/') if part]
+    for depth, part in enumerate(parts):
+        directory = reader.read(lba, min((size + iso_sector_size - 1) // iso_sector_size, 16))
+        position = 0
+        found = None
+        while position < len(directory):
+            length = directory[position]
+            if length == 0:
+                # Records never straddle sectors; skip the padding to the next one
+                position = (position // iso_sector_size + 1) * iso_sector_size
+                continue
+            name_length = directory[position + 32]
+            name = directory[position + 33:position + 33 + name_length].decode('ascii', 'replace').split(';')[0].rstrip('.')
+            if name.upper() == part:
+                found = struct.unpack_from('<I', directory, position + 2)[0], struct.unpack_from('<I', directory, position + 10)[0], directory[position + 25] & 2
+                break
+            position += length
+        if found is None or bool(found[2]) != (depth < len(parts) - 1):
+            return None
+        lba, size = found[0], found[1]
+    return lba, size
+
+def read_autorun_icon(path):
+    """The .ico named by an image's autorun.inf, as a PIL image"""
+    reader = open_sector_reader(path)
+    if reader is None:
+        return None
+    with reader:
+        location = iso_find_file(reader, 'AUTORUN.INF')
+        if location is None or location[1] > 64 * 1024:
+            return None
+        text = reader.read(location[0], (location[1] + iso_sector_size - 1) // iso_sector_size)[:location[1]].decode('latin-1')
+        icon = None
+        section = None
+        for line in text.splitlines():
+            line = line.split(';', 1)[0].strip()
+            if line.startswith('['):
+                section = line.strip('[]').strip().lower()
+            elif section == 'autorun' and '=' in line:
+                key, value = line.split('=', 1)
+                if key.strip().lower() == 'icon':
+                    icon = value.split(',', 1)[0].strip().strip('"')
+        # Icons inside executables would need a PE resource parser; only plain .ico files are used
+        if not icon or not icon.lower().endswith('.ico'):
+            return None
+        location = iso_find_file(reader, icon)
+        if location is None or location[1] > 1024 * 1024:
+            return None
+        data = reader.read(location[0], (location[1] + iso_sector_size - 1) // iso_sector_size)[:location[1]]
+    return Image.open(io.BytesIO(data))
+
+def cover_art(path):
+    """Cover art for an image from a sidecar file or its autorun icon, or None"""
+    sidecar = find_sidecar(path)
+    if sidecar is not None:
+        return Image.open(sidecar)
+    return read_autorun_icon(path)
+
+def fit_image(art, size, background):
+    art = art.convert('RGBA')
+    art.thumbnail((size, size))
+    tile = Image.new('RGB', (size, size), background)
+    tile.paste(art, ((size - art.width) // 2, (size - art.height) // 2), art)
+    return tile
+
+def rgb565_tile(art, size, rotation):
+    """Big-endian RGB565 pixels laid out the way the ST7789 driver sends a frame, so a tile is blitted as is"""
+    tile = fit_image(art, size, (255, 255, 255)).rotate(rotation, expand=True)
+    return b''.join(struct.pack('>H', ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)) for r, g, b in tile.getdata())
+
+def blit_panel_tile(display, tile, x, y, size):
+    """Draw a pre-rendered tile at (x, y) of the unrotated frame without redrawing the screen"""
+    width, height = display.width, display.height
+    k = (st7789_rotation // 90) % 4
+    if k == 0:
+        x0, y0 = x, y
+    elif k == 1:
+        x0, y0 = y, width - x - size
+    elif k == 2:
+        x0, y0 = width - x - size, height - y - size
+    else:
+        x0, y0 = height - y - size, x
+    with display_flush_seconds.time('st7789_tile'):
+        display.set_window(x0, y0, x0 + size - 1, y0 + size - 1)
+        for i in range(0, len(tile), 4096):
+            display.data(tile[i:i + 4096])
+
+class ThumbnailStore:
+    """
+    Disk cache of cover art: an RGB565 tile for the ST7789 picker and a small
+    JPEG for /list, per version of each image. Images without art get an
+    empty marker so they aren't searched again. The least recently used files
+    are evicted once the cache outgrows thumb_cache_bytes.
+    """
+
+    def __init__(self, catalog, folder):
+        self.catalog = catalog
+        self.folder = folder
+        self.known = {}
+        self.version = 0
+        self.lock = Lock()
+        self.pending = []
+        self.pending_event = Event()
+
+    def _key(self, name):
+        entry = self.catalog.get(name)
+        if entry is None:
+            return None
+        identity = f"{name}\0{entry.size}\0{entry.mtime}\0{thumb_panel_size}\0{st7789_rotation}"
+        sidecar = find_sidecar(os.path.join(self.catalog.root, name))
+        if sidecar is not None:
+            identity += f"\0{sidecar}\0{os.path.getmtime(sidecar)}"
+        return hashlib.sha1(identity.encode()).hexdigest()[:24]
+
+    def _file(self, key, extension):
+        return os.path.join(self.folder, key + extension)
+
+    def state(self, name):
+        """'ready', 'none', or None when the image hasn't been looked at yet"""
+        entry = self.catalog.get(name)
+        known = self.known.get(name)
+        if entry is None or known is None or known[:2] != (entry.size, entry.mtime):
+            return None
+        return known[3]
+
+    def render(self, name):
+        key = self._key(name)
+        if key is None:
+            return None
+        entry = self.catalog.get(name)
+        if os.path.exists(self._file(key, '.tile')) and os.path.exists(self._file(key, '.jpg')):
+            state = 'ready'
+        elif os.path.exists(self._file(key, '.none')):
+            state = 'none'
+        else:
+            state = 'none'
+            try:
+                art = cover_art(os.path.join(self.catalog.root, name)) if Image is not None else None
+            except Exception as e:
+                logger.warning(f"Could not read cover art for {name}: {e}")
+                art = None
+            os.makedirs(self.folder, exist_ok=True)
+            if art is not None:
+                fit_image(art, thumb_web_size, (255, 255, 255)).save(self._file(key, '.jpg'), 'JPEG', quality=80)
+                with open(self._file(key, '.tile.tmp'), 'wb') as f:
+                    f.write(rgb565_tile(art, thumb_panel_size, st7789_rotation))
+                os.rename(self._file(key, '.tile.tmp'), self._file(key, '.tile'))
+                state = 'ready'
+            else:
+                open(self._file(key, '.none'), 'w').close()
+            self.evict()
+        with self.lock:
+            self.known[name] = (entry.size, entry.mtime, key, state)
+            self.version += 1
+        return state
+
+    def _ready_file(self, name, extension):
+        if self.state(name) is None:
+            self.render(name)
+        known = self.known.get(name)
+        if known is None or known[3] != 'ready':
+            return None
+        path = self._file(known[2], extension)
+        try:
+            # mtime doubles as the LRU clock for eviction
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.known.pop(name, None)
+            return None
+        return path
+
+    def panel_tile(self, name):
+        """RGB565 tile for the ST7789, or None if the image has no art or it hasn't been rendered yet"""
+        if self.state(name) != 'ready':
+            self.prefetch([name])
+            return None
+        path = self._ready_file(name, '.tile')
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def web_jpeg(self, name):
+        """Path of the web thumbnail, rendering it first if needed"""
+        return self._ready_file(name, '.jpg')
+
+    def evict(self):
+        """
+        Drop the least recently used keys, all of their files at once: the tile
+        and the JPEG are touched by different readers, so evicting them one
+        file at a time would leave half a pair behind.
+        """
+        groups = {}
+        try:
+            for file in os.listdir(self.folder):
+                if file.endswith('.tmp'):
+                    continue
+                key = file.split('.', 1)[0]
+                path = os.path.join(self.folder, file)
+                st = os.stat(path)
+                mtime, size, paths = groups.get(key, (0, 0, []))
+                groups[key] = (max(mtime, st.st_mtime), size + st.st_size, paths + [path])
+        except OSError:
+            return
+        total = sum(size for mtime, size, paths in groups.values())
+        for mtime, size, paths in sorted(groups.values()):
+            if total <= thumb_cache_bytes:
+                break
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+        with self.lock:
+            for name, known in list(self.known.items()):
+                if known[3] == 'ready' and not (os.path.exists(self._file(known[2], '.tile'))
+                                                and os.path.exists(self._file(known[2], '.jpg'))):
+                    del self.known[name]
+
+    def forget(self, changed, removed):
+        # Catalog listener: the next lookup recomputes the key for changed images
+        with self.lock:
+            for name in list(changed) + list(removed):
+                self.known.pop(name, None)
+
+    def prefetch(self, names):
+        missing = [name for name in names if self.state(name) is None]
+        if missing:
+            with self.lock:
+                self.pending.extend(missing)
+            self.pending_event.set()
+
+    def worker(self):
+        while not exitRequested:
+            self.pending_event.wait()
+            with self.lock:
+                names, self.pending = self.pending, []
+                self.pending_event.clear()
+            for name in names:
+                if self.state(name) is None:
+                    try:
+                        self.render(name)
+                    except Exception as e:
+                        logger.error(f"Failed to render thumbnail for {name}: {e}")
+
+thumbnail_store = ThumbnailStore(image_catalog, thumbs_folder)
+image_catalog.add_listener(thumbnail_store.forget)
+
+def start_thumbnails():
+    daemonThumbnails = Thread(target=thumbnail_store.worker, daemon=True, name='Thumbnails')
+    daemonThumbnails.start()
+    logger.info("Thumbnail thread started")
+
+### END OF COVER ART ###
+    
+### Beginning of Configfs Gadget ###
+
+udc_class_folder = '/sys/class/udc'
+# How long to wait for configfs and the UDC to reflect a change before giving up
+gadget_settle_timeout = 2
+gadget_poll_interval = 0.005
+
+# Device descriptors and LUN settings for each mode
+gadget_profiles = {
+    'cdrom': {
+        'idVendor': '0x04da',   # Panasonic
+        'idProduct': '0x0d01',  # USB CD-ROM Drive KXL-840AN (increases compability with many retro systems)
+        'product': 'USBODE-v1.99',
+        'configuration': 'Config 1: USBODE',
+        'cdrom': '1',
+        'ro': '1',
+    },
+    'exfat': {
+        'idVendor': '0x0525',   # Linux Foundation - must be adopted by your ID
+        'idProduct': '0xa4a5',  # Linux-USB file backed Storage Gadget - must be adopted by your ProductID
+        'product': 'USBODE-v1.99-ExFAT',
+        'configuration': 'Config 1: USBODE-USB',
+        'cdrom': '0',
+        'ro': '0',
+    },
+}
+
+def wait_for(condition, timeout=gadget_settle_timeout):
+    """Poll condition until it holds, returning False if it still does not after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(gadget_poll_interval)
+    return True
+
+class ConfigfsGadget:
+    """
+    A mass storage gadget under /sys/kernel/config/usb_gadget, built, torn
+    down and bound with plain file operations instead of shell scripts
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.function = f"{path}/functions/mass_storage.usb0"
+        self.lun = self.lun_path(0)
+        self.config = f"{path}/configs/c.1"
+
+    def lun_path(self, lun):
+        return f"{self.function}/lun.{lun}"
+
+    def write(self, name, value):
+        with open(f"{self.path}/{name}", "w") as f:
+            f.write(f"{value}\n")
+
+    def read(self, name):
+        return read_sysfs(f"{self.path}/{name}")
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def build(self, profile, luns=1):
+        """Create the gadget with luns LUNs; the kernel makes lun.0 with the function, the others are made here"""
+        settings = gadget_profiles[profile]
+        for folder in ("strings/0x409", "configs/c.1/strings/0x409", "functions/mass_storage.usb0"):
+            os.makedirs(f"{self.path}/{folder}", exist_ok=True)
+        for lun in range(1, luns):
+            os.makedirs(self.lun_path(lun), exist_ok=True)
+        self.write("idVendor", settings['idVendor'])
+        self.write("idProduct", settings['idProduct'])
+        self.write("bcdDevice", "0x0100")  # v1.0.0
+        self.write("bcdUSB", "0x0200")     # USB 2.0
+        self.write("strings/0x409/serialnumber", "1111111111")
+        self.write("strings/0x409/manufacturer", "Linux")
+        self.write("strings/0x409/product", settings['product'])
+        self.write("configs/c.1/strings/0x409/configuration", settings['configuration'])
+        self.write("configs/c.1/MaxPower", "0")
+        for lun in range(luns):
+            self.write(f"functions/mass_storage.usb0/lun.{lun}/cdrom", settings['cdrom'])
+            self.write(f"functions/mass_storage.usb0/lun.{lun}/ro", settings['ro'])
+            self.write(f"functions/mass_storage.usb0/lun.{lun}/removable", "1")
+        link = f"{self.config}/mass_storage.usb0"
+        if not os.path.islink(link):
+            os.symlink(self.function, link)
+
+    def teardown(self):
+        """Remove the gadget, children first as configfs requires; missing pieces are skipped"""
+        # lun.0 goes away with the function, extra changer LUNs have to be removed first
+        try:
+            extra_luns = [name for name in os.listdir(self.function) if name.startswith("lun.") and name != "lun.0"]
+        except FileNotFoundError:
+            extra_luns = []
+        steps = ((os.unlink, f"{self.config}/mass_storage.usb0"), (os.rmdir, f"{self.config}/strings/0x409"),
+                 (os.rmdir, self.config)) + tuple((os.rmdir, f"{self.function}/{name}") for name in extra_luns) + \
+                ((os.rmdir, self.function), (os.rmdir, f"{self.path}/strings/0x409"), (os.rmdir, self.path))
+        for remove, path in steps:
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+        if not wait_for(lambda: not self.exists()):
+            raise OSError(errno.EBUSY, f"{self.path} is still present")
+
+    def bound(self):
+        return self.read("UDC") != ""
+
+    def bind(self):
+        controllers = sorted(os.listdir(udc_class_folder))
+        if not controllers:
+            raise OSError(errno.ENODEV, f"No USB device controller in {udc_class_folder}")
+        self.write("UDC", controllers[0])
+        if not wait_for(lambda: self.read("UDC") == controllers[0]):
+            raise OSError(errno.ETIMEDOUT, f"{controllers[0]} did not bind to {self.path}")
+
+    def unbind(self):
+        if self.bound():
+            self.write("UDC", "")
+            if not wait_for(lambda: not self.bound()):
+                raise OSError(errno.ETIMEDOUT, f"{self.path} did not unbind")
+
+    def eject(self, lun=0):
+        self.write(f"functions/mass_storage.usb0/lun.{lun}/forced_eject", "1")
+        if not wait_for(lambda: self.read(f"functions/mass_storage.usb0/lun.{lun}/file") == ""):
+            raise OSError(errno.ETIMEDOUT, f"{self.lun_path(lun)} did not eject")
+
+# Both are built at startup; only the one matching the mode is bound to the UDC
+gadgets = {'cdrom': ConfigfsGadget(gadgetCDFolder), 'exfat': ConfigfsGadget(gadgetExfatFolder)}
+gadgets_staged = False
+
+def stage_gadgets():
+    """Build the CD-ROM and exFAT gadgets once, so switching modes only moves the UDC between them"""
+    global gadgets_staged
+    for profile, staged in gadgets.items():
+        with job_stage(f'stage {profile}'):
+            # Leftovers from a previous run may still be bound
+            staged.unbind()
+            cleanupMode(staged.path)
+            staged.build(profile, changer_luns if profile == 'cdrom' else 1)
+    gadgets['exfat'].write("functions/mass_storage.usb0/lun.0/file", store_dev)
+    gadgets_staged = True
+
+### END OF CONFIGFS GADGET ###
+
+### Beginning of Disc Changer ###
+
+# With changer=N in usbode.conf the CD-ROM gadget has N LUNs, each a drive with
+# its own image, so hosts that handle multi-LUN devices change discs without
+# an eject and reload. usbode-iso.txt remembers one image per line, LUN 0 first.
+
+def changer_lun(lun):
+    """lun as an int, raising ValueError if the changer has no such LUN"""
+    try:
+        lun = int(lun)
+    except (TypeError, ValueError):
+        raise ValueError(f"{lun!r} is not a disc number")
+    if not 0 <= lun < changer_luns:
+        raise ValueError(f"There is no disc {lun}, the changer has {changer_luns} LUNs")
+    return lun
+
+def saved_discs():
+    """Image remembered for each LUN, '' for an empty one"""
+    discs = []
+    if os.path.exists(iso_mount_file):
+        with open(iso_mount_file, "r") as f:
+            discs = [line.strip() for line in f]
+    return (discs + [''] * changer_luns)[:changer_luns]
+
+def save_disc(lun, filename):
+    discs = saved_discs()
+    discs[lun] = filename
+    with open(iso_mount_file, "w") as f:
+        f.write("".join(f"{disc}\n" for disc in discs))
+
+def eject_disc(lun):
+    """Empty one LUN and forget its image, leaving the other discs loaded"""
+    if checkState() == 1 and gadget_state.discs[lun]:
+        with job_stage('eject'):
+            remember_hot_regions(gadget_state.discs[lun])
+            gadgets['cdrom'].eject(lun)
+            release_backing_file(lun)
+    save_disc(lun, '')
+    logger.info(f"Ejected disc {lun}")
+    gadget_state_changed()
+    signal_update()
+
+### END OF DISC CHANGER ###
+
+### Beginning of Gadget State ###
+
+# checkState(), getMountedCDName() and the status pages read this snapshot
+# instead of sysfs. The code that changes configfs refreshes it, and a watcher
+# re-reads sysfs every few seconds to catch changes made outside USBODE.
+gadget_state_poll_seconds = 2
+
+# backing and image are those of LUN 0, discs holds the image of every LUN
+GadgetState = namedtuple('GadgetState', 'mode udc backing image discs')
+
+gadget_state = GadgetState(0, '', '', '', ('',) * changer_luns)
+gadget_state_lock = Lock()
+gadget_state_version = 0
+
+def read_gadget_state():
+    mode, udc = 0, ''
+    for gadget_mode, path in ((1, gadgetCDFolder), (2, gadgetExfatFolder)):
+        udc = read_sysfs(path + "/UDC")
+        if udc:
+            mode = gadget_mode
+            break
+    backings = [read_sysfs(f"{gadgetCDFolder}/functions/mass_storage.usb0/lun.{lun}/file") for lun in range(changer_luns)]
+    discs = tuple(image_for_backing_file(backing) if backing else '' for backing in backings)
+    return GadgetState(mode, udc, backings[0], discs[0], discs)
+
+def refresh_gadget_state():
+    """Re-read the gadget from sysfs, returning True if it differed from the snapshot"""
+    global gadget_state
+    with gadget_state_lock:
+        state = read_gadget_state()
+        changed = state != gadget_state
+        gadget_state = state
+    return changed
+
+def gadget_state_changed():
+    """Refresh the snapshot after changing the gadget and bump the version the API's ETags are built from"""
+    global gadget_state_version
+    refresh_gadget_state()
+    gadget_state_version += 1
+    event_hub.wake.set()
+
+def watch_gadget_state():
+    global gadget_state_version
+    while not exitRequested:
+        time.sleep(gadget_state_poll_seconds)
+        # A running job refreshes the snapshot itself after each step
+        if gadget_jobs.current is not None:
+            continue
+        with gadget_jobs.gadget_lock:
+            previous = gadget_state
+            if not refresh_gadget_state():
+                continue
+            # The host ejected a disc itself, so nothing reads the export behind it any more
+            for lun, (before, now) in enumerate(zip(previous.discs, gadget_state.discs)):
+                if before and not now:
+                    release_backing_file(lun)
+        logger.warning(f"Gadget changed outside USBODE, now mode {gadget_state.mode} serving {gadget_state.image or 'nothing'}")
+        gadget_state_version += 1
+        signal_update()
+
+def start_gadget_state():
+    refresh_gadget_state()
+    Thread(target=watch_gadget_state, daemon=True, name='Gadget State').start()
+
+### END OF GADGET STATE ###
+
+### Beginning of Gadget Jobs ###
+
+# Every configfs change (mounts, mode switches, the boot-time setup) is a job run
+# by one worker thread. Web handlers and buttons queue a job and return, a job
+# replaces the queued ones it makes pointless, and a failed job is rolled back.
+gadget_jobs_kept = 50
+# Kinds where only the newest of several queued jobs in a row needs to run, by what they change;
+# mounts and ejects of the same disc replace each other
+gadget_coalesced_kinds = {'mount': 'disc', 'eject': 'disc', 'mode': 'mode'}
+
+GadgetSnapshot = namedtuple('GadgetSnapshot', 'mode discs saved_image')
+
+def gadget_snapshot():
+    """What a failed job has to put back: the mode, the image on each LUN and the remembered images"""
+    refresh_gadget_state()
+    saved_image = None
+    if os.path.exists(iso_mount_file):
+        with open(iso_mount_file, "r") as f:
+            saved_image = f.read()
+    return GadgetSnapshot(gadget_state.mode, gadget_state.discs, saved_image)
+
+def restore_saved_image(saved_image):
+    if saved_image is None:
+        try:
+            os.remove(iso_mount_file)
+        except FileNotFoundError:
+            pass
+    else:
+        with open(iso_mount_file, "w") as f:
+            f.write(saved_image)
+
+# Mounts done while switching or rolling back count towards those, not as mounts of their own
+@timed(rollback_seconds, group='gadget')
+def restore_gadget(snapshot):
+    current = gadget_snapshot()
+    if current.saved_image != snapshot.saved_image:
+        restore_saved_image(snapshot.saved_image)
+    if current.mode != snapshot.mode:
+        if snapshot.mode == 0:
+            disable_gadget()
+        else:
+            # Setting up CD-ROM mode loads the remembered images restored above
+            init_gadget(gadget_modes[snapshot.mode])
+    elif snapshot.mode == 1:
+        for lun, (image, wanted) in enumerate(zip(current.discs, snapshot.discs)):
+            if image != wanted:
+                if wanted:
+                    change_Loaded_Mount(wanted, lun)
+                else:
+                    eject_disc(lun)
+        # Loading and ejecting rewrote the remembered images
+        restore_saved_image(snapshot.saved_image)
+    if gadget_snapshot().mode != snapshot.mode:
+        raise RuntimeError(f"gadget is still in mode {checkState()}")
+
+class GadgetJob:
+    """One queued mount or mode switch and the time spent in each stage, as reported by /jobs/<id>"""
+
+    def __init__(self, id, kind, target, action, args, lun=None):
+        self.id = id
+        self.kind = kind
+        self.target = target
+        self.lun = lun
+        self.action = action
+        self.args = args
+        self.state = 'queued'
+        self.stages = []
+        self.stack = []
+        self.error = None
+        self.rolled_back = None
+        self.rollback_error = None
+        self.superseded_by = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = Event()
+
+    def url(self):
+        return f"/jobs/{self.id}"
+
+    def coalesce_key(self):
+        """Queued jobs with the same key replace each other, None if this job never does"""
+        changes = gadget_coalesced_kinds.get(self.kind)
+        return (changes, self.lun) if changes else None
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def as_dict(self):
+        elapsed = (self.finished or time.time()) - self.started if self.started else None
+        return {'id': self.id, 'kind': self.kind, 'target': self.target, 'lun': self.lun, 'state': self.state, 'error': self.error,
+                'rolled_back': self.rolled_back, 'rollback_error': self.rollback_error, 'superseded_by': self.superseded_by,
+                'created': self.created, 'started': self.started, 'finished': self.finished,
+                'queued_ms': round(((self.started or self.finished or time.time()) - self.created) * 1000, 1),
+                'elapsed_ms': round(elapsed * 1000, 1) if elapsed is not None else None,
+                'stages': [{'stage': name, 'ms': round(seconds * 1000, 1)} for name, seconds in self.stages]}
+
+gadget_job_seconds = Histogram('usbode_gadget_job_seconds', "Time to run a gadget job, including any rollback", 'kind')
+gadget_jobs_total = Counter('usbode_gadget_jobs_total', "Gadget jobs by final state", 'state')
+
+class GadgetJobQueue:
+    """Owns every gadget change: runs jobs one at a time on a background thread so requests never wait on them"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.ready = threading.Condition(self.lock)
+        # Held while a job runs, so the exit path cannot tear the gadget down under it
+        self.gadget_lock = threading.RLock()
+        self.jobs = OrderedDict()
+        self.pending = deque()
+        self.next_id = 1
+        self.current = None
+        self.thread = None
+
+    def _enqueue(self, kind, target, action, args, lun=None):
+        job = GadgetJob(str(self.next_id), kind, target, action, args, lun)
+        self.next_id += 1
+        self.jobs[job.id] = job
+        while len(self.jobs) > gadget_jobs_kept:
+            oldest = next(iter(self.jobs.values()))
+            if oldest.state in ('queued', 'running'):
+                break
+            self.jobs.popitem(last=False)
+        # Three quick picks on the display become one mount
+        key = job.coalesce_key()
+        while key is not None and self.pending and self.pending[-1].coalesce_key() == key:
+            superseded = self.pending.pop()
+            superseded.state = 'superseded'
+            superseded.superseded_by = job.id
+            superseded.finished = time.time()
+            superseded.done.set()
+            gadget_jobs_total.inc('superseded')
+            logger.info(f"{kind} job {superseded.id} superseded by job {job.id}")
+        self.pending.append(job)
+        self.ready.notify()
+        return job
+
+    def submit(self, kind, target, action, *args, lun=None):
+        with self.lock:
+            job = self._enqueue(kind, target, action, args, lun)
+        logger.info(f"Queued {kind} job {job.id}" + (f" for {target}" if target else "")
+                    + (f" on disc {lun}" if lun is not None and changer_luns > 1 else ""))
+        return job
+
+    def submit_mode(self, mode=None):
+        """Queue a switch to mode, or to the other mode than the one the queued jobs leave the gadget in"""
+        with self.lock:
+            if mode is None:
+                mode = 'cdrom' if self._expected_mode() == 'exfat' else 'exfat'
+            job = self._enqueue('mode', mode, switch_to, (mode,))
+        logger.info(f"Queued mode job {job.id} for {mode}")
+        return job
+
+    def _expected_mode(self):
+        for job in reversed([self.current] + list(self.pending)):
+            if job is None:
+                continue
+            if job.kind in ('mode', 'init'):
+                return job.target
+            if job.kind == 'mount' and is_image_file(job.target):
+                return 'cdrom'
+        return gadget_modes.get(checkState())
+
+    def get(self, id):
+        with self.lock:
+            return self.jobs.get(id)
+
+    def recent(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def run(self, job):
+        with self.gadget_lock:
+            job.state = 'running'
+            job.started = time.time()
+            self.current = job
+            snapshot = None
+            try:
+                snapshot = gadget_snapshot()
+                if job.action(*job.args) is False:
+                    raise RuntimeError(f"{job.kind} did not complete, see the log")
+                job.state = 'done'
+            except Exception as e:
+                job.state = 'failed'
+                job.error = str(e)
+                logger.exception(f"{job.kind} job {job.id} failed: {e}")
+                # job.error keeps why the job failed, rollback_error why putting things back failed too
+                try:
+                    if snapshot is None:
+                        raise RuntimeError("the gadget state could not be read before the job started")
+                    with job_stage('rollback'):
+                        restore_gadget(snapshot)
+                    job.rolled_back = True
+                except Exception as e:
+                    job.rolled_back = False
+                    job.rollback_error = str(e)
+                    logger.exception(f"Rolling back {job.kind} job {job.id} after \"{job.error}\" failed: {e}")
+            finally:
+                self.current = None
+                job.finished = time.time()
+                job.done.set()
+        gadget_job_seconds.observe(job.finished - job.started, job.kind)
+        gadget_jobs_total.inc(job.state)
+        logger.info(f"{job.kind} job {job.id} {job.state} in {(job.finished - job.started) * 1000:.0f} ms: "
+                    + ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in job.stages))
+
+    def worker(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.ready.wait()
+                job = self.pending.popleft()
+                # Claimed under the lock so _expected_mode never misses it between the queue and run()
+                self.current = job
+            self.run(job)
+
+gadget_jobs = GadgetJobQueue()
 
-def getMyIPAddress():
-    while True:
-        global myIPAddress, updateEvent
-        time.sleep(1)
-        try:
-            ipAddressAttempt = subprocess.check_output(['hostname', '-I']).decode('utf-8').strip().split(' ')[0]
-        except Exception as e:
-            ipAddressAttempt = "Unable to determine IP address"
-            logger.error(f"Failed to get IP address: {e}")
-        
-        if ipAddressAttempt != myIPAddress:
-            logger.info(f"IP address changed from {myIPAddress} to {ipAddressAttempt}")
-            myIPAddress = ipAddressAttempt
-            
-            # Use the lock to safely set the update event
-            with update_lock:
-                updateEvent = 1
+def start_jobs():
+    gadget_jobs.thread = Thread(target=gadget_jobs.worker, daemon=True, name='Gadget Jobs')
+    gadget_jobs.thread.start()
 
-### Begining of Web Interface ###
+@contextmanager
+def job_stage(name):
+    """Time a step of the job the worker is running; nested stages are named parent/child"""
+    job = gadget_jobs.current
+    if job is None or threading.current_thread() is not gadget_jobs.thread:
+        yield
+        return
+    job.stack.append(name)
+    path = "/".join(job.stack)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        job.stages.append((path, time.monotonic() - start))
+        job.stack.pop()
 
-app = Flask(__name__)
+def switch_to(mode):
+    """Switch only if the gadget is not already in mode, so repeated requests do not toggle back"""
+    if gadget_modes.get(checkState()) != mode:
+        switch()
+    if gadget_modes.get(checkState()) != mode:
+        raise RuntimeError(f"Gadget did not come up in {mode} mode")
 
-# HTML template with CSS styling embedded - all curly braces properly escaped
-HTML_LAYOUT = """<!DOCTYPE html>
-<html>
-<head>
-    <title>USBODE - USB Optical Drive Emulator</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <style>
-        /* Basic styling compatible with CSS 1.0 */
-        body {{background-color: #EAEAEA; color: #333333; font-family: serif; margin: 0; padding: 0;}}
-        h1, h2, h3 {{color: #1E4D8C;}}
-        a {{color: #0066CC;}}
-        a:visited {{color: #0066CC;}}
-        
-        /* Container with percentage-based width for better scaling */
-        .container {{width: 100%; max-width: 800px; margin: 0 auto; padding: 0;}}
-        
-        /* Header and footer styling */
-        .header {{background-color: #3A7CA5; padding: 10px; text-align: center; color: #FFFFFF;}}
-        .header h1, .header h2 {{color: #FFFFFF; margin: 5px 0;}}
-        .content {{padding: 10px; background-color: #FFFFFF; min-height: 300px;}}
-        .footer {{background-color: #3A7CA5; padding: 10px; text-align: center; color: #FFFFFF;}}
-        
-        /* Button styling that works on small screens */
-        .button {{
-            background-color: #4CAF50; 
-            padding: 7px 15px; 
-            text-decoration: none; 
-            color: #FFFFFF; 
-            margin: 5px; 
-            display: inline-block;
-            border: 1px solid #2E8B57;
-        }}
-        
-        /* Info boxes with better padding on small screens */
-        .info-box {{background-color: #F5F5F5; padding: 10px; margin: 10px 0;}}
-        .warning {{background-color: #FFDDDD; padding: 10px; margin: 10px 0; color: #990000;}}
-        
-        /* File list items with better scaling */
-        .file-link {{
-            padding: 8px; 
-            margin: 5px 0; 
-            display: block; 
-            font-size: 16px;
-            word-wrap: break-word;
-            overflow-wrap: break-word;
-        }}
-        .file-link-even {{background-color: #E3F2FD;}}
-        .file-link-odd {{background-color: #BBDEFB;}}
-        
-        /* Simple media queries for basic responsive layout - ignored by old browsers */
-        @media screen and (max-width: 480px) {{
-            .button {{
-                display: block;
-                margin: 10px 0;
-                text-align: center;
-            }}
-        }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>USBODE</h1>
-            <h2>USB Optical Drive Emulator</h2>
-        </div>
-        <div class="content">
-            {content}
-        </div>
-        <div class="footer">
-            <p>Version {version}</p>
-        </div>
-    </div>
-</body>
-</html>
-"""
+def mount_image(path, lun=0):
+    """Load an image; in exFAT mode that means remembering it and setting up CD-ROM mode, which loads it"""
+    if checkState() == 2 and is_image_file(path):
+        save_disc(lun, path)
+        switch_to('cdrom')
+        if gadget_state.discs[lun] != path:
+            raise RuntimeError(f"{path} was not loaded")
+        return True
+    return change_Loaded_Mount(path, lun)
 
-@app.route('/')
-def index():
-    mode = checkState()
-    mode_text = "(CD-Emulator)" if mode == 1 else "(ExFAT mode)" if mode == 2 else ""
-    
-    content = f"""
-    <h3>Welcome to USBODE</h3>
-    <div class="info-box">
-        <p>My IP address is: {myIPAddress}</p>
-        <p>Currently Serving: <strong>{getMountedCDName()}</strong></p>
-        <p>Current Mode is: <strong>{mode} {mode_text}</strong></p>
-    </div>
-    
-    <div>
-        <a class="button" href="/switch">Switch Modes</a>
-        <a class="button" href="/list">Load Another Image</a>
-        <a class="button" href="/shutdown">Shutdown the Pi</a>
-    </div>
-    """
-    
-    return HTML_LAYOUT.format(content=content, version=versionNum)
+### END OF GADGET JOBS ###
 
-@app.route('/switch')  
-def switch_mode():
-    switch()
-    mode = checkState()
-    mode_text = "(CD-Emulator)" if mode == 1 else "(ExFAT mode)" if mode == 2 else ""
-    
-    content = f"""
-    <h3>Switching Mode</h3>
-    <div class="info-box">
-        <p>Switching mode complete.</p>
-        <p>Current mode is <strong>{mode} {mode_text}</strong></p>
-    </div>
-    
-    <div>
-        <a class="button" href="/switch">Switch Modes Again</a>
-        <a class="button" href="/">Return to Homepage</a>
-    </div>
-    """
-    
-    return HTML_LAYOUT.format(content=content, version=versionNum)
+### Beginning of Command Bus ###
 
-@app.route('/list')
-def listFiles():
-    fileList = list_images()
-    is_exfat = (checkState() == 2)
-    
-    content = f"""
-    <h3>File Selection</h3>
-    <div class="info-box">
-        <p>Current File Loaded: <strong>{getMountedCDName()}</strong></p>
-        <p>To load a different ISO, select it. No disconnection between the OS and the USBODE will occur.</p>
-    </div>
-    """
-    
-    content += "<h4>Available Files:</h4>"
-    # Add alternating colors to the file list
-    for i, file in enumerate(fileList):
-        encoded_file = urllib.parse.quote_plus(file)
-        row_class = "file-link-even" if i % 2 == 0 else "file-link-odd"
-        content += f'<div class="file-link {row_class}"><a href="/mount/{encoded_file}">{file}</a></div>'
-    
-    content += """
-    <div>
-        <a class="button" href="/">Return to Homepage</a>
-    </div>
-    """
-    
-    return HTML_LAYOUT.format(content=content, version=versionNum)
+# Typed commands submitted by the web routes, the JSON API and the display buttons
+# alike, so a button press no longer round-trips through the web server
+# lun picks the changer drive, 0 unless changer=N is set in usbode.conf
+MountImage = namedtuple('MountImage', 'name lun', defaults=(0,))
+MountDevice = namedtuple('MountDevice', 'path')
+EjectDisc = namedtuple('EjectDisc', 'lun')
+# mode is 'cdrom' or 'exfat', or None to toggle
+SwitchMode = namedtuple('SwitchMode', 'mode')
+Shutdown = namedtuple('Shutdown', [])
 
-@app.route('/cdemu')
-def mountCDEMU():
-    change_Loaded_Mount(f"{cdemu_cdrom}")
-    
-    content = f"""
-    <h3>Mounting File</h3>
-    <div class="info-box">
-        <p>Attempting to mount: <strong>CDEMU CDROM</strong></p>
-    </div>
-    
-    <div>
-        <a class="button" href="/">Return to Homepage</a>
-        <a class="button" href="/list">Select Another File</a>
-    </div>
-    """
-    
-    return HTML_LAYOUT.format(content=content, version=versionNum)
+command_handlers = {}
+command_seconds = Histogram('usbode_command_seconds', "Time to dispatch a command, not including the queued job", 'command')
 
-@app.route('/mount/<file>')
-def mountFile(file):
-    decoded_file = urllib.parse.unquote_plus(file)
-    change_Loaded_Mount(f"{store_mnt}/{decoded_file}")
-    
-    content = f"""
-    <h3>Mounting File</h3>
-    <div class="info-box">
-        <p>Attempting to mount: <strong>{decoded_file}</strong></p>
-    </div>
-    
-    <div>
-        <a class="button" href="/">Return to Homepage</a>
-        <a class="button" href="/list">Select Another File</a>
-    </div>
-    """
-    
-    return HTML_LAYOUT.format(content=content, version=versionNum)
+def command_handler(kind):
+    def register(function):
+        command_handlers[kind] = function
+        return function
+    return register
 
-@app.route('/shutdown')
-def shutdown():
-    start_shutdown()
-    
-    content = """
-    <h3>System Shutdown</h3>
-    <div class="warning">
-        <p>Shutting down the Pi now...</p>
-    </div>
-    """
-    
-    return HTML_LAYOUT.format(content=content, version=versionNum)
+def dispatch(command):
+    """Run the handler for command; mounts and switches return their queued GadgetJob"""
+    handler = command_handlers.get(type(command))
+    if handler is None:
+        raise TypeError(f"No handler for {type(command).__name__}")
+    with command_seconds.time(type(command).__name__):
+        return handler(command)
 
-@app.route('/exit')
-def exit():
-    start_exit()
-    Thread.is_alive == 0
-    
-    content = """
-    <h3>Application Exit</h3>
-    <div class="warning">
-        <p>Exiting the application now...</p>
-    </div>
-    """
-    
-    return HTML_LAYOUT.format(content=content, version=versionNum)
-### END OF WEB INTERFACE ###
+@command_handler(MountImage)
+def handle_mount_image(command):
+    # store_path and changer_lun raise ValueError for names outside the store and missing LUNs, before anything is queued
+    path = store_path(command.name)
+    lun = changer_lun(command.lun)
+    return gadget_jobs.submit('mount', command.name, mount_image, path, lun, lun=lun)
 
-def getMountedCDName():
-    if not os.path.exists(gadgetCDFolder+"/functions/mass_storage.usb0/lun.0/file"):
-        logger.exception("Error: ISO Not Set")
-    with open(gadgetCDFolder+"/functions/mass_storage.usb0/lun.0/file", "r") as f:
-        return f.readline().strip()
+@command_handler(MountDevice)
+def handle_mount_device(command):
+    return gadget_jobs.submit('mount', command.path, change_Loaded_Mount, command.path, lun=0)
 
-# Print without endline
-def prints(string):
-    print(string, end=' ')
+@command_handler(EjectDisc)
+def handle_eject_disc(command):
+    lun = changer_lun(command.lun)
+    return gadget_jobs.submit('eject', None, eject_disc, lun, lun=lun)
+
+@command_handler(SwitchMode)
+def handle_switch_mode(command):
+    return gadget_jobs.submit_mode(command.mode)
+
+@command_handler(Shutdown)
+def handle_shutdown(command):
+    start_shutdown()
+
+### END OF COMMAND BUS ###
 
-def list_images():
-    fileList = []
-    dir_list=os.listdir(store_mnt)
-    for file in dir_list:
-        if (file.lower().endswith(".iso") or file.lower().endswith("cue")) and not (file.startswith("._")):
-            fileList.append(file)
-    fileListSorted=sorted(fileList, key=str.lower)
-    logger.info(f"Found {len(fileList)} files")
-    return fileListSorted
-    
 def cleanupMode(gadgetFolder=gadgetCDFolder):
     #Cleanup the gadget folder
     print("Unloading Gadget")
-    logger.info(subprocess.run(['sh', 'scripts/cleanup_mode.sh', gadgetFolder], cwd="/opt/usbode", capture_output=True, text=True))
-    time.sleep(.25)
+    with job_stage('cleanup'):
+        try:
+            ConfigfsGadget(gadgetFolder).teardown()
+        except OSError as e:
+            logger.error(f"Failed to remove gadget {gadgetFolder}: {e}")
+        gadget_state_changed()
 
 def init_gadget(type):
-    logger.info(f"Initializing USBODE {type} gadget through configfs...")
-    cleanupMode()
-    try:
-        os.makedirs(gadgetCDFolder, exist_ok=True)
-        os.makedirs(gadgetCDFolder + "/strings/0x409", exist_ok=True)
-        os.makedirs(gadgetCDFolder +"/configs/c.1/strings/0x409", exist_ok=True)
-        os.makedirs(gadgetCDFolder +"/functions/mass_storage.usb0", exist_ok=True)
+    with job_stage(f'init {type}'), init_gadget_seconds.time(type):
+        logger.info(f"Bringing up the USBODE {type} gadget...")
+        try:
+            if not gadgets_staged:
+                stage_gadgets()
+            if type == "exfat":
+                # Unblocked again in the finally below; once exported, store_exported() keeps writers out
+                if not block_store_writes():
+                    raise RuntimeError("uploads or extractions are still writing to the image store")
+                if checkState() == 1:
+                    for disc in gadget_state.discs:
+                        remember_hot_regions(disc)
+            disable_gadget()
         
-        if type == "cdrom":
-            result = subprocess.run(['sh', 'scripts/cd_gadget_setup.sh', gadgetCDFolder], cwd="/opt/usbode", capture_output=True, text=True)
-            if result.returncode != 0:
-                logger.exception(f"CDROM gadget setup failed: {result.stderr}")
-            
-            with open(iso_mount_file, "r") as f:
-                iso_filename = f.readline().strip()
-            
-            if iso_filename and os.path.exists(f"{iso_filename}"):
-                logger.info(f"Loading ISO: {iso_filename}")
-                change_Loaded_Mount(f"{iso_filename}")
-            else:
-                logger.warning(f"The requested file to load {iso_filename} does not exist, switching to exFAT mode.")
-                disable_gadget()
+            if type == "cdrom":
+                for lun, iso_filename in enumerate(saved_discs()):
+                    if iso_filename and os.path.exists(f"{iso_filename}"):
+                        logger.info(f"Loading ISO: {iso_filename}" + (f" into disc {lun}" if changer_luns > 1 else ""))
+                        change_Loaded_Mount(f"{iso_filename}", lun)
+                    elif lun == 0 or iso_filename:
+                        logger.warning(f"The requested file to load {iso_filename} does not exist, the drive will be empty.")
                 
-        elif type == "exfat":
-            result = subprocess.run(['sh', 'scripts/exfat_gadget_setup.sh', gadgetCDFolder], cwd="/opt/usbode", capture_output=True, text=True)
-            if result.returncode != 0:
-                logger.exception(f"ExFAT gadget setup failed: {result.stderr}")
-            else:
-                logger.info(f"Loading ExFAT: {store_dev}")
-            change_Loaded_Mount(f"{store_dev}")
+            elif type == "exfat":
+                # Let go of the images so the host can change the store under them
+                with job_stage('eject'):
+                    for lun in range(changer_luns):
+                        try:
+                            if read_sysfs(gadgets['cdrom'].lun_path(lun) + "/file"):
+                                gadgets['cdrom'].eject(lun)
+                        except OSError as e:
+                            logger.error(f"Forced eject failed: {e}")
+                    release_backing_file()
+                # The host closes the backing file when it safely removes the drive, so reload the store if it did
+                if not read_sysfs(gadgets['exfat'].lun + "/file"):
+                    with job_stage('load store'):
+                        gadgets['exfat'].write("functions/mass_storage.usb0/lun.0/file", store_dev)
             
-        enable_gadget()
-    except Exception as e:
-        logger.exception(f"Failed to initialize {type} gadget: {e}")
+            enable_gadget(type)
+        except Exception as e:
+            logger.exception(f"Failed to initialize {type} gadget: {e}")
+        finally:
+            if type == "exfat":
+                allow_store_writes()
 
-def enable_gadget():
-    p = subprocess.run(['sh', 'scripts/enablegadget.sh', gadgetCDFolder], cwd="/opt/usbode")
-    if p.returncode != 0:
-        logger.exception(f"failed: {p.returncode} {p.stderr} {p.stdout}")
+def enable_gadget(type):
+    try:
+        with job_stage('enable'):
+            gadgets[type].bind()
+    except OSError as e:
+        logger.error(f"Failed to enable gadget: {e}")
         return False
-    else:
-        return True
+    finally:
+        gadget_state_changed()
+    return True
 
 def disable_gadget():
-    subprocess.run(['sh', 'scripts/disablegadget.sh', gadgetCDFolder], cwd="/opt/usbode")
+    try:
+        with job_stage('disable'):
+            for staged in gadgets.values():
+                staged.unbind()
+    except OSError as e:
+        logger.error(f"Failed to disable gadget: {e}")
+    gadget_state_changed()
 
+@timed(switch_seconds, group='gadget')
 def switch():
-    if checkState(gadgetCDFolder) == 0:
-        logger.error("Both modes are disabled, enabling exfat mode")
-        disable_gadget()
-        init_gadget("exfat")
-        change_Loaded_Mount(f"{store_dev}")
-        enable_gadget()
+    if outermost_call('gadget'):
+        mode_switches_total.inc()
+    state = checkState()
+    if state == 2:
+        # The host may have changed the store while it owned it in exFAT mode
+        with job_stage('catalog refresh'):
+            image_catalog.refresh(force=True)
+        if len(list_images()) > 0:
+            print("Switching to CD-ROM mode")
+            with job_stage('sync'):
+                subprocess.run('sync')
+            init_gadget("cdrom")
     else:
-        if checkState(gadgetCDFolder) == 1:
-            print("Switching to ExFAT mode")
-            disable_gadget()
-            init_gadget("exfat")
-            change_Loaded_Mount(f"{store_dev}")
-            enable_gadget()
+        if state == 0:
+            logger.error("Both modes are disabled, enabling exfat mode")
         else:
-            if len(list_images()) > 0:
-                print("Switching to CD-ROM mode")
-                subprocess.run('sync')            
-                disable_gadget()
-                init_gadget("cdrom")
-                enable_gadget()
-
-def checkState(gadgetFolder=gadgetCDFolder):
+            print("Switching to ExFAT mode")
+        init_gadget("exfat")
+
+def checkState():
     #Return Mode of the gadget 0 = not enabled, 1 = cdrom, 2 = exfat
-    if not os.path.exists(gadgetFolder+"/UDC"):
-        logger.error(f"{gadgetFolder}/UDC not found")
-        return 0
-    else:
-        UDCContents=open(gadgetFolder+"/UDC", "r")
-        UDCchar = UDCContents.read(1)
-        UDCContents.close()
-        if UDCchar ==  "\n":
-            return 0
-        else:
-            cdromState = open(f"{gadgetFolder}/functions/mass_storage.usb0/lun.0/cdrom", "r").readline().rstrip()
-            if cdromState == "1":
-                return 1
-            elif cdromState == "0":
-                return 2
-            else:
-                logger.error(f"Could not read from {gadgetFolder}/functions/mass_storage.usb0/lun.0/cdrom")
-                return 0
+    #Each mode has its own gadget, the mode is whichever one holds the UDC
+    return gadget_state.mode
 
-def change_Loaded_Mount(filename):
-    isoloading = False
-    #Save the ISO filename to to persistent storage
+def store_exported():
+    """True while the store partition is handed to the host in exFAT mode"""
+    return gadget_state.mode == 2
+
+def count_mount(result):
+    if outermost_call('gadget'):
+        mounts_total.inc(result)
+
+@timed(mount_seconds, group='gadget')
+def change_Loaded_Mount(filename, lun=0):
+    lun_file = f"{gadgetCDFolder}/functions/mass_storage.usb0/lun.{lun}/file"
     if checkState() == 1:
-        subprocess.run(['sh', 'scripts/force_eject_iso.sh', gadgetCDFolder], cwd="/opt/usbode")
-    if filename.lower().endswith(".iso") or filename.lower().endswith(".cue"): 
-        f = open(iso_mount_file, "w")
-        f.write(f"{filename}" + "\n")
-        f.close()
-        isoloading = True
+        with job_stage('eject'):
+            remember_hot_regions(gadget_state.discs[lun])
+            try:
+                gadgets['cdrom'].eject(lun)
+            except OSError as e:
+                # The old image may still be loaded; fail so the job rolls back instead of swapping its backing file
+                logger.error(f"Forced eject failed: {e}")
+                count_mount('failed')
+                return False
+    #Save the ISO filename to to persistent storage
+    if is_image_file(filename): 
+        save_disc(lun, filename)
     #Change the disk image in the gadget
-    if not os.path.exists(gadgetCDFolder+"/functions/mass_storage.usb0/lun.0/file"):
+    if not os.path.exists(lun_file):
         logger.error("Gadget is not enabled, cannot change mount")
+        count_mount('failed')
         updateDisplay(disp)
         return False
     else:
-        print(gadgetCDFolder+"/functions/mass_storage.usb0/lun.0/file")
-        with open(gadgetCDFolder+"/functions/mass_storage.usb0/lun.0/file", "w") as f:
-            logger.info(f"Changing mount to {filename}")
-            f.write(f"{filename}")
+        print(lun_file)
+        try:
+            with job_stage('backing file'):
+                backing = backing_file_for(filename, lun)
+        except Exception as e:
+            logger.error(f"Cannot serve {filename}: {e}")
+            count_mount('failed')
+            return False
+        with job_stage('warm-up'):
+            warm_image(filename)
+        with job_stage('load lun'), open(lun_file, "w") as f:
+            logger.info(f"Changing mount to {filename}" + (f" via {backing}" if backing != filename else "")
+                        + (f" on disc {lun}" if changer_luns > 1 else ""))
+            f.write(f"{backing}")
             f.close()
-            if checkState() == 2 and isoloading == True:
-                switch()
-        global updateEvent
-        updateEvent = 1
+        count_mount('ok')
+        gadget_state_changed()
+        signal_update()
         return True
 
 def start_exit():
@@ -542,12 +4863,12 @@ def start_exit():
             image = Image.new('RGB', (st_disp.width, st_disp.height), color=(0, 0, 0))
             draw = ImageDraw.Draw(image)
             draw.text((40, 100), "Shutting down...", font=st_fontL, fill=(255, 255, 255))
-            st_disp.display(image)
+            show_st7789(st_disp, image)
             time.sleep(1)
             
             # Then clear to black
             black_image = Image.new('RGB', (st_disp.width, st_disp.height), color=(0, 0, 0))
-            st_disp.display(black_image)
+            show_st7789(st_disp, black_image)
             
             # Clean up GPIO
             import RPi.GPIO as GPIO
@@ -563,7 +4884,7 @@ def start_exit():
             image1 = Image.new('1', (disp.width, disp.height), "BLACK")
             draw = ImageDraw.Draw(image1)
             draw.text((10, 25), "Shutting down...", font=fontL, fill=1)
-            disp.ShowImage(disp.getbuffer(image1))
+            show_oled(disp, image1)
             time.sleep(1)
             
             # Then clear to black
@@ -573,8 +4894,15 @@ def start_exit():
         except Exception as e:
             logger.error(f"Error stopping OLED: {e}")
             
-    disable_gadget()
-    cleanupMode()
+    # Wait for a running gadget job instead of tearing the gadget down under it
+    with gadget_jobs.gadget_lock:
+        if checkState() == 1:
+            for disc in gadget_state.discs:
+                remember_hot_regions(disc)
+        disable_gadget()
+        for staged in gadgets.values():
+            cleanupMode(staged.path)
+        release_backing_file()
     logger.info(subprocess.run(['rmmod', 'usb_f_mass_storage'], capture_output=True, text=True))
     logger.info(subprocess.run(['rmmod', 'libcomposite'], capture_output=True, text=True))
 
@@ -582,22 +4910,174 @@ def start_shutdown():
     print("Shutdown in progress...")
     subprocess.run(['shutdown', 'now'])
 
+### Beginning of HTTP Server ###
+
+http_workers = 8
+# Extra workers for requests that hold one for minutes (event streams, long-polls, uploads and
+# extraction), so they can't take the workers page loads need; more of them get 503
+http_stream_workers = 6
+# Connections allowed to wait for a worker before new ones are turned away
+http_backlog = 16
+# Seconds a client may stall on a single read, and may idle between keep-alive requests
+http_timeout = 15
+http_keepalive_timeout = 5
+# Seconds the request line and headers may take in total, against clients that trickle them in
+http_header_timeout = 10
+http_shutdown_grace = 5
+
+class HeaderDeadlineReader:
+    """Wraps a connection's rfile so reads fail once the header deadline has passed"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.deadline = None
+
+    def _check(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise socket.timeout("request headers took too long")
+
+    def readline(self, *args):
+        line = self.stream.readline(*args)
+        self._check()
+        return line
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self._check()
+        return data
+
+    def readinto(self, buffer):
+        count = self.stream.readinto(buffer)
+        self._check()
+        return count
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def long_lived_request(method, path):
+    """Requests that keep their worker long after the headers: event streams, long-polls, uploads and extraction"""
+    path = urllib.parse.urlsplit(path).path
+    return path.startswith('/events') or (path.startswith('/upload/') and method in ('PUT', 'POST')) or \
+        (path == '/extract' and method == 'POST')
+
+class PooledRequestHandler(WSGIRequestHandler):
+    """Keep-alive request handler that drops idle, stalled and slow-header clients so they can't pin a worker"""
+    protocol_version = 'HTTP/1.1'
+    timeout = http_timeout
+
+    def setup(self):
+        super().setup()
+        self.rfile = HeaderDeadlineReader(self.rfile)
+        self.handled_requests = 0
+
+    def handle_one_request(self):
+        self.connection.settimeout(http_keepalive_timeout if self.handled_requests else http_timeout)
+        self.handled_requests += 1
+        self.rfile.deadline = time.monotonic() + http_header_timeout
+        self.stream_slot = False
+        try:
+            super().handle_one_request()
+        finally:
+            if self.stream_slot:
+                self.server.stream_slots.release()
+
+    def parse_request(self):
+        result = super().parse_request()
+        # Headers are in; bodies and responses only have the per-read timeout
+        self.rfile.deadline = None
+        self.connection.settimeout(http_timeout)
+        if result and long_lived_request(self.command, self.path):
+            if not self.server.stream_slots.acquire(blocking=False):
+                self.send_error(503, "Too many streams and uploads in progress")
+                return False
+            self.stream_slot = True
+        return result
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug server that hands each connection to a fixed pool of worker
+    threads instead of a new thread per connection. Once the pool and its
+    backlog are full, further connections are closed straight away, so a
+    burst of slow clients can't exhaust the Pi's memory or starve the others.
+    Long-lived requests may only occupy http_stream_workers of the workers,
+    which leaves http_workers for pages however many streams are open.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app):
+        super().__init__(host, port, app, handler=PooledRequestHandler)
+        self.pool = ThreadPoolExecutor(max_workers=http_workers + http_stream_workers, thread_name_prefix='HTTP')
+        self.slots = threading.BoundedSemaphore(http_workers + http_stream_workers + http_backlog)
+        self.stream_slots = threading.BoundedSemaphore(http_stream_workers)
+        self.active = 0
+        self.active_lock = Lock()
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            logger.warning(f"HTTP server busy, dropping connection from {client_address[0]}")
+            self.shutdown_request(request)
+            return
+        with self.active_lock:
+            self.active += 1
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.active_lock:
+                self.active -= 1
+            self.slots.release()
+
+    def stop(self, grace=http_shutdown_grace):
+        """Stop accepting, give in-flight requests up to grace seconds to finish, then close the socket"""
+        self.shutdown()
+        deadline = time.monotonic() + grace
+        while self.active and time.monotonic() < deadline:
+            time.sleep(0.05)
+        if self.active:
+            logger.warning(f"Closing HTTP server with {self.active} requests still running")
+        self.pool.shutdown(wait=False)
+        self.server_close()
+
+http_server = None
+
 def start_flask():
+    global http_server
     print("Starting Flask server...")
-    app.run(host='::', port=80)
+    http_server = PooledWSGIServer('::', 80, app)
+    http_server.serve_forever()
+
+def stop_flask():
+    if http_server is not None:
+        http_server.stop()
+
+### END OF HTTP SERVER ###
+
+def show_oled(disp, image):
+    with display_flush_seconds.time('oled'):
+        disp.ShowImage(disp.getbuffer(image))
+
+def show_st7789(display, image):
+    with display_flush_seconds.time('st7789'):
+        display.display(image)
 
 def changeISO_OLED(disp):
-    file_list = list_images()
+    folder = current_image_folder()
+    file_list = folder_menu_items(folder)
     iterator = 0
     
-    if len(file_list) < 1:
+    if len(list_images()) < 1:
         print("No images found in store, throwing error on screen.")
         disp.clear()
         image1 = Image.new('1', (disp.width, disp.height), "WHITE")
         draw = ImageDraw.Draw(image1)
         draw.text((0, 0), "No Images in store.", font=fontL, fill=0)
         draw.text((0, 14), "Please add an image first.", font=fontL, fill=0)
-        disp.ShowImage(disp.getbuffer(image1))
+        show_oled(disp, image1)
         time.sleep(1.0)  # Show error for a second
         return False
         
@@ -615,7 +5095,7 @@ def changeISO_OLED(disp):
     debounce_time = 0.2  # seconds
     last_press_time = {pin: 0 for pin in button_pins}
     
-    updateDisplay_FileS(disp, iterator, file_list)
+    updateDisplay_FileS(disp, iterator, file_list, folder)
     
     while True:
         current_time = time.time()
@@ -630,20 +5110,29 @@ def changeISO_OLED(disp):
                 # Check debounce
                 if current_time - last_press_time[pin] > debounce_time:
                     last_press_time[pin] = current_time
+                    count_button_press(pin)
                     
                     # Handle button actions
                     if i == 0:  # Up button
                         iterator = (iterator - 1) % len(file_list)
-                        updateDisplay_FileS(disp, iterator, file_list)
+                        updateDisplay_FileS(disp, iterator, file_list, folder)
                         print("Going up")
                     elif i == 1:  # Down button
                         iterator = (iterator + 1) % len(file_list)
-                        updateDisplay_FileS(disp, iterator, file_list)
+                        updateDisplay_FileS(disp, iterator, file_list, folder)
                         print(f"Selected {file_list[iterator]}")
                     elif i == 2 or i == 3:  # OK button or Press button
-                        print(f"loading {store_mnt}/{file_list[iterator]}")
-                        requests.request('GET', f'http://127.0.0.1/mount/{file_list[iterator]}')
-                        return True
+                        kind, target = folder_menu_select(folder, file_list[iterator])
+                        if kind == 'folder':
+                            folder = target
+                            file_list = folder_menu_items(folder)
+                            iterator = 0
+                            updateDisplay_FileS(disp, iterator, file_list, folder)
+                            print(f"Opened folder /{folder}")
+                        else:
+                            print(f"loading {store_mnt}/{target}")
+                            dispatch(MountImage(target, display_disc))
+                            return True
                     elif i == 4:  # Cancel button
                         print("CANCEL")
                         return True
@@ -653,15 +5142,16 @@ def changeISO_OLED(disp):
                 
         time.sleep(0.05)  # More responsive polling
 
-def updateDisplay_FileS(disp, iterator, file_list):
+@timed(display_render_seconds, 'oled_files')
+def updateDisplay_FileS(disp, iterator, file_list, folder=''):
     image1 = Image.new('1', (disp.width, disp.height), "WHITE")
     draw = ImageDraw.Draw(image1)
     
     # Move "Select an ISO" text up slightly
-    draw.text((0, -2), "Select an ISO:", font=fontL, fill=0)
+    draw.text((0, -2), f"Select for disc {display_disc}:" if changer_luns > 1 else "Select an ISO:", font=fontL, fill=0)
     
-    # Current ISO with two-line support
-    current_iso = str.replace(getMountedCDName(), store_mnt+'/', '')
+    # Current ISO with two-line support, of the disc the pick goes into
+    current_iso = str.replace(gadget_state.discs[display_disc], store_mnt+'/', '')
     
     # First line has "I: " prefix, so fewer characters per line
     first_line_chars = 18
@@ -688,8 +5178,8 @@ def updateDisplay_FileS(disp, iterator, file_list):
     line_y = 22 if len(current_iso) <= first_line_chars else 32
     draw.line([(0, line_y), (127, line_y)], fill=0)
     
-    # New ISO selection with two-line support
-    selected_file = file_list[iterator]
+    # New ISO selection with two-line support, showing the verified DAT title when there is one
+    selected_file = menu_item_label(folder, file_list[iterator])
     
     # Position for new selection depends on line_y
     selection_y = line_y + 3
@@ -712,8 +5202,9 @@ def updateDisplay_FileS(disp, iterator, file_list):
     
     # Removed file position indicator completely to avoid text overflow
     
-    disp.ShowImage(disp.getbuffer(image1))
+    show_oled(disp, image1)
 
+@timed(display_render_seconds, 'oled_main')
 def updateDisplay(disp):
     image1 = Image.new('1', (disp.width, disp.height), "WHITE")
     draw = ImageDraw.Draw(image1)
@@ -793,15 +5284,28 @@ def updateDisplay(disp):
     mode_text = "(CD)" if mode == 1 else "(ExFAT)" if mode == 2 else ""
     draw.text((15, 45), f"{mode} {mode_text}", font=fontL, fill=0)
     
-    disp.ShowImage(disp.getbuffer(image1))
+    show_oled(disp, image1)
 
-def updateDisplay_Advanced(disp):
+@timed(display_render_seconds, 'oled_advanced')
+def drawDisplay_Advanced(disp):
     image1 = Image.new('1', (disp.width, disp.height), "WHITE")
     draw = ImageDraw.Draw(image1)
     draw.text((0, 0), "Advanced Menu:" + versionNum, font = fontL, fill = 0 )
     draw.text((1,25), "Shutdown USBODE", font = fontS, fill = 0 )
     draw.line([(0,37),(127,37)], fill = 0)
-    disp.ShowImage(disp.getbuffer(image1))
+    if changer_luns > 1:
+        # Joystick picks the disc the file picker loads into, KEY3 empties it
+        draw.text((1,40), f"Up/Down: disc {display_disc}", font = fontS, fill = 0 )
+        draw.text((1,51), f"KEY3: eject disc {display_disc}", font = fontS, fill = 0 )
+    show_oled(disp, image1)
+
+def waitForRelease(disp, pin):
+    while disp.RPI.digital_read(pin) != 0:
+        time.sleep(0.05)
+
+def updateDisplay_Advanced(disp):
+    global display_disc
+    drawDisplay_Advanced(disp)
     while True:
         time.sleep(0.15)
         if disp.RPI.digital_read(disp.RPI.GPIO_KEY2_PIN) == 0:
@@ -809,14 +5313,24 @@ def updateDisplay_Advanced(disp):
         else: 
             print("CANCEL") 
             return True
+        if changer_luns > 1:
+            for pin, step in ((disp.RPI.GPIO_KEY_UP_PIN, -1), (disp.RPI.GPIO_KEY_DOWN_PIN, 1)):
+                if disp.RPI.digital_read(pin) != 0:
+                    display_disc = (display_disc + step) % changer_luns
+                    drawDisplay_Advanced(disp)
+                    waitForRelease(disp, pin)
+            if disp.RPI.digital_read(disp.RPI.GPIO_KEY3_PIN) != 0:
+                dispatch(EjectDisc(display_disc))
+                waitForRelease(disp, disp.RPI.GPIO_KEY3_PIN)
+                return True
         if disp.RPI.digital_read(disp.RPI.GPIO_KEY1_PIN) == 0: # button is released
             pass
         else: # button is pressed:
-            requests.request('GET', f'http://127.0.0.1/shutdown')
+            dispatch(Shutdown())
         if disp.RPI.digital_read(disp.RPI.GPIO_KEY_PRESS_PIN) == 0: 
             pass
         else:
-            requests.request('GET', f'http://127.0.0.1/shutdown')
+            dispatch(Shutdown())
 
 def showLEDLights():
     #Creates a musicical pattern on the LED to indicate that the USBODE is ready
@@ -942,6 +5456,7 @@ def getDisplayInput():
                     # Check debounce
                     if current_time - last_press_time[pin] > debounce_time:
                         last_press_time[pin] = current_time
+                        count_button_press(pin)
                         
                         # If screen is off, just turn it on and do nothing else
                         if not screen_is_on:
@@ -953,7 +5468,7 @@ def getDisplayInput():
                             # Handle button actions
                             if i == 0:  # Mode button
                                 logger.info("Changing MODE (OLED button)")
-                                switch()
+                                dispatch(SwitchMode(None)).wait()
                                 updateDisplay(disp)
                                 if st7789Enabled and st_disp:
                                     updateST7789Display(st_disp)
@@ -992,6 +5507,7 @@ def getDisplayInput():
                     # Check debounce
                     if current_time - last_press_time[pin] > debounce_time:
                         last_press_time[pin] = current_time
+                        count_button_press(pin)
                         
                         # If screen is off, just turn it on and do nothing else
                         if not screen_is_on:
@@ -1037,7 +5553,7 @@ def getDisplayInput():
                 try:
                     # Black image to clear the screen
                     black_image = Image.new('RGB', (st_disp.width, st_disp.height), color=(0, 0, 0))
-                    st_disp.display(black_image)
+                    show_st7789(st_disp, black_image)
                     
                     # Turn off backlight by setting GPIO 13 low
                     import RPi.GPIO as GPIO
@@ -1125,7 +5641,7 @@ def init_st7789():
             backlight=13,            # Use backlight pin directly in constructor
             width=240,               # Display width
             height=240,              # Display height
-            rotation=90,             # Pirate Audio uses 90 degree rotation
+            rotation=st7789_rotation, # Pirate Audio uses 90 degree rotation
             spi_speed_hz=80000000,   # 80MHz - same as reference
             offset_left=0,
             offset_top=0
@@ -1141,25 +5657,25 @@ def init_st7789():
         
         # Create a solid red image
         red_image = Image.new('RGB', (display.width, display.height), color=(255, 0, 0))
-        display.display(red_image)
+        show_st7789(display, red_image)
         logger.info("Displayed red test pattern")
         time.sleep(0.5)
         
         # Create a solid green image
         green_image = Image.new('RGB', (display.width, display.height), color=(0, 255, 0))
-        display.display(green_image)
+        show_st7789(display, green_image)
         logger.info("Displayed green test pattern")
         time.sleep(0.5)
         
         # Create a solid blue image
         blue_image = Image.new('RGB', (display.width, display.height), color=(0, 0, 255))
-        display.display(blue_image)
+        show_st7789(display, blue_image)
         logger.info("Displayed blue test pattern")
         time.sleep(0.5)
         
         # Create a solid white image
         white_image = Image.new('RGB', (display.width, display.height), color=(255, 255, 255))
-        display.display(white_image)
+        show_st7789(display, white_image)
         logger.info("Displayed white test pattern")
         
         logger.info("ST7789 display initialization complete")
@@ -1201,6 +5717,7 @@ def log_st7789_settings(disp):
 
 # Add these new functions to provide a consistent interface
 
+@timed(display_render_seconds, 'st7789_main')
 def updateST7789Display(display):
     """Update the ST7789 display with current status information"""
     image = Image.new('RGB', (display.width, display.height), color=(255, 255, 255))
@@ -1375,16 +5892,20 @@ def updateST7789Display(display):
                   outline=(0, 0, 0), fill=(255, 223, 128), width=2)
     
     
-    display.display(image)
+    show_st7789(display, image)
     
-def updateST7789Display_FileS(display, iterator, file_list):
+@timed(display_render_seconds, 'st7789_files')
+def updateST7789Display_FileS(display, iterator, file_list, folder=''):
     """Show file selection screen on ST7789 display"""
     image = Image.new('RGB', (display.width, display.height), color=(255, 255, 255))
     draw = ImageDraw.Draw(image)
     
-    # Draw header
+    # Draw header, showing the folder being browsed when not at the top of the store
     draw.rectangle([(0, 0), (240, 30)], fill=(58, 124, 165))
-    draw.text((10, 5), "Select ISO", font=st_fontL, fill=(255, 255, 255))
+    header = "Select ISO" if not folder else "/" + folder if len(folder) <= 20 else "/…" + folder[-19:]
+    if changer_luns > 1 and not folder:
+        header = f"Select ISO for disc {display_disc}"
+    draw.text((10, 5), header, font=st_fontL, fill=(255, 255, 255))
     
     # Replace "Current:" text with CD icon
     cd_x, cd_y = 10, 40
@@ -1401,7 +5922,7 @@ def updateST7789Display_FileS(display, iterator, file_list):
             45, 180, fill=(255, 255, 255), width=1)
     
     # Show current ISO name with more characters (up to 25) since we're using smaller font
-    current_iso = str.replace(getMountedCDName(), store_mnt+'/', '')
+    current_iso = str.replace(gadget_state.discs[display_disc], store_mnt+'/', '')
     if len(current_iso) > 25:  # If longer than 25 chars, show first 12 + "…" + last 12
         current_iso_display = current_iso[:12] + "…" + current_iso[-12:]  # Using Unicode ellipsis character
     else:
@@ -1410,7 +5931,7 @@ def updateST7789Display_FileS(display, iterator, file_list):
     draw.text((35, 40), current_iso_display, font=st_fontS, fill=(0, 0, 0))
     
     # Determine if we need 1, 2 or 3 lines for selected file display
-    selected_file = file_list[iterator]
+    selected_file = menu_item_label(folder, file_list[iterator])
     chars_per_line = 21  # Characters per line
     
     # Calculate how many lines we need and adjust the blue box height accordingly
@@ -1454,13 +5975,22 @@ def updateST7789Display_FileS(display, iterator, file_list):
     
     if len(selected_file) <= chars_per_line:
         # For single line, position counter at y=125
-        draw.text((10, 125), position_text, font=st_fontS, fill=(0, 0, 0))
+        position_y = 125
     elif len(selected_file) <= chars_per_line * 2:
         # For two lines, position counter at y=140
-        draw.text((10, 140), position_text, font=st_fontS, fill=(0, 0, 0))
+        position_y = 140
     else:
         # For three lines, position counter at y=160
-        draw.text((10, 160), position_text, font=st_fontS, fill=(0, 0, 0))
+        position_y = 160
+    draw.text((10, position_y), position_text, font=st_fontS, fill=(0, 0, 0))
+    
+    # Volume label, filesystem and date of the highlighted image, from the metadata cache
+    kind, target = folder_menu_select(folder, file_list[iterator])
+    if kind == 'image':
+        info = metadata_summary(metadata_store.get(target))
+        if len(info) > 30:
+            info = info[:29] + "…"
+        draw.text((10, position_y + 15), info, font=st_fontS, fill=(80, 80, 80))
     
     # Draw navigation buttons - always at the bottom
     draw.rectangle([(0, 190), (240, 240)], fill=(58, 124, 165))
@@ -1493,8 +6023,24 @@ def updateST7789Display_FileS(display, iterator, file_list):
     draw.line([(check_x-10, check_y), (check_x, check_y+10), (check_x+15, check_y-15)], 
               fill=(0, 255, 0), width=3)
     
-    display.display(image)
+    show_st7789(display, image)
+    
+    # Cover art is pre-rendered in panel format, so it costs one blit on top of the frame
+    if kind == 'image':
+        tile = thumbnail_store.panel_tile(target)
+        if tile is not None:
+            blit_panel_tile(display, tile, thumb_panel_position[0], thumb_panel_position[1], thumb_panel_size)
+
+def st7789_advanced_items():
+    """(action, label) for each advanced menu entry; the changer adds the disc slot and eject entries"""
+    current_mode = checkState()
+    mode_text = "Switch to ExFAT" if current_mode == 1 else "Switch to CD-ROM" if current_mode == 2 else "Enable Device"
+    items = [('mode', mode_text)]
+    if changer_luns > 1:
+        items += [('disc', f"Disc slot: {display_disc}"), ('eject', f"Eject disc {display_disc}")]
+    return items + [('shutdown', "Shutdown USBODE")]
 
+@timed(display_render_seconds, 'st7789_advanced')
 def updateST7789Display_Advanced(display, selected_item=0):
     """Show advanced menu on ST7789 display with item selection"""
     image = Image.new('RGB', (display.width, display.height), color=(255, 255, 255))
@@ -1504,23 +6050,18 @@ def updateST7789Display_Advanced(display, selected_item=0):
     draw.rectangle([(0, 0), (240, 30)], fill=(58, 124, 165))
     draw.text((10, 5), "Advanced Menu", font=st_fontL, fill=(255, 255, 255))
     
-    # Menu options - Mode switching is first
-    current_mode = checkState()
-    mode_text = "Switch to ExFAT" if current_mode == 1 else "Switch to CD-ROM" if current_mode == 2 else "Enable Device"
-    
-    # First item - Mode switching
-    if selected_item == 0:
-        draw.rectangle([(10, 50), (230, 85)], fill=(187, 222, 251), outline=(58, 124, 165), width=2)
-    else:
-        draw.rectangle([(10, 50), (230, 85)], fill=(255, 255, 255), outline=(200, 200, 200), width=1)
-    draw.text((20, 60), mode_text, font=st_fontL, fill=(0, 0, 0))
-    
-    # Second item - Shutdown option
-    if selected_item == 1:
-        draw.rectangle([(10, 95), (230, 130)], fill=(187, 222, 251), outline=(58, 124, 165), width=2)
-    else:
-        draw.rectangle([(10, 95), (230, 130)], fill=(255, 255, 255), outline=(200, 200, 200), width=1)
-    draw.text((20, 105), "Shutdown USBODE", font=st_fontL, fill=(0, 0, 0))
+    # Menu options - Mode switching is first, shutdown last; items are packed closer to fit the changer's
+    items = st7789_advanced_items()
+    top = 50 if len(items) <= 2 else 40
+    step = min(45, (185 - top) // len(items))
+    height = step - 10 if len(items) <= 2 else step - 6
+    for i, (action, label) in enumerate(items):
+        y = top + i * step
+        if selected_item == i:
+            draw.rectangle([(10, y), (230, y + height)], fill=(187, 222, 251), outline=(58, 124, 165), width=2)
+        else:
+            draw.rectangle([(10, y), (230, y + height)], fill=(255, 255, 255), outline=(200, 200, 200), width=1)
+        draw.text((20, y + (height - 15) // 2), label, font=st_fontL, fill=(0, 0, 0))
     
     # Draw navigation buttons - larger size to fill ~86% of the bottom bar
     draw.rectangle([(0, 190), (240, 240)], fill=(58, 124, 165))
@@ -1554,7 +6095,7 @@ def updateST7789Display_Advanced(display, selected_item=0):
     draw.line([(check_x-10, check_y), (check_x, check_y+10), (check_x+15, check_y-15)], 
               fill=(0, 255, 0), width=3)
     
-    display.display(image)
+    show_st7789(display, image)
 
 # Add this function for ST7789 ISO selection
 
@@ -1566,10 +6107,11 @@ def changeST7789ISO(display):
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
     
-    file_list = list_images()
+    folder = current_image_folder()
+    file_list = folder_menu_items(folder)
     iterator = 0
     
-    if len(file_list) < 1:
+    if len(list_images()) < 1:
         logger.warning("No images found in store")
         image = Image.new('RGB', (display.width, display.height), color=(255, 255, 255))
         draw = ImageDraw.Draw(image)
@@ -1583,12 +6125,12 @@ def changeST7789ISO(display):
         draw.text((10, 90), "Please add images to", font=st_fontL, fill=(0, 0, 0))
         draw.text((10, 120), "the storage device", font=st_fontL, fill=(0, 0, 0))
         
-        display.display(image)
+        show_st7789(display, image)
         time.sleep(2.0)  # Show error for 2 seconds
         return False
     
     # Update display with first file
-    updateST7789Display_FileS(display, iterator, file_list)
+    updateST7789Display_FileS(display, iterator, file_list, folder)
     
     # Pirate Audio button mapping
     up_button = 5      # Button A
@@ -1613,8 +6155,9 @@ def changeST7789ISO(display):
         if current_up == 0 and last_states[up_button] == 1:  # Pressed
             last_states[up_button] = 0
         elif current_up == 1 and last_states[up_button] == 0:  # Released
+            count_button_press(up_button)
             iterator = (iterator - 1) % len(file_list)
-            updateST7789Display_FileS(display, iterator, file_list)
+            updateST7789Display_FileS(display, iterator, file_list, folder)
             logger.info(f"Button A (up): selected {file_list[iterator]}")
             last_states[up_button] = 1
         
@@ -1623,8 +6166,9 @@ def changeST7789ISO(display):
         if current_down == 0 and last_states[down_button] == 1:  # Pressed
             last_states[down_button] = 0
         elif current_down == 1 and last_states[down_button] == 0:  # Released
+            count_button_press(down_button)
             iterator = (iterator + 1) % len(file_list)
-            updateST7789Display_FileS(display, iterator, file_list)
+            updateST7789Display_FileS(display, iterator, file_list, folder)
             logger.info(f"Button B (down): selected {file_list[iterator]}")
             last_states[down_button] = 1
         
@@ -1634,8 +6178,18 @@ def changeST7789ISO(display):
         if current_select == 0 and last_states[select_button] == 1:  # Pressed
             last_states[select_button] = 0
         elif current_select == 1 and last_states[select_button] == 0:  # Released
-            logger.info(f"Button Y (select): Loading {store_mnt}/{file_list[iterator]}")
-            requests.request('GET', f'http://127.0.0.1/mount/{urllib.parse.quote_plus(file_list[iterator])}')
+            count_button_press(select_button)
+            kind, target = folder_menu_select(folder, file_list[iterator])
+            if kind == 'folder':
+                folder = target
+                file_list = folder_menu_items(folder)
+                iterator = 0
+                updateST7789Display_FileS(display, iterator, file_list, folder)
+                logger.info(f"Button Y (select): opened folder /{folder}")
+                last_states[select_button] = 1
+                continue
+            logger.info(f"Button Y (select): Loading {store_mnt}/{target}")
+            dispatch(MountImage(target, display_disc))
             return True
         
         # Check Cancel button (X)
@@ -1643,6 +6197,7 @@ def changeST7789ISO(display):
         if current_cancel == 0 and last_states[cancel_button] == 1:  # Pressed
             last_states[cancel_button] = 0
         elif current_cancel == 1 and last_states[cancel_button] == 0:  # Released
+            count_button_press(cancel_button)
             logger.info("Button X (cancel): Returning to main screen")
             return False
 
@@ -1668,8 +6223,9 @@ def handleST7789AdvancedMenu(display):
         select_button: 1
     }
     
-    selected_item = 0  # 0 = Mode Switch, 1 = Shutdown
-    max_items = 2
+    global display_disc
+    selected_item = 0  # Index into st7789_advanced_items(), starting at Mode Switch
+    max_items = len(st7789_advanced_items())
     
     # Initial menu display
     updateST7789Display_Advanced(display, selected_item)
@@ -1682,6 +6238,7 @@ def handleST7789AdvancedMenu(display):
         if current_up == 0 and last_states[up_button] == 1:  # Pressed
             last_states[up_button] = 0
         elif current_up == 1 and last_states[up_button] == 0:  # Released
+            count_button_press(up_button)
             selected_item = (selected_item - 1) % max_items
             updateST7789Display_Advanced(display, selected_item)
             logger.info(f"Advanced menu: selected item {selected_item}")
@@ -1692,6 +6249,7 @@ def handleST7789AdvancedMenu(display):
         if current_down == 0 and last_states[down_button] == 1:  # Pressed
             last_states[down_button] = 0
         elif current_down == 1 and last_states[down_button] == 0:  # Released
+            count_button_press(down_button)
             selected_item = (selected_item + 1) % max_items
             updateST7789Display_Advanced(display, selected_item)
             logger.info(f"Advanced menu: selected item {selected_item}")
@@ -1702,6 +6260,7 @@ def handleST7789AdvancedMenu(display):
         if current_cancel == 0 and last_states[cancel_button] == 1:  # Pressed
             last_states[cancel_button] = 0
         elif current_cancel == 1 and last_states[cancel_button] == 0:  # Released
+            count_button_press(cancel_button)
             logger.info("Advanced menu: canceled")
             return False
         
@@ -1710,11 +6269,21 @@ def handleST7789AdvancedMenu(display):
         if current_select == 0 and last_states[select_button] == 1:  # Pressed
             last_states[select_button] = 0
         elif current_select == 1 and last_states[select_button] == 0:  # Released
-            if selected_item == 0:  # Mode switch
+            count_button_press(select_button)
+            action = st7789_advanced_items()[selected_item][0]
+            if action == 'mode':
                 logger.info("Advanced menu: switching mode")
-                switch()
+                dispatch(SwitchMode(None)).wait()
                 return True
-            elif selected_item == 1:  # Shutdown
+            elif action == 'disc':  # Cycle the disc the file picker loads into
+                display_disc = (display_disc + 1) % changer_luns
+                logger.info(f"Advanced menu: file picker loads into disc {display_disc}")
+                updateST7789Display_Advanced(display, selected_item)
+            elif action == 'eject':
+                logger.info(f"Advanced menu: ejecting disc {display_disc}")
+                dispatch(EjectDisc(display_disc))
+                return True
+            elif action == 'shutdown':
                 logger.info("Advanced menu: shutting down")
                 
                 # Show shutdown screen before initiating shutdown
@@ -1741,11 +6310,11 @@ def handleST7789AdvancedMenu(display):
                 draw.line([(power_x, power_y - power_radius - 10), (power_x, power_y)], 
                          fill=(255, 255, 255), width=2)
                 
-                display.display(image)
+                show_st7789(display, image)
                 time.sleep(1)  # Show shutdown screen for a moment
                 
                 # Now initiate shutdown
-                requests.request('GET', 'http://127.0.0.1/shutdown')
+                dispatch(Shutdown())
                 return True
             
             last_states[select_button] = 1
@@ -1760,6 +6329,14 @@ def main():
         result = subprocess.run(['mount', store_dev, store_mnt, '-o', 'umask=000'], capture_output=True, text=True)
         if result.returncode != 0:
             logger.error(f"Failed to mount image store: {result.stderr}")
+        start_catalog()
+        start_metadata()
+        start_hashing()
+        start_warmup()
+        start_thumbnails()
+        start_events()
+        start_gadget_state()
+        start_jobs()
         
         #Append sbin paths for cron install
         os.environ['PATH'] = f"{os.environ['PATH']}:/sbin:/usr/sbin:/usr/local/sbin"
@@ -1778,10 +6355,11 @@ def main():
         except Exception as e:
             logger.error(f"Failed to start Flask server: {e}")
         
+        # Through the job queue so requests arriving during boot wait their turn
         if os.path.exists(iso_mount_file):
-            init_gadget("cdrom")
+            gadget_jobs.submit('init', 'cdrom', init_gadget, "cdrom").wait()
         else:
-            init_gadget("exfat")
+            gadget_jobs.submit('init', 'exfat', init_gadget, "exfat").wait()
 
         #LED Lights aren't working yet
         # daemonLEDBlinker = Thread(target=showLEDLights, daemon=True, name='LED Blinker')
@@ -1806,6 +6384,7 @@ def main():
         while exitRequested == 0:
             time.sleep(0.15)
             
+        stop_flask()
         start_exit()
         logger.info("Clean exit completed")
         quit(0)